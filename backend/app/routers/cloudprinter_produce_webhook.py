@@ -1,9 +1,13 @@
-import json, time, hmac, os, smtplib
+import json, time, hmac, os
 from email.message import EmailMessage
-from fastapi import APIRouter, Request, HTTPException, status, Depends, Response, BackgroundTasks
+from fastapi import APIRouter, Request, HTTPException, status, Depends, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 
+from app.services.email_outbox import queue_email
+from app.services.email_templates import TRACK_ORDER_URL, render as render_email
+from app.services.webhook_dedupe import dedupe_key
+
 router = APIRouter()
 security = HTTPBasic(auto_error=False)
 
@@ -30,6 +34,7 @@ def _send_production_email(
     display_name: str,
     child_name: str,
     job_id: str | None,
+    order_id: str | None = None,
 ):
     if not to_email:
         print("[MAIL] skipped: empty recipient for production email")
@@ -37,90 +42,11 @@ def _send_production_email(
 
     display = (display_name or "there").strip().title() or "there"
     child   = (child_name or "Your").strip().title() or "Your"
-    track_href = f"https://diffrun.com/track-your-order?job_id={job_id}" if job_id else "https://diffrun.com/track-your-order"
+    track_href = f"{TRACK_ORDER_URL}?job_id={job_id}" if job_id else TRACK_ORDER_URL
 
     subject = f"{child}'s storybook is now in production 🎉"
 
-    html = f"""\
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="color-scheme" content="light">
-            <meta name="supported-color-schemes" content="light">
-            <style>
-                @media only screen and (max-width: 480px) {{
-                    .container {{
-                        width: 100% !important;
-                        max-width: 100% !important;
-                        padding: 16px !important;
-                    }}
-                    .col, .img-col {{
-                        display: block !important;
-                        width: 100% !important;
-                    }}
-                    .img-col img {{
-                        width: 100% !important;
-                        height: auto !important;
-                    }}
-                    .browse-now-btn {{
-                        font-size: 14px !important;
-                        padding: 12px 16px !important;
-                    }}
-                    p, li, a {{
-                        font-size: 15px !important;
-                        line-height: 1.5 !important;
-                    }}
-                }}
-            </style>
-        </head>
-        <body style="font-family: Arial, sans-serif; background:#f7f7f7; margin:0; padding:20px;">
-            <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse:collapse;">
-                <tr>
-                    <td align="center">
-                        <table role="presentation" class="container" width="100%" cellpadding="0" cellspacing="0" border="0"
-                            style="max-width: 48rem; margin: 0 auto; background:#ffffff; border-radius:8px; box-shadow:0 0 10px rgba(0,0,0,0.08); overflow:hidden;">
-                            <tr>
-                                <td style="padding:24px;">
-                                    <p>Hey {display},</p>
-                                    <p><strong>{child}'s storybook</strong> has been moved to production at our print factory. 🎉</p>
-                                    <p>It will be shipped within the next 3–4 business days. We will notify you with the tracking ID once your order is shipped.</p>
-                                    <a href="{track_href}"
-                                        style="display: inline-block; background:#5784ba; color: white; text-decoration: none; border-radius: 18px; padding: 12px 24px; font-weight: bold;">
-                                        Track your order
-                                    </a>
-                                    <p>Thanks,<br />Team Diffrun</p>
-                                    <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0"
-                                        style="margin-top: 30px; background-color: #f7f6cf; border-radius: 8px;">
-                                        <tr>
-                                            <td class="col" style="padding: 20px; vertical-align: middle;">
-                                                <p style="font-size: 15px; margin: 0;">
-                                                    Explore more magical books in our growing collection &nbsp;
-                                                    <button class="browse-now-btn"
-                                                        style="background-color:#5784ba; margin-top: 20px; border-radius: 30px; border: none; padding:10px 15px;">
-                                                        <a href="https://diffrun.com"
-                                                            style="color:white; font-weight: bold; text-decoration: none; display:inline-block;">
-                                                            Browse Now
-                                                        </a>
-                                                    </button>
-                                                </p>
-                                            </td>
-                                            <td class="img-col" width="300"
-                                                style="padding: 0 20px 0 0; margin: 0; vertical-align: middle;">
-                                                <img src="https://diffrungenerations.s3.ap-south-1.amazonaws.com/email_image+(2).jpg"
-                                                    alt="Storybook Preview" width="300"
-                                                    style="display: block; border-radius: 0; margin: 0; padding: 0;">
-                                            </td>
-                                        </tr>
-                                    </table>
-                                </td>
-                            </tr>
-                        </table>
-                    </td>
-                </tr>
-            </table>
-        </body>
-        </html>
-        """
+    html = render_email("production", display=display, child=child, track_href=track_href)
 
     msg = EmailMessage()
     msg["Subject"] = subject
@@ -129,15 +55,73 @@ def _send_production_email(
     msg.set_content("Your book has moved to production. View this email in HTML to see the formatted message.")
     msg.add_alternative(html, subtype="html")
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(EMAIL_USER, EMAIL_PASS)
-        smtp.send_message(msg)
+    # delivery hooks (registered in main) stamp contacts, or reopen the once-gate if parked
+    queue_email(msg, kind="production",
+                meta={"email": to_email, "job_id": job_id, "order_id": order_id})
+
+def _process_item_produce(data: ItemProducePayload, orders_collection) -> bool:
+    """Apply an ItemProduce event; False when no order matches order_reference."""
+    update_fields = {
+        "print_status": "in_production",
+        "production_started_at": data.datetime,
+        "cp_order_id": data.order,
+        "cp_item_id": data.item,
+        "cp_item_reference": data.item_reference,
+    }
+    res = orders_collection.update_one({"order_id": data.order_reference}, {"$set": update_fields})
+
+    if res.matched_count == 0:
+        print(f"[CP PRODUCE] order not found for order_ref={data.order_reference}")
+        return False
+
+    # Idempotent email gate
+    once = orders_collection.update_one(
+        {"order_id": data.order_reference, "$or": [{"production_email_sent": {"$exists": False}}, {"production_email_sent": False}]},
+        {"$set": {"production_email_sent": True}}
+    )
+
+    if once.modified_count == 1:
+        order = orders_collection.find_one(
+            {"order_id": data.order_reference},
+            {"customer_email": 1, "email": 1, "user_name": 1, "name": 1, "job_id": 1, "_id": 0},
+        )
+        to_email = (order.get("customer_email") or order.get("email") or "").strip() if order else ""
+        user_name = order.get("user_name") if order else None
+        name = order.get("name") if order else None
+        job_id = order.get("job_id") if order else None
+
+        if to_email and EMAIL_USER and EMAIL_PASS:
+            try:
+                _send_production_email(
+                    to_email,
+                    user_name or "there",
+                    name or "Your",
+                    job_id,
+                    data.order_reference,
+                )
+                print(f"[CP PRODUCE] sent production email to {to_email} for {data.order_reference}")
+            except Exception as e:
+                # could not even be queued: reopen the once-gate so a later event resends
+                orders_collection.update_one(
+                    {"order_id": data.order_reference}, {"$set": {"production_email_sent": False}})
+                print(f"[CP PRODUCE] production email to {to_email} failed for {data.order_reference}: {e}")
+        else:
+            print(f"[CP PRODUCE] email skipped (to={to_email!r}) for {data.order_reference}")
+    return True
+
+def process_item_produce_event(ev: dict) -> None:
+    """Webhook worker handler for a queued ItemProduce event (raises to retry)."""
+    from main import orders_collection, webhook_dedupe
+
+    data = ItemProducePayload(apikey="", **(ev.get("payload") or {}))
+    if not _process_item_produce(data, orders_collection) and ev.get("dedupe_key"):
+        # order may not exist yet; a redelivery should be applied
+        webhook_dedupe.forget("cloudprinter", ev["dedupe_key"])
 
 @router.post("/api/webhook/cloudprinter/produce")
 @router.post("/api/webhook/cloudprinter/produce/")
 async def cloudprinter_itemproduce_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     credentials: HTTPBasicCredentials | None = Depends(security),
 ):
     t0 = time.perf_counter()
@@ -169,51 +153,34 @@ async def cloudprinter_itemproduce_webhook(
     data = ItemProducePayload(**payload)
 
     try:
-        from main import orders_collection
+        from main import orders_collection, webhook_dedupe, webhook_queue
     except Exception as e:
         print(f"[CP PRODUCE] DB import error: {e}")
         raise HTTPException(status_code=500, detail="Server misconfiguration")
 
-    update_fields = {
-        "print_status": "in_production",
-        "production_started_at": data.datetime,
-        "cp_order_id": data.order,
-        "cp_item_id": data.item,
-        "cp_item_reference": data.item_reference,
-    }
-    res = orders_collection.update_one({"order_id": data.order_reference}, {"$set": update_fields})
+    key = dedupe_key(data.type, data.order, data.item, data.datetime)
+    if webhook_dedupe.seen("cloudprinter", key):
+        print(f"[CP PRODUCE] duplicate ItemProduce for {order_ref}; ignoring")
+        return {"ok": True, "duplicate": True}
 
-    if res.matched_count == 0:
+    if orders_collection.find_one({"order_id": data.order_reference}, {"_id": 1}) is None:
+        # unknown order: same 204 as before, and a redelivery should be applied
+        webhook_dedupe.forget("cloudprinter", key)
         print(f"[CP PRODUCE] order not found for order_ref={data.order_reference} -> 204")
         return Response(status_code=204)
 
-    # Idempotent email gate
-    once = orders_collection.update_one(
-        {"order_id": data.order_reference, "$or": [{"production_email_sent": {"$exists": False}}, {"production_email_sent": False}]},
-        {"$set": {"production_email_sent": True}}
-    )
-
-    if once.modified_count == 1:
-        order = orders_collection.find_one(
-            {"order_id": data.order_reference},
-            {"customer_email": 1, "email": 1, "user_name": 1, "name": 1, "job_id": 1, "_id": 0},
+    # durable append; DB work and the email run on the webhook workers
+    try:
+        webhook_queue.enqueue(
+            "cloudprinter_produce",
+            f"order:{data.order_reference}",
+            data.model_dump(exclude={"apikey"}),
+            dedupe_key=key,
         )
-        to_email = (order.get("customer_email") or order.get("email") or "").strip() if order else ""
-        user_name = order.get("user_name") if order else None
-        name = order.get("name") if order else None
-        job_id = order.get("job_id") if order else None
-
-        if to_email and EMAIL_USER and EMAIL_PASS:
-            background_tasks.add_task(
-                _send_production_email,
-                to_email,
-                user_name or "there",
-                name or "Your",
-                job_id,
-            )
-            print(f"[CP PRODUCE] queued production email to {to_email} for {data.order_reference}")
-        else:
-            print(f"[CP PRODUCE] email skipped (to={to_email!r}) for {data.order_reference}")
+    except Exception:
+        # release the key so CloudPrinter's retry is accepted
+        webhook_dedupe.forget("cloudprinter", key)
+        raise
 
     dt_ms = (time.perf_counter() - t0) * 1000
     print(f"[CP PRODUCE] --> 200 ok ({dt_ms:.1f} ms) ItemProduce {order_ref}")
@@ -3,13 +3,16 @@ import json
 import time
 import hmac
 import os
-import smtplib
 import urllib.parse
 from email.message import EmailMessage
-from fastapi import APIRouter, Request, HTTPException, status, Depends, BackgroundTasks
+from fastapi import APIRouter, Request, HTTPException, status, Depends
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 
+from app.services.email_outbox import queue_email
+from app.services.email_templates import render as render_email
+from app.services.webhook_dedupe import dedupe_key
+
 router = APIRouter()
 security = HTTPBasic(auto_error=False)
 
@@ -88,106 +91,17 @@ def _send_tracking_email(to_email: str,
     else:
         track_url = _tracking_link(shipping_option, tracking)
 
-    track_button_html = (
-        f"""
-        <p style="margin: 20px 0;">
-          <a href="{track_url}"
-             style="background-color:#5784ba; color:#ffffff; text-decoration:none; font-weight:bold;
-                    padding:12px 18px; border-radius:30px; display:inline-block;">
-            Track your order
-          </a>
-        </p>
-        """ if track_url else ""
-    )
+    track_button_html = render_email("tracking_button", track_url=track_url) if track_url else ""
 
     subject = f"Your order from Diffrun {order_ref} has been shipped!"
-    html = f"""
-    <html>
-    <head>
-      <meta charset="UTF-8">
-      <meta name="color-scheme" content="light">
-      <meta name="supported-color-schemes" content="light">
-      <style>
-        @media only screen and (max-width: 480px) {{
-          .container {{
-            width: 100% !important;
-            max-width: 100% !important;
-            padding: 16px !important;
-          }}
-          .col, .img-col {{
-            display: block !important;
-            width: 100% !important;
-          }}
-          .img-col img {{
-            width: 100% !important;
-            height: auto !important;
-          }}
-          .browse-now-btn {{
-            font-size: 14px !important;
-            padding: 12px 16px !important;
-          }}
-          p, li, a {{
-            font-size: 15px !important;
-            line-height: 1.5 !important;
-          }}
-        }}
-      </style>
-    </head>
-    <body style="font-family: Arial, sans-serif; background:#f7f7f7; margin:0; padding:20px;">
-      <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse:collapse;">
-        <tr>
-          <td align="center">
-            <table role="presentation" class="container" width="100%" cellpadding="0" cellspacing="0" border="0"
-                   style="max-width: 48rem; margin: 0 auto; background:#ffffff; border-radius:8px; box-shadow:0 0 10px rgba(0,0,0,0.08); overflow:hidden;">
-              <tr>
-                <td style="padding:24px;">
-                  
-                  <!-- Your original content (unchanged) -->
-                  <p>Hey {display_name},</p>
-                  Order Update! <strong>{child_name}'s storybook</strong> has been printed and is ready to be shipped. 🚚✨
-
-                  <ul>
-                    <li><strong>Order:</strong> {order_ref}</li>
-                    <li><strong>Tracking:</strong> {tracking}</li>
-                  </ul>
-
-                  {track_button_html}
-
-                  <p>Thanks,<br />Team Diffrun</p>
-
-                  <!-- Explore More Row -->
-                  <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0"
-                         style="margin-top: 30px; background-color: #f7f6cf; border-radius: 8px;">
-                    <tr>
-                      <td class="col" style="padding: 20px; vertical-align: middle;">
-                        <p style="font-size: 15px; margin: 0;">
-                          Explore more magical books in our growing collection &nbsp;
-                          <button class="browse-now-btn"
-                                  style="background-color:#5784ba; margin-top: 20px; border-radius: 30px; border: none; padding:10px 15px;">
-                            <a href="https://diffrun.com"
-                               style="color:white; font-weight: bold; text-decoration: none; display:inline-block;">
-                              Browse Now
-                            </a>
-                          </button>
-                        </p>
-                      </td>
-                      <td class="img-col" width="300" style="padding: 0 20px 0 0; margin: 0; vertical-align: middle;">
-                        <img src="https://diffrungenerations.s3.ap-south-1.amazonaws.com/email_image+(2).jpg"
-                             alt="Storybook Preview" width="300"
-                             style="display: block; border-radius: 0; margin: 0; padding: 0;">
-                      </td>
-                    </tr>
-                  </table>
-
-                </td>
-              </tr>
-            </table>
-          </td>
-        </tr>
-      </table>
-    </body>
-    </html>
-    """
+    html = render_email(
+        "tracking",
+        display_name=display_name,
+        child_name=child_name,
+        order_ref=order_ref,
+        tracking=tracking,
+        track_button_html=track_button_html,
+    )
 
     msg = EmailMessage()
     msg["Subject"] = subject
@@ -197,17 +111,78 @@ def _send_tracking_email(to_email: str,
         "Your order has been shipped. View this email in HTML to see the formatted message.")
     msg.add_alternative(html, subtype="html")
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(EMAIL_USER, EMAIL_PASS)
-        smtp.send_message(msg)
-    print(f"[MAIL] sent shipped-email to {to_email} for order {order_ref}")
+    queue_email(msg, kind="tracking")
+    print(f"[MAIL] queued shipped-email to {to_email} for order {order_ref}")
+
+
+def _process_item_shipped(data: ItemShippedPayload, orders_collection) -> None:
+    # 1) Update tracking fields (always) and set print_status to 'shipped'
+    update_fields = {
+        "tracking_code": data.tracking,
+        "shipping_option": data.shipping_option,
+        "shipped_at": data.datetime,
+        "print_status": "shipped",
+    }
+    orders_collection.update_one({"order_id": data.order_reference}, {
+                                 "$set": update_fields})
+
+    # 2) Idempotent email: set shipped_email_sent=True only once; send email iff we flipped it now
+    filter_once = {
+        "order_id": data.order_reference,
+        "$or": [{"shipped_email_sent": {"$exists": False}}, {"shipped_email_sent": False}],
+    }
+    set_once = {"$set": {"shipped_email_sent": True}}
+    once = orders_collection.update_one(filter_once, set_once)
+
+    if once.modified_count == 1:
+        # We "won" the race to send the email → fetch recipient + name
+        order = orders_collection.find_one(
+            {"order_id": data.order_reference},
+            {"customer_email": 1, "email": 1, "user_name": 1, "name": 1, "_id": 0},
+        )
+        to_email = (order.get("customer_email") or order.get("email")
+                    or "").strip() if order else "support@diffrun.com"
+        # to_email = "support@diffrun.com"
+        user_name = (order.get("user_name") if order else None)
+        name = order.get("name") if order else None
+
+        if to_email:
+            # pass the provider-specific template constant (clean, maintainable)
+            try:
+                _send_tracking_email(
+                    to_email,
+                    data.order_reference,
+                    data.shipping_option,
+                    data.tracking,
+                    user_name,
+                    name,
+                    CLOUDPRINTER_TRACKING_URL_TEMPLATE,
+                    None
+                )
+            except Exception as e:
+                # the once-flag is already set; a retry would not resend, so just log
+                print(f"[CP WEBHOOK] shipped-email to {to_email} failed for {data.order_reference}: {e}")
+        else:
+            print(
+                f"[CP WEBHOOK] no customer_email/email in DB for {data.order_reference}; email skipped")
+    else:
+        print(
+            f"[CP WEBHOOK] shipped-email already sent for {data.order_reference}; skipping")
+
+
+def process_item_shipped_event(ev: dict) -> None:
+    """Webhook worker handler for a queued ItemShipped event (raises to retry)."""
+    # Lazy import to avoid circular import with main.py
+    from main import orders_collection
+
+    data = ItemShippedPayload(apikey="", **(ev.get("payload") or {}))
+    _process_item_shipped(data, orders_collection)
 
 
 @router.post("/api/webhook/cloudprinter")
 @router.post("/api/webhook/cloudprinter/")
 async def cloudprinter_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     credentials: HTTPBasicCredentials | None = Depends(security),
 ):
     t0 = time.perf_counter()
@@ -247,66 +222,31 @@ async def cloudprinter_webhook(
     # Validate payload shape
     data = ItemShippedPayload(**payload)
 
-    # ---- DB work + idempotent email
+    # ---- dedupe + durable append; DB work and the email run on the webhook workers
     try:
         # Lazy import to avoid circular import with main.py
-        from main import orders_collection
+        from main import webhook_dedupe, webhook_queue
     except Exception as e:
         print(f"[CP WEBHOOK] DB import error: {e}")
         raise HTTPException(status_code=500, detail="Server misconfiguration")
 
-    # 1) Update tracking fields (always) and set print_status to 'shipped'
-    update_fields = {
-        "tracking_code": data.tracking,
-        "shipping_option": data.shipping_option,
-        "shipped_at": data.datetime,
-        "print_status": "shipped",
-    }
-    orders_collection.update_one({"order_id": data.order_reference}, {
-                                 "$set": update_fields})
-
-    # 2) Idempotent email: set shipped_email_sent=True only once; send email iff we flipped it now
-    filter_once = {
-        "order_id": data.order_reference,
-        "$or": [{"shipped_email_sent": {"$exists": False}}, {"shipped_email_sent": False}],
-    }
-    set_once = {"$set": {"shipped_email_sent": True}}
-    once = orders_collection.update_one(filter_once, set_once)
+    key = dedupe_key(data.type, data.order_reference, data.item_reference,
+                     data.tracking, data.datetime)
+    if webhook_dedupe.seen("cloudprinter", key):
+        print(f"[CP WEBHOOK] duplicate ItemShipped for {order_ref}; ignoring")
+        return {"ok": True, "duplicate": True}
 
-    if once.modified_count == 1:
-        # We "won" the race to send the email → fetch recipient + name
-        order = orders_collection.find_one(
-            {"order_id": data.order_reference},
-            {"customer_email": 1, "email": 1, "user_name": 1, "name": 1, "_id": 0},
+    try:
+        webhook_queue.enqueue(
+            "cloudprinter_shipped",
+            f"order:{data.order_reference}",
+            data.model_dump(exclude={"apikey"}),
+            dedupe_key=key,
         )
-        to_email = (order.get("customer_email") or order.get("email")
-                    or "").strip() if order else "support@diffrun.com"
-        # to_email = "support@diffrun.com"
-        user_name = (order.get("user_name") if order else None)
-        name = order.get("name") if order else None
-
-        if to_email:
-            # queue email in background
-            # pass the provider-specific template constant (clean, maintainable)
-            background_tasks.add_task(
-                _send_tracking_email,
-                to_email,
-                data.order_reference,
-                data.shipping_option,
-                data.tracking,
-                user_name,
-                name,
-                CLOUDPRINTER_TRACKING_URL_TEMPLATE,
-                None
-            )
-            print(
-                f"[CP WEBHOOK] queued shipped-email to {to_email} for {data.order_reference}")
-        else:
-            print(
-                f"[CP WEBHOOK] no customer_email/email in DB for {data.order_reference}; email skipped")
-    else:
-        print(
-            f"[CP WEBHOOK] shipped-email already sent for {data.order_reference}; skipping")
+    except Exception:
+        # release the key so CloudPrinter's retry is accepted
+        webhook_dedupe.forget("cloudprinter", key)
+        raise
 
     dt_ms = (time.perf_counter() - t0) * 1000
     print(f"[CP WEBHOOK] --> 200 ok ({dt_ms:.1f} ms) ItemShipped {order_ref}")
@@ -1,5 +1,6 @@
 # app/routers/razorpay_export.py
 import os, io, csv, re
+import asyncio
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 import httpx
@@ -7,12 +8,16 @@ from fastapi import APIRouter, Query, HTTPException, Body
 from fastapi.responses import StreamingResponse
 from dateutil import parser as dtparser
 from dotenv import load_dotenv
+from pymongo import MongoClient
+
+from app.services.razorpay_ledger import RazorpayLedger
 
 router = APIRouter(prefix="/razorpay", tags=["razorpay"])
 
 load_dotenv()
 
-RZP_BASE = "https://api.razorpay.com/v1"
+# overridable so a local fake Razorpay server can stand in during tests
+RZP_BASE = os.getenv("RAZORPAY_API_BASE", "https://api.razorpay.com/v1").rstrip("/")
 KEY_ID = os.getenv("RAZORPAY_KEY_ID")
 KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
 
@@ -42,13 +47,43 @@ def ts_to_ddmmyyyy_hhmmss(ts: Any) -> str:
     except Exception:
         return ""
 
-async def fetch_payments(
+RZP_FETCH_CONCURRENCY = int(os.getenv("RZP_FETCH_CONCURRENCY", "6"))
+RZP_SHARD_SECONDS = int(os.getenv("RZP_SHARD_SECONDS", str(6 * 3600)))
+RZP_MAX_RETRIES = int(os.getenv("RZP_MAX_RETRIES", "5"))
+
+async def _get_payments_page(client: httpx.AsyncClient, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One /payments page, retrying 429 / 5xx with exponential backoff (honours Retry-After)."""
+    delay = 1.0
+    for attempt in range(RZP_MAX_RETRIES + 1):
+        try:
+            r = await client.get(f"{RZP_BASE}/payments", params=params)
+        except httpx.TransportError:
+            if attempt == RZP_MAX_RETRIES:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+            continue
+        if r.status_code == 429 or r.status_code >= 500:
+            if attempt == RZP_MAX_RETRIES:
+                r.raise_for_status()
+            try:
+                wait = float(r.headers.get("Retry-After") or delay)
+            except ValueError:
+                wait = delay
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, 30.0)
+            continue
+        r.raise_for_status()
+        return r.json().get("items", []) or []
+    return []
+
+async def _fetch_payments_serial(
     client: httpx.AsyncClient,
     *,
     status_filter: Optional[str],
     from_unix: Optional[int],
     to_unix: Optional[int],
-    max_fetch: int = 10000,
+    max_fetch: int,
 ) -> List[Dict[str, Any]]:
     items: List[Dict[str, Any]] = []
     skip = 0
@@ -62,21 +97,109 @@ async def fetch_payments(
         # include UPI/card context where available
         params["expand[]"] = "card"
 
-        r = await client.get(f"{RZP_BASE}/payments", params=params)
-        r.raise_for_status()
-        data = r.json()
-        batch = data.get("items", []) or []
+        page = await _get_payments_page(client, params)
+        batch = page
         if status_filter:
             sf = status_filter.lower()
             batch = [p for p in batch if (p.get("status") or "").lower() == sf]
         items.extend(batch)
 
-        if len(batch) < COUNT or len(items) >= max_fetch:
+        # stop on a short *raw* page; a status filter can shrink full pages
+        if len(page) < COUNT or len(items) >= max_fetch:
             break
         skip += COUNT
 
     return items[:max_fetch]
 
+async def fetch_payments(
+    client: httpx.AsyncClient,
+    *,
+    status_filter: Optional[str],
+    from_unix: Optional[int],
+    to_unix: Optional[int],
+    max_fetch: int = 10000,
+    concurrency: Optional[int] = None,
+    shard_seconds: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Payments created in [from_unix, to_unix], newest first, at most max_fetch.
+    A bounded window is split into time shards that are paged concurrently
+    (at most `concurrency` in flight); results are merged and deduped by id.
+    Without a start bound there is nothing to shard, so it walks pages serially.
+    """
+    if from_unix is None:
+        return await _fetch_payments_serial(
+            client, status_filter=status_filter, from_unix=from_unix,
+            to_unix=to_unix, max_fetch=max_fetch,
+        )
+
+    end = to_unix if to_unix is not None else int(datetime.now().timestamp())
+    step = max(60, shard_seconds or RZP_SHARD_SECONDS)
+    shards = []
+    lo = from_unix
+    while lo <= end:
+        hi = min(end, lo + step - 1)
+        shards.append((lo, hi))
+        lo = hi + 1
+
+    sem = asyncio.Semaphore(max(1, concurrency or RZP_FETCH_CONCURRENCY))
+
+    async def _run(lo_: int, hi_: int) -> List[Dict[str, Any]]:
+        async with sem:
+            return await _fetch_payments_serial(
+                client, status_filter=status_filter, from_unix=lo_,
+                to_unix=hi_, max_fetch=max_fetch,
+            )
+
+    results = await asyncio.gather(*(_run(lo_, hi_) for lo_, hi_ in shards))
+
+    merged: Dict[str, Dict[str, Any]] = {}
+    for batch in results:
+        for p in batch:
+            pid = p.get("id")
+            if pid and pid not in merged:
+                merged[pid] = p
+    items = sorted(merged.values(), key=lambda p: int(p.get("created_at") or 0), reverse=True)
+    return items[:max_fetch]
+
+RZP_BY_ID_CONCURRENCY = int(os.getenv("RZP_BY_ID_CONCURRENCY", "10"))
+
+async def fetch_payments_by_ids(
+    client: httpx.AsyncClient,
+    ids: List[str],
+    concurrency: Optional[int] = None,
+) -> List[tuple]:
+    """
+    GET /payments/{id} for every id concurrently (bounded).
+    Returns [(id, payment | None, error | None), ...] in input order, where error is
+    "not_found", an httpx.HTTPStatusError or an httpx.RequestError.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency or RZP_BY_ID_CONCURRENCY))
+
+    async def _one(pid: str) -> tuple:
+        async with sem:
+            try:
+                r = await client.get(f"{RZP_BASE}/payments/{pid}")
+                if r.status_code == 404:
+                    return pid, None, "not_found"
+                r.raise_for_status()
+                return pid, r.json(), None
+            except (httpx.HTTPStatusError, httpx.RequestError) as e:
+                return pid, None, e
+
+    return list(await asyncio.gather(*(_one(pid) for pid in ids)))
+
+# ---- Local payment ledger (Mongo mirror of Razorpay, synced from a created_at watermark)
+MONGO_URI = os.getenv("MONGO_URI")
+client = MongoClient(MONGO_URI, tz_aware=True)
+db = client["candyman"]
+
+razorpay_ledger = RazorpayLedger(
+    db["razorpay_payments"],
+    db["razorpay_sync_state"],
+    fetch_payments,
+)
+
 @router.get("/payments-csv")
 async def payments_csv(
     status: Optional[str] = Query("captured", description="Filter by status (e.g. captured)"),
@@ -85,7 +208,10 @@ async def payments_csv(
     max_fetch: int = Query(2000, ge=1, le=50000, description="Upper bound to avoid runaway downloads"),
 ) -> StreamingResponse:
     """
-    Fetch Razorpay payments and stream as CSV.
+    Read Razorpay payments from the local ledger (syncing any missing range first) and stream as CSV.
+    status / amount_refunded / refund_status are re-synced for payments created in the last
+    RZP_LEDGER_REFRESH_DAYS days (every RZP_LEDGER_REFRESH_INTERVAL); for older payments they
+    reflect the last time the payment was pulled.
     Keys must be set in backend env: RAZORPAY_KEY_ID / RAZORPAY_KEY_SECRET
     """
     _assert_keys()
@@ -98,7 +224,7 @@ async def payments_csv(
 
     try:
         async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=30.0) as client:
-            payments = await fetch_payments(
+            payments = await razorpay_ledger.payments(
                 client,
                 status_filter=status,
                 from_unix=from_unix,
@@ -244,20 +370,18 @@ async def payments_by_ids(
 
     try:
         async with httpx.AsyncClient(auth=(KEY_ID, KEY_SECRET), timeout=20.0) as client:
-            for pid in uniq_ids:
-                try:
-                    r = await client.get(f"{RZP_BASE}/payments/{pid}")
-                    if r.status_code == 404:
-                        errors.append({"id": pid, "error": "Not found"})
-                        continue
-                    r.raise_for_status()
-                    p = r.json()
-                    items.append(_payment_to_detail(p))
-                except httpx.HTTPStatusError as e:
-                    errors.append({"id": pid, "error": f"http {e.response.status_code}", "detail": e.response.text[:200]})
-                except httpx.RequestError as e:
-                    errors.append({"id": pid, "error": "network", "detail": str(e)})
+            results = await fetch_payments_by_ids(client, uniq_ids)
     except httpx.RequestError as e:
         raise HTTPException(502, detail=f"Network error calling Razorpay: {e}")
 
+    for pid, p, err in results:
+        if err is None:
+            items.append(_payment_to_detail(p))
+        elif err == "not_found":
+            errors.append({"id": pid, "error": "Not found"})
+        elif isinstance(err, httpx.HTTPStatusError):
+            errors.append({"id": pid, "error": f"http {err.response.status_code}", "detail": err.response.text[:200]})
+        else:
+            errors.append({"id": pid, "error": "network", "detail": str(err)})
+
     return {"count": len(items), "items": items, "errors": errors}
\ No newline at end of file
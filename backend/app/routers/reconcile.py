@@ -1,11 +1,13 @@
 # app/routers/reconcile.py
 from fastapi import APIRouter, Query, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Optional, Dict, Any, List, Tuple, Union
 import os
 import httpx
 import re
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateMany
+from pymongo.collation import Collation
 from pymongo.errors import PyMongoError
 from app.routers.razorpay_export import (
     _assert_keys,
@@ -13,6 +15,8 @@ from app.routers.razorpay_export import (
     ts_to_ddmmyyyy_hhmmss,
 )
 import hmac, hashlib
+import base64
+from bson import json_util
 from datetime import timedelta
 from dateutil import parser as dtparser, tz as dttz
 from zoneinfo import ZoneInfo
@@ -22,7 +26,6 @@ import json
 import html
 import logging
 from email.message import EmailMessage
-import smtplib
 
 IST_TZ = ZoneInfo("Asia/Kolkata")
 router = APIRouter(prefix="/reconcile", tags=["reconcile"])
@@ -35,7 +38,16 @@ def norm(s: str | None, *, case_insensitive: bool) -> str:
     return t.lower() if case_insensitive else t
 
 # ---- Razorpay fetcher (reuse your existing code) ----------------------------
-from app.routers.razorpay_export import fetch_payments, _assert_keys
+from app.routers.razorpay_export import (
+    RZP_BASE,
+    fetch_payments_by_ids,
+    _assert_keys,
+    razorpay_ledger,
+)
+from app.services.email_outbox import queue_email
+from app.services.order_reconcile import mark_reconciled_many
+from app.services.run_lease import RunLease
+from app.services.timing import timed
 # ----------------------------------------------------------------------------
 
 # ---- Mongo connection via ENV ----------------------------------------------
@@ -112,12 +124,10 @@ def _send_email_html(
     msg.add_alternative(html_body, subtype="html")
 
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(email_user, email_pass)
-            smtp.sendmail(email_user, recipients, msg.as_string())
-        logger.info(f"[EMAIL] Sent '{subject}' to {', '.join(recipients)}")
+        queue_email(msg, kind="reconcile")
+        logger.info(f"[EMAIL] Queued '{subject}' to {', '.join(recipients)}")
     except Exception as e:
-        logger.exception(f"[EMAIL] Failed to send '{subject}' — {e}")
+        logger.exception(f"[EMAIL] Failed to queue '{subject}' — {e}")
 
 def _render_na_table(title: str, wnd_from: str, wnd_to: str, rows: list[dict]) -> str:
     """Render an HTML table with: Payment ID, Email, Payment Date, Amount, Paid, Preview, Job ID."""
@@ -184,16 +194,29 @@ def _render_na_table(title: str, wnd_from: str, wnd_to: str, rows: list[dict]) -
 
 
 # ------------------------------ KEEP: /orders --------------------------------
-@router.get("/orders")
-def get_orders(
-    sort_by: Optional[str] = Query(None, description="Field to sort by"),
-    sort_dir: Optional[str] = Query("asc", description="asc or desc"),
-    filter_status: Optional[str] = Query(None),
-    filter_book_style: Optional[str] = Query(None),
-    filter_print_approval: Optional[str] = Query(None),
-    filter_discount_code: Optional[str] = Query(None),
-    exclude_discount_code: Optional[str] = None,
-):
+_ORDERS_PROJECTION = {
+    "order_id": 1, "job_id": 1, "cover_url": 1, "book_url": 1, "preview_url": 1,
+    "name": 1, "shipping_address": 1, "created_at": 1, "processed_at": 1,
+    "approved_at": 1, "approved": 1, "book_id": 1, "book_style": 1,
+    "print_status": 1, "price": 1, "total_price": 1, "amount": 1, "total_amount": 1,
+    "feedback_email": 1, "print_approval": 1, "discount_code": 1,
+    "currency": 1, "locale": 1,
+    "_id": 1,  # keyset tiebreaker; not returned
+}
+_ORDERS_STREAM_BATCH = 500
+# keyset cursors compare with $gt/$lt, which only match values of the same BSON
+# type; processed_at / approved_at are stored both as strings and as dates, so
+# paging is limited to fields with a single type
+_KEYSET_SORT_FIELDS = ("created_at", "_id")
+
+
+def _orders_query(
+    filter_status: Optional[str],
+    filter_book_style: Optional[str],
+    filter_print_approval: Optional[str],
+    filter_discount_code: Optional[str],
+    exclude_discount_code: Optional[str],
+) -> Dict[str, Any]:
     # Base query: only show paid orders
     query = {"paid": True}
 
@@ -230,71 +253,187 @@ def get_orders(
         elif "discount_code" not in query:
             query["discount_code"] = {"$ne": exclude_discount_code.upper()}
 
-    # Fetch and sort records
+    return query
+
+
+def _order_row(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "order_id": doc.get("order_id", ""),
+        "job_id": doc.get("job_id", ""),
+        "coverPdf": doc.get("cover_url", ""),
+        "interiorPdf": doc.get("book_url", ""),
+        "previewUrl": doc.get("preview_url", ""),
+        "name": doc.get("name", ""),
+        "city": doc.get("shipping_address", {}).get("city", ""),
+        "price": doc.get("price", doc.get("total_price", doc.get("amount", doc.get("total_amount", 0)))),
+        "paymentDate": doc.get("processed_at", ""),
+        "approvalDate": doc.get("approved_at", ""),
+        "status": "Approved" if doc.get("approved") else "Uploaded",
+        "bookId": doc.get("book_id", ""),
+        "bookStyle": doc.get("book_style", ""),
+        "printStatus": doc.get("print_status", ""),
+        "feedback_email": doc.get("feedback_email", False),
+        "print_approval": doc.get("print_approval", None),
+        "discount_code": doc.get("discount_code", ""),
+        "currency": doc.get("currency", ""),
+        "locale": doc.get("locale", ""),
+    }
+
+
+def _projection_for(sort_field: str) -> Dict[str, Any]:
+    # the cursor needs the sort value, even when it is not a returned column
+    if sort_field.split(".", 1)[0] in _ORDERS_PROJECTION:
+        return _ORDERS_PROJECTION
+    return {**_ORDERS_PROJECTION, sort_field: 1}
+
+
+def _sort_value(doc: Dict[str, Any], sort_field: str) -> Any:
+    value: Any = doc
+    for part in sort_field.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def _encode_cursor(doc: Dict[str, Any], sort_field: str) -> str:
+    raw = json_util.dumps({"v": _sort_value(doc, sort_field), "id": doc["_id"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _after_cursor(cursor: str, sort_field: str, sort_order: int) -> Dict[str, Any]:
+    """
+    Filter for rows strictly after `cursor` in (sort_field, _id) order; sort_field
+    is one of _KEYSET_SORT_FIELDS. Mongo sorts null/missing first ascending and
+    last descending.
+    """
+    try:
+        decoded = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        value, last_id = decoded["v"], decoded["id"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    op = "$gt" if sort_order == 1 else "$lt"
+    same_value_after = {sort_field: value, "_id": {op: last_id}}
+    if value is None:
+        if sort_order == 1:
+            return {"$or": [same_value_after, {sort_field: {"$ne": None}}]}
+        return same_value_after
+    branches = [{sort_field: {op: value}}, same_value_after]
+    if sort_order == -1:
+        branches.append({sort_field: None})
+    return {"$or": branches}
+
+
+@router.get("/orders")
+def get_orders(
+    sort_by: Optional[str] = Query(None, description="Field to sort by"),
+    sort_dir: Optional[str] = Query("asc", description="asc or desc"),
+    filter_status: Optional[str] = Query(None),
+    filter_book_style: Optional[str] = Query(None),
+    filter_print_approval: Optional[str] = Query(None),
+    filter_discount_code: Optional[str] = Query(None),
+    exclude_discount_code: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size; enables keyset paging"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    stream: bool = Query(False, description="Stream every matching row as NDJSON"),
+):
+    """
+    Paid orders for the reconcile view.
+      - default: the full list (as before);
+      - limit[/cursor]: {"orders": [...], "next_cursor": str | None}, keyset-paged on
+        (sort field, _id); sort_by must be created_at or _id;
+      - stream=true: application/x-ndjson, one row per line, read in batches.
+    """
+    query = _orders_query(filter_status, filter_book_style, filter_print_approval,
+                          filter_discount_code, exclude_discount_code)
+
     sort_field = sort_by if sort_by else "created_at"
     sort_order = 1 if sort_dir == "asc" else -1
+    sort_spec = [(sort_field, sort_order), ("_id", sort_order)]
+    projection = _projection_for(sort_field)
 
-    projection = {
-        "order_id": 1, "job_id": 1, "cover_url": 1, "book_url": 1, "preview_url": 1,
-        "name": 1, "shipping_address": 1, "created_at": 1, "processed_at": 1,
-        "approved_at": 1, "approved": 1, "book_id": 1, "book_style": 1,
-        "print_status": 1, "price": 1, "total_price": 1, "amount": 1, "total_amount": 1,
-        "feedback_email": 1, "print_approval": 1, "discount_code": 1,
-        "currency": 1, "locale": 1, "_id": 0,
-    }
+    if (cursor or (limit is not None and not stream)) and sort_field not in _KEYSET_SORT_FIELDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Paging (limit/cursor) supports sort_by in {list(_KEYSET_SORT_FIELDS)}",
+        )
+
+    if cursor:
+        query = {"$and": [query, _after_cursor(cursor, sort_field, sort_order)]}
+
+    if stream:
+        def _lines():
+            cur = orders_collection.find(query, projection).sort(sort_spec)
+            if limit:
+                cur = cur.limit(limit)
+            for doc in cur.batch_size(_ORDERS_STREAM_BATCH):
+                yield json.dumps(jsonable_encoder(_order_row(doc))) + "\n"
+
+        return StreamingResponse(_lines(), media_type="application/x-ndjson")
 
-    records = list(orders_collection.find(query, projection).sort(sort_field, sort_order))
-    result = []
-    for doc in records:
-        result.append({
-            "order_id": doc.get("order_id", ""),
-            "job_id": doc.get("job_id", ""),
-            "coverPdf": doc.get("cover_url", ""),
-            "interiorPdf": doc.get("book_url", ""),
-            "previewUrl": doc.get("preview_url", ""),
-            "name": doc.get("name", ""),
-            "city": doc.get("shipping_address", {}).get("city", ""),
-            "price": doc.get("price", doc.get("total_price", doc.get("amount", doc.get("total_amount", 0)))),
-            "paymentDate": doc.get("processed_at", ""),
-            "approvalDate": doc.get("approved_at", ""),
-            "status": "Approved" if doc.get("approved") else "Uploaded",
-            "bookId": doc.get("book_id", ""),
-            "bookStyle": doc.get("book_style", ""),
-            "printStatus": doc.get("print_status", ""),
-            "feedback_email": doc.get("feedback_email", False),
-            "print_approval": doc.get("print_approval", None),
-            "discount_code": doc.get("discount_code", ""),
-            "currency": doc.get("currency", ""),
-            "locale": doc.get("locale", ""),
-        })
-    return result
+    if limit is None and not cursor:
+        return [_order_row(doc) for doc in orders_collection.find(query, projection).sort(sort_spec)]
+
+    page_size = limit or 100
+    docs = list(orders_collection.find(query, projection).sort(sort_spec).limit(page_size + 1))
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    return {
+        "orders": [_order_row(doc) for doc in docs],
+        "next_cursor": _encode_cursor(docs[-1], sort_field) if has_more else None,
+    }
 # ----------------------------------------------------------------------------
 
-async def _vlookup_core(
-    *,
-    status,
-    max_fetch,
-    from_date,
-    to_date,
-    case_insensitive_ids,
-    orders_batch_size,
-    na_status,
-):
-    resp = await vlookup_payment_to_orders_auto(
-        status=status,
-        max_fetch=max_fetch,
-        from_date=from_date,
-        to_date=to_date,
-        case_insensitive_ids=case_insensitive_ids,
-        orders_batch_size=orders_batch_size,
-        na_status=na_status,
-    )
-    logger.info(f"Response data: {resp.body}")
-    if isinstance(resp, JSONResponse):
-        # JSONResponse.body is bytes → decode to dict
-        return json.loads(resp.body.decode("utf-8"))
-    return resp  # already a dict
+# ---- auto-reconcile worker -------------------------------------------------
+AUTO_RECONCILE_CONCURRENCY = int(os.getenv("AUTO_RECONCILE_CONCURRENCY", "8"))
+AUTO_RECONCILE_LEASE_SECONDS = int(os.getenv("AUTO_RECONCILE_LEASE_SECONDS", "900"))
+_auto_reconcile_lease = RunLease(db["job_leases"], "auto_reconcile", AUTO_RECONCILE_LEASE_SECONDS)
 
+# ---- payment id -> order matching ------------------------------------------
+_TX_IN_CHUNK = 5_000
+# case-insensitive equality on transaction_id without a second stored field
+_TX_CI_COLLATION = Collation(locale="en", strength=2)
+_tx_indexes_ready = False
+
+def _ensure_tx_indexes() -> None:
+    global _tx_indexes_ready
+    if _tx_indexes_ready:
+        return
+    try:
+        orders_collection.create_index("transaction_id", name="transaction_id_1")
+        orders_collection.create_index(
+            "transaction_id", name="transaction_id_ci", collation=_TX_CI_COLLATION)
+        _tx_indexes_ready = True
+    except PyMongoError:
+        logger.exception("[VLOOKUP] transaction_id index creation failed")
+
+def _match_payment_ids_to_orders(
+    payment_ids: List[str],
+    case_insensitive: bool,
+    chunk_size: int = _TX_IN_CHUNK,
+) -> Tuple[set, int]:
+    """
+    Return (matched normalized keys, order docs seen) for payment_ids that appear as
+    some order's transaction_id. With case_insensitive the query runs under a
+    strength-2 collation, served by the transaction_id_ci index.
+    """
+    _ensure_tx_indexes()
+    wanted = {norm(pid, case_insensitive=case_insensitive) for pid in payment_ids}
+    matched: set = set()
+    docs = 0
+    for i in range(0, len(payment_ids), chunk_size):
+        part = payment_ids[i:i + chunk_size]
+        cur = orders_collection.find(
+            {"transaction_id": {"$in": part}},
+            {"_id": 0, "transaction_id": 1},
+        )
+        if case_insensitive:
+            cur = cur.collation(_TX_CI_COLLATION)
+        for doc in cur:
+            docs += 1
+            key = norm(str(doc.get("transaction_id") or ""), case_insensitive=case_insensitive)
+            if key in wanted:
+                matched.add(key)
+    return matched, docs
 
 @router.get("/vlookup-payment-to-orders/auto")
 async def vlookup_payment_to_orders_auto(
@@ -305,12 +444,38 @@ async def vlookup_payment_to_orders_auto(
     to_date:   Optional[str] = Query(None, description="YYYY-MM-DD / ISO; omit for ALL time"),
     case_insensitive_ids: bool = Query(False, description="Lowercase both sides before matching"),
 
-    # Orders paging (scan *all* orders)
+    # Upper bound for one $in chunk of payment ids (capped at _TX_IN_CHUNK)
     orders_batch_size: int = Query(50_000, ge=1_000, le=200_000, description="Mongo batch size"),
 
     # IMPORTANT: default to only NA with status=captured
     na_status: Optional[str] = Query("captured", description="Only include NA payments with this Razorpay status"),
 ):
+    return JSONResponse(await vlookup_na_payments(
+        status=status,
+        max_fetch=max_fetch,
+        from_date=from_date,
+        to_date=to_date,
+        case_insensitive_ids=case_insensitive_ids,
+        orders_batch_size=orders_batch_size,
+        na_status=na_status,
+    ))
+
+
+@timed("reconcile.vlookup_na_payments")
+async def vlookup_na_payments(
+    *,
+    status: Optional[str] = None,
+    max_fetch: int = 200_000,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    case_insensitive_ids: bool = False,
+    orders_batch_size: int = 50_000,
+    na_status: Optional[str] = "captured",
+) -> Dict[str, Any]:
+    """
+    Payments in the window that no order references (NA), filtered by na_status.
+    Called in-process by the route above, the auto-reconcile job and the hourly email.
+    """
     _assert_keys()
 
     def _to_unix(s: Optional[str]) -> Optional[int]:
@@ -321,14 +486,15 @@ async def vlookup_payment_to_orders_auto(
     
     from_unix = _to_unix_start(from_date)
     to_unix   = _to_unix_end(to_date)
-    # 1) Razorpay: fetch ALL (status=None => all statuses)
+    # 1) Payments: ALL statuses (status=None) from the synced ledger
     try:
         async with httpx.AsyncClient(
             auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET")),
             timeout=60.0
         ) as client:
-            payments: List[Dict[str, Any]] = await fetch_payments(
-                client=client,
+            # local ledger: only the not-yet-synced range is pulled from Razorpay
+            payments: List[Dict[str, Any]] = await razorpay_ledger.payments(
+                client,
                 status_filter=status,   # None => all
                 from_unix=from_unix,
                 to_unix=to_unix,
@@ -350,43 +516,19 @@ async def vlookup_payment_to_orders_auto(
         pay_index[key] = {"id": raw_id, "status": st}
 
     payment_keys = set(pay_index.keys())
-    matched_keys: set[str] = set()
-
-    # 2) Scan ALL orders by _id (Atlas-safe)
-    total_orders_docs = 0
-    orders_with_tx = 0
-    last_id = None
 
+    # 2) Look the payment ids up in orders (indexed $in on transaction_id, chunked),
+    #    so cost follows the payments in the window rather than total orders
     try:
-        while True:
-            q: Dict[str, Any] = {}
-            if last_id is not None:
-                q["_id"] = {"$gt": last_id}
-
-            batch = list(
-                orders_collection.find(q, projection={"transaction_id": 1, "order_id": 1})
-                                 .sort([("_id", 1)])
-                                 .limit(orders_batch_size)
-            )
-            if not batch:
-                break
-
-            total_orders_docs += len(batch)
-
-            for doc in batch:
-                raw_tx = doc.get("transaction_id")
-                if not raw_tx:
-                    continue
-                tx_key = norm(str(raw_tx), case_insensitive=case_insensitive_ids)
-                if not tx_key:
-                    continue
-                orders_with_tx += 1
-                if tx_key in payment_keys:
-                    matched_keys.add(tx_key)
-
-            last_id = batch[-1]["_id"]
+        matched_keys, orders_with_tx = await asyncio.to_thread(
+            _match_payment_ids_to_orders,
+            [rec["id"] for rec in pay_index.values()],
+            case_insensitive_ids,
+            min(orders_batch_size, _TX_IN_CHUNK),
+        )
     except PyMongoError as e:
         raise HTTPException(status_code=502, detail=f"Mongo query failed: {e}")
+    total_orders_docs = orders_with_tx
 
     # 3) NA keys (in payments but not matched to any order)
     na_keys = payment_keys - matched_keys
@@ -411,7 +553,7 @@ async def vlookup_payment_to_orders_auto(
 
     matched_distinct = len(matched_keys)
     logger.info(f"na items {na_items}")
-    return JSONResponse({
+    return {
         "summary": {
             "total_orders_docs_scanned": total_orders_docs,
             "orders_with_transaction_id": orders_with_tx,
@@ -432,7 +574,7 @@ async def vlookup_payment_to_orders_auto(
         # Only the chosen status (default captured)
         "na_payment_ids": [x["id"] for x in na_items],
         "na_by_status": na_by_status,  # contains only the chosen status
-    })
+    }
 
 def _extract_uuid(s: str | None) -> str | None:
     if not isinstance(s, str) or not s:
@@ -484,6 +626,23 @@ def _extract_preview_url_from_notes(notes: dict) -> str:
 
 
 async def _auto_reconcile_and_sign_once() -> None:
+    """
+    Scheduler entry point: run one auto-reconcile pass under the run lease, so a
+    trigger that fires while a previous pass (in this or another worker) is still
+    going is skipped instead of double-verifying the same payments.
+    """
+    lease = _auto_reconcile_lease
+    token = await asyncio.to_thread(lease.acquire)
+    if token is None:
+        logger.info("[AUTO] Previous run still holds the lease; skipping this trigger.")
+        return
+    try:
+        await _auto_reconcile_run()
+    finally:
+        await asyncio.to_thread(lease.release, token)
+
+
+async def _auto_reconcile_run() -> None:
     """
     Auto-verify ALL eligible payments found in the last window, every run.
 
@@ -495,9 +654,11 @@ async def _auto_reconcile_and_sign_once() -> None:
       - Compute pricing using BOOK_PRICING + DISCOUNT_PCT (numbers, not strings)
       - POST /verify-razorpay
       - On success: mark in user_details and persist numeric pricing fields
+    Payments are fetched and verified concurrently (AUTO_RECONCILE_CONCURRENCY),
+    order docs are prefetched with one $in query and DB updates go out as one bulk_write.
     Never breaks on failure; continues to next payment_id.
     """
-    import os, json, re, httpx
+    import os, re, httpx
     from decimal import Decimal, ROUND_HALF_UP
     from datetime import datetime, timedelta, timezone
     try:
@@ -608,7 +769,7 @@ async def _auto_reconcile_and_sign_once() -> None:
     to_iso = window_end.isoformat(timespec="seconds")
 
     # ---------- discover NA captured payments ----------
-    payload = await _vlookup_core(
+    payload = await vlookup_na_payments(
         status=None,
         max_fetch=200_000,
         from_date=from_iso,
@@ -617,8 +778,6 @@ async def _auto_reconcile_and_sign_once() -> None:
         orders_batch_size=50_000,
         na_status="captured",
     )
-    if isinstance(payload, (bytes, bytearray)):
-        payload = json.loads(payload.decode("utf-8"))
 
     na_ids = payload.get("na_payment_ids", []) or []
     if not na_ids:
@@ -633,25 +792,51 @@ async def _auto_reconcile_and_sign_once() -> None:
     if not key_id or not key_secret:
         raise RuntimeError("RAZORPAY_KEY_ID / RAZORPAY_KEY_SECRET must be set")
 
-    # Use your internal base; change default if needed
-    API_BASE = os.getenv("BACKEND_INTERNAL_BASE", "https://admin.diffrun.com").rstrip("/")
+    rows_by_id: dict[str, dict] = {}
+    sem = asyncio.Semaphore(AUTO_RECONCILE_CONCURRENCY)
+    network_down = asyncio.Event()  # first network failure stops new work (no partial storms)
 
-    rows_for_email: list[dict] = []
+    def _error_row(payment_id: str) -> dict:
+        return {
+            "id": payment_id, "email": "—", "created_at": "—",
+            "amount_display": "—", "paid": False, "preview_url": "—", "job_id": "—",
+        }
 
-    # ---------- process ALL candidates (no break on failures) ----------
     async with httpx.AsyncClient(timeout=30.0) as client, \
                httpx.AsyncClient(auth=(key_id, key_secret), timeout=20.0) as rz:
 
+        # ---------- 1) fetch all Razorpay payments concurrently ----------
+        async def _fetch_pay(payment_id: str) -> tuple[str, dict | None]:
+            if network_down.is_set():
+                return payment_id, None
+            async with sem:
+                try:
+                    r = await rz.get(f"{RZP_BASE}/payments/{payment_id}")
+                    if r.status_code == 404:
+                        logger.warning(f"[AUTO] Payment {payment_id} not found at Razorpay; skipping.")
+                        return payment_id, None
+                    r.raise_for_status()
+                    return payment_id, r.json()
+                except httpx.HTTPStatusError as e:
+                    logger.warning(f"[AUTO] HTTPStatusError for {payment_id}: {e}")
+                    rows_by_id[payment_id] = _error_row(payment_id)
+                except httpx.RequestError as e:
+                    logger.warning(f"[AUTO] RequestError (network) for {payment_id}: {e}")
+                    network_down.set()
+                return payment_id, None
+
+        pays: dict[str, dict] = {
+            pid: pay for pid, pay in await asyncio.gather(*(_fetch_pay(p) for p in candidate_ids))
+            if pay is not None
+        }
+
+        # ---------- 2) build rows, extract job_ids, prefetch order docs in one $in ----------
+        work: list[tuple[str, dict, dict, str]] = []  # (payment_id, pay, base_row, job_id)
         for payment_id in candidate_ids:
+            pay = pays.get(payment_id)
+            if pay is None:
+                continue
             try:
-                # 1) Fetch Razorpay payment
-                r = await rz.get(f"https://api.razorpay.com/v1/payments/{payment_id}")
-                if r.status_code == 404:
-                    logger.warning(f"[AUTO] Payment {payment_id} not found at Razorpay; skipping.")
-                    continue
-                r.raise_for_status()
-                pay = r.json()
-
                 order_id = (pay.get("order_id") or "").strip()
                 if not order_id:
                     logger.warning(f"[AUTO] Payment {payment_id} missing order_id; skipping.")
@@ -668,84 +853,91 @@ async def _auto_reconcile_and_sign_once() -> None:
                     "preview_url": _extract_preview_url_from_notes(notes),
                     "job_id": "",   # fill after extraction
                 }
-
-
-                # 2) Signature (same as /sign-razorpay)
-                signature = _make_razorpay_signature(order_id, payment_id)
-                logger.info(f"[AUTO] Signature generated for {payment_id}")
-
-                # 3) Pull meta from Razorpay
-                
                 job_id = _extract_job_id_from_payment(pay)
                 base_row["job_id"] = job_id or "—"
+                rows_by_id[payment_id] = base_row
                 if not job_id:
                     logger.info(f"[AUTO] No job_id in Razorpay payload for {payment_id}; skipping.")
-                    rows_for_email.append(base_row)
                     continue
+                work.append((payment_id, pay, base_row, job_id))
+            except Exception as e:
+                logger.exception(f"[AUTO] Unexpected error for {payment_id}: {e}")
+                rows_by_id[payment_id] = _error_row(payment_id)
 
-                doc = orders_collection.find_one(
-                    {"job_id": job_id},
-                    {"book_id": 1, "book_style": 1},
-                )
-                book_id = (doc or {}).get("book_id") or ""
-                book_style = (doc or {}).get("book_style") or ""
-
-
-                # 4) Pricing (numbers only)
-                # actual_price from BOOK_PRICING, else fallback to paid amount from Razorpay
-                resolved = _resolve_book_pricing_numbers(book_id, book_style)
-                print(f"Resolved pricing for book_id={book_id}, book_style={book_style}: {resolved}")
-                paid_amount = _inr_from_paise_to_number(pay.get("amount"))  # number
-                if resolved is None:
-                    actual_price, shipping, taxes = paid_amount, 0.0, 0.0
-                else:
-                    actual_price, shipping, taxes = resolved
-
-                discount_code = (_note_str(notes, "discount_code", "DiscountCode", "DISCOUNT_CODE") or "").upper()   
-                discount_percentage = float(DISCOUNT_PCT.get(discount_code, 0.0))  # number
-                # discount_amount = round2((discountPct / 100) * actualPrice)
-                discount_amount = float(_round2_d(Decimal(discount_percentage) / Decimal(100) * Decimal(str(actual_price))))
-                final_amount = float(_round2_d(Decimal(str(actual_price)) - Decimal(str(discount_amount)) + Decimal(str(shipping)) + Decimal(str(taxes))))
-                
-                # 5) /verify-razorpay (send numeric types)
-                verify_payload = {
-                    "razorpay_order_id": order_id,
-                    "razorpay_payment_id": payment_id,
-                    "razorpay_signature": signature,
-                    "job_id": job_id,
-                    "actual_price": actual_price,
-                    "discount_code": discount_code,
-                    "discount_percentage": discount_percentage,
-                    "discount_amount": discount_amount,
-                    "final_amount": final_amount,
-                    "shipping_price": shipping,
-                    "taxes": taxes,
-                    "book_id": book_id or None,
-                    "book_style": book_style or None,
-                }
-                vr = await client.post(f"https://test-backend.diffrun.com/verify-razorpay", json=verify_payload)
-
-                vjson = None
+        job_ids = sorted({job_id for _, _, _, job_id in work})
+        docs_by_job: dict[str, dict] = {}
+        if job_ids:
+            try:
+                for doc in orders_collection.find(
+                    {"job_id": {"$in": job_ids}},
+                    {"_id": 0, "job_id": 1, "book_id": 1, "book_style": 1},
+                ):
+                    docs_by_job.setdefault(doc.get("job_id"), doc)
+            except PyMongoError:
+                logger.exception("[AUTO] order prefetch failed; pricing falls back to paid amount")
+
+        # ---------- 3) sign + price + /verify-razorpay concurrently ----------
+        async def _verify(payment_id: str, pay: dict, base_row: dict, job_id: str) -> dict | None:
+            if network_down.is_set():
+                return None
+            async with sem:
                 try:
-                    vjson = vr.json()
-                except Exception:
-                    pass
-
-                if not (vr.is_success and isinstance(vjson, dict) and vjson.get("success")):
-                    logger.warning(f"[AUTO] Verify failed for {payment_id}; status={vr.status_code}, body={vjson}")
-                    rows_for_email.append(base_row)   # paid stays False
-                    continue
-
-                # 6) Reconcile flag + pricing fields in DB (only when verify succeeded)
-                now_utc = datetime.now(timezone.utc)
-
-                # NOTE: if your real handle is different, replace `user_details` below.
-                orders_collection.update_many(
-                    {"transaction_id": payment_id},
-                    {"$set": {
-                        "reconcile": True,
-                        "reconciled_at": now_utc,
-                        # Persist the same numeric fields for backoffice/reporting
+                    order_id = (pay.get("order_id") or "").strip()
+                    notes = pay.get("notes") or {}
+
+                    # Signature (same as /sign-razorpay)
+                    signature = _make_razorpay_signature(order_id, payment_id)
+                    logger.info(f"[AUTO] Signature generated for {payment_id}")
+
+                    doc = docs_by_job.get(job_id)
+                    book_id = (doc or {}).get("book_id") or ""
+                    book_style = (doc or {}).get("book_style") or ""
+
+                    # Pricing (numbers only)
+                    # actual_price from BOOK_PRICING, else fallback to paid amount from Razorpay
+                    resolved = _resolve_book_pricing_numbers(book_id, book_style)
+                    logger.info(f"[AUTO] Resolved pricing for book_id={book_id}, book_style={book_style}: {resolved}")
+                    paid_amount = _inr_from_paise_to_number(pay.get("amount"))  # number
+                    if resolved is None:
+                        actual_price, shipping, taxes = paid_amount, 0.0, 0.0
+                    else:
+                        actual_price, shipping, taxes = resolved
+
+                    discount_code = (_note_str(notes, "discount_code", "DiscountCode", "DISCOUNT_CODE") or "").upper()
+                    discount_percentage = float(DISCOUNT_PCT.get(discount_code, 0.0))  # number
+                    # discount_amount = round2((discountPct / 100) * actualPrice)
+                    discount_amount = float(_round2_d(Decimal(discount_percentage) / Decimal(100) * Decimal(str(actual_price))))
+                    final_amount = float(_round2_d(Decimal(str(actual_price)) - Decimal(str(discount_amount)) + Decimal(str(shipping)) + Decimal(str(taxes))))
+
+                    # /verify-razorpay (send numeric types)
+                    verify_payload = {
+                        "razorpay_order_id": order_id,
+                        "razorpay_payment_id": payment_id,
+                        "razorpay_signature": signature,
+                        "job_id": job_id,
+                        "actual_price": actual_price,
+                        "discount_code": discount_code,
+                        "discount_percentage": discount_percentage,
+                        "discount_amount": discount_amount,
+                        "final_amount": final_amount,
+                        "shipping_price": shipping,
+                        "taxes": taxes,
+                        "book_id": book_id or None,
+                        "book_style": book_style or None,
+                    }
+                    vr = await client.post(f"https://test-backend.diffrun.com/verify-razorpay", json=verify_payload)
+
+                    vjson = None
+                    try:
+                        vjson = vr.json()
+                    except Exception:
+                        pass
+
+                    if not (vr.is_success and isinstance(vjson, dict) and vjson.get("success")):
+                        logger.warning(f"[AUTO] Verify failed for {payment_id}; status={vr.status_code}, body={vjson}")
+                        return None   # paid stays False
+
+                    return {
                         "actual_price": actual_price,
                         "discount_code": discount_code,
                         "discount_percentage": discount_percentage,
@@ -753,42 +945,54 @@ async def _auto_reconcile_and_sign_once() -> None:
                         "final_amount": final_amount,
                         "shipping_price": shipping,
                         "taxes": taxes,
-                    }},
-                )
-                logger.info(f"[AUTO] Reconciled {payment_id} and updated pricing fields in user_details.")
+                    }
+                except httpx.HTTPStatusError as e:
+                    logger.warning(f"[AUTO] HTTPStatusError for {payment_id}: {e}")
+                    rows_by_id[payment_id] = _error_row(payment_id)
+                except httpx.RequestError as e:
+                    logger.warning(f"[AUTO] RequestError (network) for {payment_id}: {e}")
+                    network_down.set()
+                except Exception as e:
+                    logger.exception(f"[AUTO] Unexpected error for {payment_id}: {e}")
+                    rows_by_id[payment_id] = _error_row(payment_id)
+                return None
+
+        verify_results = await asyncio.gather(*(_verify(*w) for w in work))
+
+        # ---------- 4) reconcile flag + pricing fields, one bulk_write ----------
+        now_utc = datetime.now(timezone.utc)
+        ops = []
+        succeeded: list[tuple[str, str]] = []  # (payment_id, job_id)
+        for (payment_id, _pay, base_row, job_id), pricing in zip(work, verify_results):
+            if pricing is None:
+                continue
+            ops.append(UpdateMany(
+                {"transaction_id": payment_id},
+                {"$set": {"reconcile": True, "reconciled_at": now_utc, **pricing}},
+            ))
+            succeeded.append((payment_id, job_id))
 
-                # mark this row as success
-                success_row = dict(base_row)
-                success_row["paid"] = True
-                rows_for_email.append(success_row)
+        if ops:
+            try:
+                orders_collection.bulk_write(ops, ordered=False)
+                for payment_id, _ in succeeded:
+                    rows_by_id[payment_id] = dict(rows_by_id[payment_id], paid=True)
+                logger.info(f"[AUTO] Reconciled {len(ops)} payments and updated pricing fields in user_details.")
+            except PyMongoError:
+                logger.exception("[AUTO] bulk reconcile update failed")
+                succeeded = []
+
+        # ---------- 5) Mark reconciled (best-effort, same service as /reconcile/mark) ----------
+        if succeeded:
+            try:
+                await asyncio.to_thread(mark_reconciled_many, orders_collection, succeeded)
+            except Exception:
+                logger.exception("[AUTO] mark reconciled failed")
 
+    if network_down.is_set():
+        logger.warning("[AUTO] Network errors talking to Razorpay/verify; remaining payments left for the next run.")
 
-                # 7) Optional /reconcile/mark (best-effort)
-                try:
-                    mark_payload = {"job_id": job_id, "razorpay_payment_id": payment_id}
-                    await client.post(f"{API_BASE}/reconcile/mark", json=mark_payload)
-                except Exception:
-                    pass
-
-            except httpx.HTTPStatusError as e:
-                logger.warning(f"[AUTO] HTTPStatusError for {payment_id}: {e}")
-                rows_for_email.append({
-                    "id": payment_id, "email": "—", "created_at": "—",
-                    "amount_display": "—", "paid": False, "preview_url": "—", "job_id": "—",
-                })
-                continue
-            except httpx.RequestError as e:
-                logger.warning(f"[AUTO] RequestError (network) for {payment_id}: {e}")
-                # network is unhealthy; stop the run to avoid partial storms
-                break
-            except Exception as e:
-                logger.exception(f"[AUTO] Unexpected error for {payment_id}: {e}")
-                rows_for_email.append({
-                    "id": payment_id, "email": "—", "created_at": "—",
-                    "amount_display": "—", "paid": False, "preview_url": "—", "job_id": "—",
-                })
-                # keep going to the next payment_id
-                continue
+    rows_for_email: list[dict] = [rows_by_id[pid] for pid in candidate_ids if pid in rows_by_id]
     try:
         if rows_for_email:
             verified = sum(1 for r in rows_for_email if r.get("paid") is True)
@@ -802,21 +1006,52 @@ async def _auto_reconcile_and_sign_once() -> None:
         logger.exception("[AUTO] Failed to render/send auto-reconcile email")
 
 
-def _lookup_paid_preview_by_job(job_id: Optional[str]) -> Tuple[Optional[bool], Optional[str]]:
-    if not job_id:
+def _paid_preview(doc: Optional[Dict[str, Any]]) -> Tuple[Optional[bool], Optional[str]]:
+    if not doc:
         return (None, None)
+    paid = bool(doc.get("paid")) if "paid" in doc else None
+    preview_url = doc.get("preview_url") if isinstance(doc.get("preview_url"), str) else None
+    return (paid, preview_url)
+
+def _resolve_order_docs(payments: List[Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """
+    Batch the DB side of _project_row: one $in on transaction_id for all payment ids,
+    then one $in on job_id for payments that did not resolve by transaction id.
+    Returns (docs_by_transaction_id, docs_by_job_id); first doc wins, like find_one.
+    """
+    proj = {"_id": 0, "transaction_id": 1, "job_id": 1, "paid": 1, "preview_url": 1}
+    by_tx: Dict[str, Dict[str, Any]] = {}
+    by_job: Dict[str, Dict[str, Any]] = {}
+
+    pids = [p.get("id") for p in payments if p.get("id")]
     try:
-        doc = orders_collection.find_one({"job_id": job_id}, {"paid": 1, "preview_url": 1})
-        if not doc:
-            return (None, None)
-        paid = bool(doc.get("paid")) if "paid" in doc else None
-        preview_url = doc.get("preview_url") if isinstance(doc.get("preview_url"), str) else None
-        return (paid, preview_url)
+        for i in range(0, len(pids), _TX_IN_CHUNK):
+            for doc in orders_collection.find({"transaction_id": {"$in": pids[i:i + _TX_IN_CHUNK]}}, proj):
+                by_tx.setdefault(doc.get("transaction_id"), doc)
     except Exception:
-        return (None, None)
+        logger.exception("[NA-DETAILS] transaction_id lookup failed")
 
-def _project_row(payment: Dict[str, Any]) -> Dict[str, Any]:
-    """Combine Razorpay fields + DB (job_id, paid, preview_url)."""
+    guesses = set()
+    for p in payments:
+        if (by_tx.get(p.get("id")) or {}).get("job_id"):
+            continue
+        jid = _extract_job_id_from_payment(p)
+        if jid:
+            guesses.add(jid)
+    if guesses:
+        try:
+            for doc in orders_collection.find({"job_id": {"$in": sorted(guesses)}}, proj):
+                by_job.setdefault(doc.get("job_id"), doc)
+        except Exception:
+            logger.exception("[NA-DETAILS] job_id lookup failed")
+    return by_tx, by_job
+
+def _project_row(
+    payment: Dict[str, Any],
+    docs_by_tx: Dict[str, Dict[str, Any]],
+    docs_by_job: Dict[str, Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Combine Razorpay fields + DB (job_id, paid, preview_url) from pre-resolved docs."""
     upi = payment.get("upi") or {}
     acq = payment.get("acquirer_data") or {}
     vpa = payment.get("vpa") or upi.get("vpa") or ""
@@ -827,20 +1062,16 @@ def _project_row(payment: Dict[str, Any]) -> Dict[str, Any]:
     # Primary: transaction_id == payment_id mapping in your user_details
     job_id_db = None
     paid, preview_url = (None, None)
-    try:
-        doc_tx = orders_collection.find_one({"transaction_id": pid}, {"job_id": 1, "paid": 1, "preview_url": 1})
-        if doc_tx:
-            job_id_db = doc_tx.get("job_id")
-            paid = bool(doc_tx.get("paid")) if "paid" in doc_tx else None
-            preview_url = doc_tx.get("preview_url") if isinstance(doc_tx.get("preview_url"), str) else None
-    except Exception:
-        pass
+    doc_tx = docs_by_tx.get(pid)
+    if doc_tx:
+        job_id_db = doc_tx.get("job_id")
+        paid, preview_url = _paid_preview(doc_tx)
 
     # Fallback: extract UUID job_id from Razorpay payload then lookup by job_id
     if not job_id_db:
         job_id_guess = _extract_job_id_from_payment(payment)
         if job_id_guess:
-            paid, preview_url = _lookup_paid_preview_by_job(job_id_guess)
+            paid, preview_url = _paid_preview(docs_by_job.get(job_id_guess))
             job_id_db = job_id_guess
 
     return {
@@ -871,11 +1102,15 @@ async def na_payment_details(body: Dict[str, Any]) -> Dict[str, Any]:
     Body: {"ids": ["pay_ABC...", ...]}
     Returns Razorpay details + DB-enriched (job_id, paid, preview_url) for each ID.
     """
-    _assert_keys()
-
     ids = body.get("ids")
     if not isinstance(ids, list) or not ids:
         raise HTTPException(400, detail="Body must contain 'ids' as a non-empty list of strings")
+    return await na_payment_details_for(ids)
+
+
+@timed("reconcile.na_payment_details_for")
+async def na_payment_details_for(ids: List[Any]) -> Dict[str, Any]:
+    _assert_keys()
 
     uniq_ids = list(dict.fromkeys([str(x).strip() for x in ids if str(x).strip()]))
     if len(uniq_ids) > 2000:
@@ -889,22 +1124,25 @@ async def na_payment_details(body: Dict[str, Any]) -> Dict[str, Any]:
             auth=(os.getenv("RAZORPAY_KEY_ID"), os.getenv("RAZORPAY_KEY_SECRET")),
             timeout=20.0
         ) as client:
-            for pid in uniq_ids:
-                try:
-                    r = await client.get(f"https://api.razorpay.com/v1/payments/{pid}")
-                    if r.status_code == 404:
-                        errors.append({"id": pid, "error": "not_found"})
-                        continue
-                    r.raise_for_status()
-                    p = r.json()
-                    items.append(_project_row(p))
-                except httpx.HTTPStatusError as e:
-                    errors.append({"id": pid, "error": f"http_{e.response.status_code}", "detail": (e.response.text or "")[:200]})
-                except httpx.RequestError as e:
-                    errors.append({"id": pid, "error": "network", "detail": str(e)})
+            results = await fetch_payments_by_ids(client, uniq_ids)
     except httpx.RequestError as e:
         raise HTTPException(502, detail=f"Network error calling Razorpay: {e}")
 
+    payments: List[Dict[str, Any]] = []
+    for pid, p, err in results:
+        if err is None:
+            payments.append(p)
+        elif err == "not_found":
+            errors.append({"id": pid, "error": "not_found"})
+        elif isinstance(err, httpx.HTTPStatusError):
+            errors.append({"id": pid, "error": f"http_{err.response.status_code}", "detail": (err.response.text or "")[:200]})
+        else:
+            errors.append({"id": pid, "error": "network", "detail": str(err)})
+
+    # Two $in queries for the whole batch instead of up to two find_one per payment
+    docs_by_tx, docs_by_job = await asyncio.to_thread(_resolve_order_docs, payments)
+    items = [_project_row(p, docs_by_tx, docs_by_job) for p in payments]
+
     return {"count": len(items), "items": items, "errors": errors}
 
 def _make_razorpay_signature(order_id: str, payment_id: str) -> str:
@@ -932,8 +1170,8 @@ async def email_report(
     na_status: Optional[str] = Query("captured"),     # same default as UI
     max_fetch: int = Query(200_000, ge=1, le=1_000_000),
 ):
-    # 1) Call the same core logic via the existing route (or refactor into a shared function)
-    data = await vlookup_payment_to_orders_auto(
+    # 1) Same core logic the UI route uses
+    payload = await vlookup_na_payments(
         status=status,
         max_fetch=max_fetch,
         from_date=from_date,
@@ -942,9 +1180,8 @@ async def email_report(
         orders_batch_size=50_000,
         na_status=na_status,
     )
-    logger.info(f"data: {data}")
+    logger.info(f"data: {payload}")
     # 2) Build your email from the returned 'summary' and 'na_payment_ids'
-    payload = data.body if isinstance(data, JSONResponse) else data  # FastAPI returns JSONResponse
     summary = payload["summary"]
     na_ids  = payload["na_payment_ids"]  # <- EXACTLY the same list UI uses
 
@@ -2,17 +2,18 @@
 import os
 import logging
 from datetime import datetime, timezone
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 from .cloudprinter_webhook import _send_tracking_email
-import requests
 
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv(), override=False)
 
-from fastapi import APIRouter, Request, Response, BackgroundTasks
+from fastapi import APIRouter, Request, Response
 from pydantic import BaseModel, Field, ConfigDict
 from pymongo import MongoClient
 
+from app.services.tracking_store import TrackingEventStore
+
 router = APIRouter()
 
 EXPECTED_TOKEN = (os.getenv("SHIPROCKET_WEBHOOK_TOKEN") or "").strip()
@@ -21,6 +22,7 @@ client = MongoClient(MONGO_URI, tz_aware=True)
 db = client["candyman"]
 orders_collection = db["shipping_details"]
 users_collection = db["user_details"]   
+tracking_events = TrackingEventStore(db)
 
 class Scan(BaseModel):
     model_config = ConfigDict(extra="allow")
@@ -70,36 +72,74 @@ def _dedupe_key(ev: ShiprocketEvent) -> str:
     import hashlib
     return hashlib.sha256(base.encode()).hexdigest()
 
-_seen: set[str] = set()
+def _scan_key(scan: dict) -> tuple:
+    # webhook scans and polled shipment_track_activities differ in shape and in
+    # extra fields, but agree on these
+    sr_status = scan.get("sr-status")
+    return scan.get("date"), None if sr_status is None else str(sr_status), scan.get("activity")
+
+def _scan_key_expr(var: str) -> list:
+    """_scan_key as an aggregation expression over the scan in `var` (e.g. "$$s")."""
+    return [
+        {"$ifNull": [f"{var}.date", None]},
+        {"$convert": {"input": f"{var}.sr-status", "to": "string", "onError": None, "onNull": None}},
+        {"$ifNull": [f"{var}.activity", None]},
+    ]
+
+def _unique_scans(scans: List[dict]) -> List[dict]:
+    """Scans deduped on _scan_key, oldest first (readers take scans[-1] as the latest)."""
+    out: Dict[tuple, dict] = {}
+    for s in scans:
+        out.setdefault(_scan_key(s), s)
+    return sorted(out.values(), key=lambda s: _parse_ts(s.get("date")) or "")
 
 def _upsert_tracking(e: ShiprocketEvent, raw: dict) -> None:
+    # raw payload goes to tracking_events; the shipping doc keeps a compact summary
+    tracking_events.record("shiprocket", raw, order_id=e.order_id, awb=e.awb)
+
     q = {"order_id": e.order_id} if e.order_id else {"awb_code": e.awb}
-    update = {
-        "$set": {
-            "shiprocket_data": {
-                "awb": e.awb,
-                "courier_name": e.courier_name,
-                "current_status": e.current_status,
-                "current_status_id": e.current_status_id,
-                "shipment_status": e.shipment_status,
-                "shipment_status_id": e.shipment_status_id,
-                "current_timestamp_iso": _parse_ts(e.current_timestamp),
-                "current_timestamp_raw": e.current_timestamp,
-                "sr_order_id": e.sr_order_id,
-                "pod_status": e.pod_status,
-                "pod": e.pod,
-                "last_update_utc": datetime.now(timezone.utc),
-                "scans": [s.model_dump(by_alias=True) for s in (e.scans or [])],
-                "raw": raw,
-            },
-            "tracking_number": e.awb or raw.get("tracking") or "",
-            "courier_partner": e.courier_name or "",
-            "delivery_status": "shipped" if (e.current_status or "").upper() in {"DELIVERED", "RTO DELIVERED"} else None,
-        }
+    scans = [s.model_dump(by_alias=True) for s in (e.scans or [])]
+    summary = {
+        "awb": e.awb,
+        "courier_name": e.courier_name,
+        "current_status": e.current_status,
+        "current_status_id": e.current_status_id,
+        "shipment_status": e.shipment_status,
+        "shipment_status_id": e.shipment_status_id,
+        "current_timestamp_iso": _parse_ts(e.current_timestamp),
+        "current_timestamp_raw": e.current_timestamp,
+        "sr_order_id": e.sr_order_id,
+        "pod_status": e.pod_status,
+        "pod": e.pod,
+        "last_update_utc": datetime.now(timezone.utc),
     }
-    if update["$set"]["delivery_status"] is None:
-        update["$set"].pop("delivery_status", None)
-    orders_collection.update_one(q, update, upsert=False)
+    top_level = {
+        "tracking_number": e.awb or raw.get("tracking") or "",
+        "courier_partner": e.courier_name or "",
+    }
+    if (e.current_status or "").upper() in {"DELIVERED", "RTO DELIVERED"}:
+        top_level["delivery_status"] = "shipped"
+
+    # each payload repeats the whole history; only unseen scans are appended
+    existing_scans = {"$ifNull": ["$shiprocket_data.scans", []]}
+    seen_keys = {"$map": {"input": existing_scans, "as": "e", "in": _scan_key_expr("$$e")}}
+    unseen = {"$filter": {
+        "input": {"$literal": _unique_scans(scans)},
+        "as": "s",
+        "cond": {"$not": [{"$in": [_scan_key_expr("$$s"), seen_keys]}]},
+    }}
+    orders_collection.update_one(q, [
+        # a null/scalar shiprocket_data would make the dotted writes below fail
+        {"$set": {"shiprocket_data": {"$cond": [
+            {"$eq": [{"$type": "$shiprocket_data"}, "object"]}, "$shiprocket_data", {}]}}},
+        {"$set": {
+            **{f"shiprocket_data.{k}": {"$literal": v} for k, v in summary.items()},
+            "shiprocket_data.scans": {"$concatArrays": [existing_scans, unseen]},
+            **{k: {"$literal": v} for k, v in top_level.items()},
+        }},
+        # older docs carried a full copy of every payload here
+        {"$unset": "shiprocket_data.raw"},
+    ], upsert=False)
 
     try:
         if e.order_id:
@@ -117,6 +157,26 @@ def _upsert_tracking(e: ShiprocketEvent, raw: dict) -> None:
         logging.exception(f"[SR WH] Failed to sync to user_details for order {e.order_id}: {sync_exc}")
 
 
+def _note_delivery(e: ShiprocketEvent) -> None:
+    """On DELIVERED, mark the customer's feedback email as due (customer_contacts)."""
+    if not e.order_id:
+        return
+    try:
+        order = users_collection.find_one(
+            {"order_id": e.order_id},
+            {"email": 1, "job_id": 1, "processed_at": 1, "feedback_email_sent": 1, "feedback_email": 1, "_id": 0},
+        )
+        if not order or order.get("feedback_email_sent") or order.get("feedback_email"):
+            return
+        from main import customer_contacts
+        customer_contacts.note_delivery(
+            order.get("email"), order.get("job_id"), e.order_id,
+            order.get("processed_at"), _parse_ts(e.current_timestamp),
+        )
+    except Exception as exc:
+        logging.exception(f"[SR WH] Failed to mark feedback due for order {e.order_id}: {exc}")
+
+
 def _latest_scan(scans: List[dict]) -> Optional[dict]:
     """Return the most recent scan object from scans.
     Attempts to use 'date' when possible; falls back to last element.
@@ -159,9 +219,107 @@ def _latest_scan(scans: List[dict]) -> Optional[dict]:
         return None
 
 
+def process_shiprocket_event(ev: dict) -> None:
+    """Webhook worker handler: apply one queued Shiprocket tracking event (raises to retry)."""
+    raw = ev.get("payload") or {}
+    event = ShiprocketEvent.model_validate(raw)
+
+    # persist tracking payload into DB
+    _upsert_tracking(event, raw)
+    if "DELIVERED" in {(event.current_status or "").upper(), (event.shipment_status or "").upper()}:
+        _note_delivery(event)
+
+    # best-effort: request a courier/charges refresh; bursts of scans for one order
+    # coalesce into a single debounced /shiprocket/order/show sync
+    try:
+        internal_id = event.order_id  # same order_id you stored in DB
+        if internal_id:
+            from main import order_show_refresher
+            order_show_refresher.request(internal_id)
+    except Exception as exc:
+        logging.exception(f"[SR WH] Failed to request order details refresh for {event.order_id}: {exc}")
+
+    # -------------------------
+    # NEW: trigger shipped email only when latest scan shows pickup
+    # -------------------------
+    query_base = {"order_id": event.order_id} if event.order_id else {"awb_code": event.awb}
+    # fetch the updated document after our upsert (only what the pickup check needs)
+    order_doc = orders_collection.find_one(
+        query_base, {"shiprocket_data.scans": 1, "tracking_number": 1, "_id": 0}) or {}
+
+    shiprocket_data = order_doc.get("shiprocket_data") or {}
+    scans = shiprocket_data.get("scans") or []
+
+    latest = _latest_scan(scans)
+    activity = (latest.get("activity") if latest else None) or ""
+    activity_norm = activity.strip().lower()
+
+    # Consider pickup detected only when activity exactly equals 'pickup done'
+    is_pickup = False
+    if activity_norm:
+        if activity_norm == "pickup done" or activity_norm == "picked up":
+            is_pickup = True
+
+    if not is_pickup:
+        logging.info("[SR WH] Pickup not detected in latest scan for %s (activity=%r). Skipping shipped email.", query_base, activity)
+        return
+
+    # require a tracking number to include in email CTA
+    tracking = (order_doc.get("tracking_number") or event.awb or raw.get("tracking") or "").strip()
+    if not tracking:
+        logging.info("[SR WH] Pickup detected but no tracking number present for %s. Skipping shipped email.", query_base)
+        return
+
+    # idempotent flag specifically for pickup-triggered emails
+    filter_once = {
+        **query_base,
+        "$or": [
+            {"shiprocket_pickup_done_email_sent": {"$exists": False}},
+            {"shiprocket_pickup_done_email_sent": False},
+        ],
+    }
+    set_once = {"$set": {"shiprocket_pickup_done_email_sent": True}}
+    once = orders_collection.update_one(filter_once, set_once, upsert=False)
+    if once.modified_count == 1:
+        doc = orders_collection.find_one(
+            query_base,
+            {"email": 1, "user_name": 1, "child_name": 1, "order_id": 1, "tracking_number": 1, "_id": 0},
+        ) or {}
+        to_email = (doc.get("email") or "").strip()
+        if to_email:
+            order_ref = (doc.get("order_id") or event.order_id or "").strip()
+            shipping_option = "shiprocket"
+            # use the tracking we resolved above
+            user_name = doc.get("user_name")
+            name = doc.get("child_name")
+            try:
+                _send_tracking_email(
+                    to_email,
+                    order_ref,
+                    shipping_option,
+                    tracking,
+                    user_name,
+                    name,
+                    SHIPROCKET_TRACKING_URL_TEMPLATE,
+                    None
+                )
+                logging.info(f"[SR WH] sent pickup-shipped-email to {to_email} for {order_ref}")
+            except Exception as exc:
+                # the once-flag is already set; a retry would not resend, so just log
+                logging.exception(f"[SR WH] pickup-shipped-email to {to_email} failed: {exc}")
+        else:
+            logging.info("[SR WH] pickup-shipped-email: no recipient email for %s", query_base)
+    else:
+        logging.info("[SR WH] pickup-shipped-email already sent earlier for %s", query_base)
+
+
 @router.post("/api/webhook/Genesis")
 @router.post("/api/webhook/Genesis/")
-async def shiprocket_tracking(request: Request, background: BackgroundTasks) -> Response:
+async def shiprocket_tracking(request: Request) -> Response:
+    # Lazy import to avoid circular import with main.py
+    from main import webhook_dedupe, webhook_queue
+
+    key = None
     try:
         if EXPECTED_TOKEN:
             token = request.headers.get("x-api-key")
@@ -178,98 +336,17 @@ async def shiprocket_tracking(request: Request, background: BackgroundTasks) ->
         event = ShiprocketEvent.model_validate(raw)
 
         key = _dedupe_key(event)
-        if key in _seen:
-            return Response(status_code=200)
-        _seen.add(key)
-
-        # persist tracking payload into DB
-        _upsert_tracking(event, raw)
-
-        # best-effort: trigger internal page update
-        try:
-            internal_id = event.order_id  # same order_id you stored in DB
-            if internal_id:
-                base_url = os.getenv("NEXT_PUBLIC_API_BASE_URL")
-                requests.get(
-                    f"{base_url}/shiprocket/order/show",
-                    params={"internal_order_id": internal_id},
-                    timeout=10
-                )
-                logging.info(f"[SR WH] Triggered /shiprocket/order/show for {internal_id}")
-        except Exception as exc:
-            logging.exception(f"[SR WH] Failed to trigger order/show for {event.order_id}: {exc}")
-
-        # -------------------------
-        # NEW: trigger shipped email only when latest scan shows pickup
-        # -------------------------
-        query_base = {"order_id": event.order_id} if event.order_id else {"awb_code": event.awb}
-        # fetch the updated document after our upsert
-        order_doc = orders_collection.find_one(query_base) or {}
-
-        shiprocket_data = order_doc.get("shiprocket_data") or {}
-        scans = shiprocket_data.get("scans") or []
-
-        latest = _latest_scan(scans)
-        activity = (latest.get("activity") if latest else None) or ""
-        activity_norm = activity.strip().lower()
-
-        # Consider pickup detected only when activity exactly equals 'pickup done'
-        is_pickup = False
-        if activity_norm:
-            if activity_norm == "pickup done" or activity_norm == "picked up":
-                is_pickup = True
-
-        if not is_pickup:
-            logging.info("[SR WH] Pickup not detected in latest scan for %s (activity=%r). Skipping shipped email.", query_base, activity)
-            return Response(status_code=200)
-
-        # require a tracking number to include in email CTA
-        tracking = (order_doc.get("tracking_number") or event.awb or raw.get("tracking") or "").strip()
-        if not tracking:
-            logging.info("[SR WH] Pickup detected but no tracking number present for %s. Skipping shipped email.", query_base)
+        if webhook_dedupe.seen("shiprocket", key):
+            logging.info(f"[SR WH] duplicate event for {event.order_id or event.awb}; ignoring")
             return Response(status_code=200)
 
-        # idempotent flag specifically for pickup-triggered emails
-        filter_once = {
-            **query_base,
-            "$or": [
-                {"shiprocket_pickup_done_email_sent": {"$exists": False}},
-                {"shiprocket_pickup_done_email_sent": False},
-            ],
-        }
-        set_once = {"$set": {"shiprocket_pickup_done_email_sent": True}}
-        once = orders_collection.update_one(filter_once, set_once, upsert=False)
-        if once.modified_count == 1:
-            doc = orders_collection.find_one(
-                query_base,
-                {"email": 1, "user_name": 1, "child_name": 1, "order_id": 1, "tracking_number": 1, "_id": 0},
-            ) or {}
-            to_email = (doc.get("email") or "").strip()
-            if to_email:
-                order_ref = (doc.get("order_id") or event.order_id or "").strip()
-                shipping_option = "shiprocket"
-                # use the tracking we resolved above
-                user_name = doc.get("user_name")
-                name = doc.get("child_name")
-                background.add_task(
-                    _send_tracking_email,
-                    to_email,
-                    order_ref,
-                    shipping_option,
-                    tracking,
-                    user_name,
-                    name,
-                    SHIPROCKET_TRACKING_URL_TEMPLATE,
-                    None
-                )
-                logging.info(f"[SR WH] queued pickup-shipped-email to {to_email} for {order_ref}")
-            else:
-                logging.info("[SR WH] pickup-shipped-email: no recipient email for %s", query_base)
-        else:
-            logging.info("[SR WH] pickup-shipped-email already sent earlier for %s", query_base)
-
+        # ack fast: store the raw event, the webhook workers apply it in order per order_id
+        order_key = f"order:{event.order_id}" if event.order_id else (f"awb:{event.awb}" if event.awb else None)
+        webhook_queue.enqueue("shiprocket", order_key, raw, dedupe_key=key)
         return Response(status_code=200)
     except Exception as exc:
         logging.exception(f"[SR WH] error: {exc}")
+        if key:
+            # let a redelivery of this event be accepted again
+            webhook_dedupe.forget("shiprocket", key)
         return Response(status_code=200)
-    
\ No newline at end of file
@@ -0,0 +1,266 @@
+# app/services/customer_contacts.py
+#
+# Per-customer contact state, one doc per normalized email (_id).
+# Feedback selection used to distinct() every email that had ever received a
+# feedback mail, feed that ever-growing list back as $nin, and $lookup
+# shipping_details for every remaining order; each send then re-checked
+# {"email": ..., "feedback_email_sent": True} without an index. Now:
+#   - a DELIVERED tracking event marks the customer's feedback as due;
+#   - the cron reads due, unsent contacts with one indexed find;
+#   - "already sent?" is an _id lookup.
+# Production and nudge sends are stamped here too, so every customer-facing
+# email has one place to look.
+# feedback.sent_at is set when the mail is queued (so it is never queued twice);
+# if the outbox parks it as failed, feedback_failed() clears it and makes the
+# customer due again, up to FEEDBACK_MAX_RETRIES times.
+#
+#   {_id: "a@b.com",
+#    feedback:   {due_at, job_id, order_id, delivery_days, sent_at, failures, last_failed_at},
+#    nudge:      {last_sent_at, last_job_id, stage, count},
+#    production: {last_sent_at, last_job_id, count},
+#    updated_at}
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+IST = ZoneInfo("Asia/Kolkata")
+FEEDBACK_MAX_DELIVERY_DAYS = 8
+FEEDBACK_MAX_RETRIES = 3
+FEEDBACK_RETRY_DELAY = timedelta(hours=24)
+_BACKFILL_MARKER = "__backfill__:feedback"
+
+
+def normalize_email(email: Optional[str]) -> str:
+    return (email or "").strip().lower()
+
+
+def _to_utc(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value.strip():
+        try:
+            dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    return None
+
+
+def delivery_days(processed_at: Any, delivered_at: Any) -> Optional[int]:
+    """IST calendar days from processing to delivery (same as $dateDiff unit=day, tz=IST)."""
+    p, d = _to_utc(processed_at), _to_utc(delivered_at)
+    if p is None or d is None:
+        return None
+    return (d.astimezone(IST).date() - p.astimezone(IST).date()).days
+
+
+def _sent_update(channel: str, job_id: Optional[str], now: datetime, fields: Dict[str, Any]) -> Dict[str, Any]:
+    update: Dict[str, Any] = {"$set": {"updated_at": now, **{f"{channel}.{k}": v for k, v in fields.items()}}}
+    if channel == "feedback":
+        update["$set"].update({"feedback.sent_at": now, "feedback.job_id": job_id})
+        update["$unset"] = {"feedback.due_at": ""}
+    else:
+        update["$set"].update({f"{channel}.last_sent_at": now, f"{channel}.last_job_id": job_id})
+        update["$inc"] = {f"{channel}.count": 1}
+    return update
+
+
+class CustomerContacts:
+    def __init__(self, collection: Collection):
+        self._coll = collection
+        self._indexes_ready = False
+        self._backfilled = False
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index(
+                [("feedback.due_at", ASCENDING)],
+                name="feedback_due",
+                partialFilterExpression={"feedback.due_at": {"$exists": True}},
+            )
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[CONTACTS] create_index failed; continuing without it")
+
+    # ---- reads ----
+    def get(self, email: str) -> Optional[Dict[str, Any]]:
+        key = normalize_email(email)
+        return self._coll.find_one({"_id": key}) if key else None
+
+    def feedback_sent(self, email: str) -> bool:
+        key = normalize_email(email)
+        if not key:
+            return False
+        return self._coll.find_one(
+            {"_id": key, "feedback.sent_at": {"$exists": True}}, {"_id": 1}) is not None
+
+    def feedback_due(self, limit: int = 200) -> List[Dict[str, Any]]:
+        """Customers whose feedback mail is due and not sent, oldest first."""
+        self._ensure_indexes()
+        cur = self._coll.find(
+            {"feedback.due_at": {"$lte": datetime.now(timezone.utc)},
+             "feedback.sent_at": {"$exists": False}},
+            {"feedback": 1},
+        ).sort("feedback.due_at", ASCENDING).limit(int(limit))
+        return [
+            {"email": d["_id"], "job_id": d["feedback"].get("job_id"),
+             "order_id": d["feedback"].get("order_id"),
+             "processing_to_delivery_days": d["feedback"].get("delivery_days")}
+            for d in cur
+        ]
+
+    def feedback_sent_count(self) -> int:
+        return self._coll.count_documents({"feedback.sent_at": {"$exists": True}})
+
+    # ---- writes ----
+    def note_delivery(
+        self,
+        email: str,
+        job_id: Optional[str],
+        order_id: Optional[str],
+        processed_at: Any,
+        delivered_at: Any,
+    ) -> bool:
+        """
+        Mark feedback due for a delivered order (0..8 IST days after processing). Returns
+        True if marked. A customer whose mail already failed is left to feedback_failed()'s
+        schedule: repeated DELIVERED events must not pull a retry forward or lift the cap.
+        """
+        key = normalize_email(email)
+        days = delivery_days(processed_at, delivered_at)
+        if not key or not job_id or days is None or not 0 <= days <= FEEDBACK_MAX_DELIVERY_DAYS:
+            return False
+        now = datetime.now(timezone.utc)
+        try:
+            self._coll.update_one(
+                {"_id": key,
+                 "feedback.sent_at": {"$exists": False},
+                 "feedback.last_failed_at": {"$exists": False},
+                 "feedback.failures": {"$not": {"$gt": FEEDBACK_MAX_RETRIES}},
+                 "$or": [{"feedback.due_at": {"$exists": False}}, {"feedback.due_at": {"$lte": now}}]},
+                {"$set": {
+                    "feedback.due_at": now,
+                    "feedback.job_id": job_id,
+                    "feedback.order_id": order_id,
+                    "feedback.delivery_days": days,
+                    "updated_at": now,
+                }},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False  # already sent, failed earlier, or due later for this customer
+        return True
+
+    def clear_feedback_due(self, email: str) -> None:
+        key = normalize_email(email)
+        if key:
+            self._coll.update_one({"_id": key}, {"$unset": {"feedback.due_at": ""}})
+
+    def feedback_failed(self, email: str, job_id: Optional[str]) -> bool:
+        """
+        A queued feedback mail was parked as failed: drop the sent stamp and, unless it
+        already failed FEEDBACK_MAX_RETRIES times, make it due again after a delay.
+        Returns True if it was re-marked as due.
+        """
+        key = normalize_email(email)
+        if not key:
+            return False
+        now = datetime.now(timezone.utc)
+        doc = self._coll.find_one_and_update(
+            {"_id": key, "feedback.sent_at": {"$exists": True}, "feedback.job_id": job_id},
+            {"$unset": {"feedback.sent_at": ""},
+             "$inc": {"feedback.failures": 1},
+             "$set": {"feedback.last_failed_at": now, "updated_at": now}},
+            projection={"feedback.failures": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc is None:
+            return False
+        if int((doc.get("feedback") or {}).get("failures") or 0) > FEEDBACK_MAX_RETRIES:
+            logger.warning("[CONTACTS] feedback to %s failed %d times; not retrying", key, FEEDBACK_MAX_RETRIES + 1)
+            return False
+        self._coll.update_one({"_id": key}, {"$set": {"feedback.due_at": now + FEEDBACK_RETRY_DELAY}})
+        return True
+
+    def record_sent(self, email: str, channel: str, job_id: Optional[str] = None, **fields: Any) -> None:
+        """Stamp a sent email of `channel` ("feedback" | "nudge" | "production")."""
+        key = normalize_email(email)
+        if key:
+            self._coll.update_one({"_id": key}, _sent_update(channel, job_id, datetime.now(timezone.utc), fields),
+                                  upsert=True)
+
+    def record_sent_many(self, channel: str, sends: Iterable[Tuple[str, Optional[str], Dict[str, Any]]]) -> None:
+        """Bulk form of record_sent: `sends` holds (email, job_id, extra_fields) tuples."""
+        now = datetime.now(timezone.utc)
+        ops = [
+            UpdateOne({"_id": normalize_email(email)}, _sent_update(channel, job_id, now, fields), upsert=True)
+            for email, job_id, fields in sends if normalize_email(email)
+        ]
+        if ops:
+            self._coll.bulk_write(ops, ordered=False)
+
+    # ---- one-time seed from the order flags ----
+    def ensure_backfilled(self, orders: Collection) -> None:
+        """
+        Seed contacts from user_details once per deployment: feedback.sent_at for every
+        email already flagged, and feedback.due_* for delivered orders still owed one
+        (the old selection pipeline, run a final time). Both run server-side via $merge.
+        """
+        if self._backfilled:
+            return
+        if self._coll.find_one({"_id": _BACKFILL_MARKER}, {"_id": 1}):
+            self._backfilled = True
+            return
+        self._ensure_indexes()
+        norm = {"$toLower": {"$trim": {"input": "$email"}}}
+        orders.aggregate([
+            {"$match": {"email": {"$exists": True, "$ne": ""},
+                        "$or": [{"feedback_email_sent": True}, {"feedback_email": True}]}},
+            {"$group": {"_id": norm}},
+            {"$project": {"feedback": {"sent_at": "$$NOW", "source": "backfill"}, "updated_at": "$$NOW"}},
+            {"$merge": {"into": self._coll.name, "on": "_id",
+                        "whenMatched": "merge", "whenNotMatched": "insert"}},
+        ])
+        orders.aggregate([
+            {"$match": {"email": {"$exists": True, "$ne": ""},
+                        "feedback_email_sent": {"$ne": True},
+                        "feedback_email": {"$ne": True},
+                        "job_id": {"$exists": True, "$nin": [None, ""]},
+                        "processed_at": {"$exists": True, "$ne": None}}},
+            {"$project": {"email": 1, "job_id": 1, "order_id": 1, "processed_at": 1}},
+            {"$lookup": {"from": "shipping_details", "localField": "order_id",
+                         "foreignField": "order_id", "as": "ship"}},
+            {"$unwind": "$ship"},
+            {"$match": {"$or": [{"ship.shiprocket_data.current_status": "DELIVERED"},
+                                {"ship.shiprocket_data.shipment_status": "DELIVERED"}],
+                        "ship.shiprocket_data.current_timestamp_iso": {"$exists": True, "$ne": None}}},
+            {"$addFields": {"days": {"$dateDiff": {
+                "startDate": {"$toDate": "$processed_at"},
+                "endDate": {"$toDate": "$ship.shiprocket_data.current_timestamp_iso"},
+                "unit": "day", "timezone": "Asia/Kolkata"}}}},
+            {"$match": {"days": {"$gte": 0, "$lte": FEEDBACK_MAX_DELIVERY_DAYS}}},
+            {"$group": {"_id": norm, "job_id": {"$first": "$job_id"},
+                        "order_id": {"$first": "$order_id"}, "days": {"$first": "$days"}}},
+            {"$project": {"feedback": {"due_at": "$$NOW", "job_id": "$job_id",
+                                       "order_id": "$order_id", "delivery_days": "$days"},
+                          "updated_at": "$$NOW"}},
+            # customers seeded as already sent keep their doc untouched
+            {"$merge": {"into": self._coll.name, "on": "_id",
+                        "whenMatched": "keepExisting", "whenNotMatched": "insert"}},
+        ], allowDiskUse=True)
+        self._coll.update_one(
+            {"_id": _BACKFILL_MARKER},
+            {"$set": {"done_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        self._backfilled = True
+        logger.info("[CONTACTS] feedback backfill complete")
@@ -0,0 +1,190 @@
+# app/services/ec2_status.py
+#
+# In-memory EC2 fleet status for the export sheets.
+# A scheduler job calls refresh() on a short interval; exports read the last
+# snapshot via rows() without touching AWS. Instance IDs that AWS reports as
+# InvalidInstanceID.NotFound are remembered and left out of later calls
+# (re-probed occasionally), so one stale ID no longer costs a retry per call.
+import logging
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+_INSTANCE_ID_RE = re.compile(r"i-[0-9a-f]+")
+
+
+class Ec2StatusProvider:
+    """
+    rows() -> (rows, err) with the schema the export code expects:
+      OnOff (1/0), Name, InstanceId, State, Type, AZ, PrivateIP, PublicIP, LaunchTime,
+      InstanceStatus, SystemStatus
+    `client_factory` returns an EC2 client; it is called once and the client reused,
+    which also makes it easy to pass a botocore Stubber / moto client in offline runs.
+    """
+
+    def __init__(
+        self,
+        instance_ids: Sequence[str],
+        client_factory: Callable[[], Any],
+        missing_recheck_seconds: float = 3600.0,
+        stale_after_seconds: float = 600.0,
+    ):
+        # keep order, drop duplicates
+        self._instance_ids = list(dict.fromkeys(i for i in instance_ids if i))
+        self._client_factory = client_factory
+        self._client = None
+        self._missing_recheck = missing_recheck_seconds
+        self._stale_after = stale_after_seconds
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._rows: List[dict] = []
+        self._err: Optional[str] = None
+        self._fetched_at: Optional[float] = None
+        self._missing: Set[str] = set()
+        self._missing_checked_at: Optional[float] = None
+
+    # ---- AWS ----
+    def _ec2(self):
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    def _describe(self, ids: List[str]) -> Tuple[List[dict], Set[str]]:
+        """describe_instances for `ids`, dropping NotFound IDs. Returns (instances, missing)."""
+        ec2 = self._ec2()
+        instances: List[dict] = []
+        missing: Set[str] = set()
+        for i in range(0, len(ids), 100):
+            to_query = list(ids[i:i + 100])
+            while to_query:
+                try:
+                    resp = ec2.describe_instances(InstanceIds=to_query)
+                except ClientError as e:
+                    if e.response.get("Error", {}).get("Code") != "InvalidInstanceID.NotFound":
+                        raise
+                    msg = e.response.get("Error", {}).get("Message", "")
+                    bad = set(_INSTANCE_ID_RE.findall(msg))
+                    if not bad:
+                        logger.warning("EC2: could not parse missing IDs from: %s", msg)
+                        break
+                    missing |= bad
+                    to_query = [x for x in to_query if x not in bad]
+                    continue
+                for r in resp.get("Reservations", []):
+                    instances.extend(r.get("Instances", []) or [])
+                break
+        return instances, missing
+
+    def _status_map(self, ids: List[str]) -> Dict[str, Tuple[str, str]]:
+        ec2 = self._ec2()
+        out: Dict[str, Tuple[str, str]] = {}
+        for i in range(0, len(ids), 100):
+            chunk = ids[i:i + 100]
+            try:
+                resp = ec2.describe_instance_status(InstanceIds=chunk, IncludeAllInstances=True)
+            except ClientError as e:
+                logger.warning("describe_instance_status failed for %s: %s", chunk, e)
+                continue
+            for st in resp.get("InstanceStatuses", []):
+                out[st.get("InstanceId", "")] = (
+                    (st.get("InstanceStatus", {}) or {}).get("Status") or "not-applicable",
+                    (st.get("SystemStatus", {}) or {}).get("Status") or "not-applicable",
+                )
+        return out
+
+    @staticmethod
+    def _row(inst: dict, statuses: Dict[str, Tuple[str, str]]) -> dict:
+        iid = inst.get("InstanceId", "")
+        state = (inst.get("State", {}) or {}).get("Name", "")
+        name = ""
+        for t in inst.get("Tags", []) or []:
+            if t.get("Key") == "Name":
+                name = t.get("Value", "")
+                break
+        inst_status, sys_status = statuses.get(iid, ("not-applicable", "not-applicable"))
+        return {
+            "OnOff": 1 if state == "running" else 0,
+            "Name": name,
+            "InstanceId": iid,
+            "State": state,
+            "Type": inst.get("InstanceType", ""),
+            "AZ": (inst.get("Placement", {}) or {}).get("AvailabilityZone", ""),
+            "PrivateIP": inst.get("PrivateIpAddress", ""),
+            "PublicIP": inst.get("PublicIpAddress", ""),
+            "LaunchTime": inst.get("LaunchTime", ""),
+            "InstanceStatus": inst_status,
+            "SystemStatus": sys_status,
+        }
+
+    # ---- public ----
+    def refresh(self, blocking: bool = False) -> None:
+        """
+        Fetch a new snapshot. Safe to call from a scheduler thread; a non-blocking call
+        returns immediately when another refresh is already running.
+        """
+        if not self._refresh_lock.acquire(blocking=blocking):
+            return
+        try:
+            now = time.monotonic()
+            with self._lock:
+                recheck = (self._missing_checked_at is None
+                           or now - self._missing_checked_at >= self._missing_recheck)
+                skip = set() if recheck else set(self._missing)
+            ids = [i for i in self._instance_ids if i not in skip]
+
+            try:
+                instances, missing = self._describe(ids) if ids else ([], set())
+                found = [inst.get("InstanceId", "") for inst in instances]
+                statuses = self._status_map(found) if found else {}
+                rows = [self._row(inst, statuses) for inst in instances]
+                err = None
+            except (BotoCoreError, ClientError) as e:
+                logger.exception("EC2 status refresh failed")
+                rows, missing, err = None, None, f"AWS error: {e}"
+            except Exception as e:
+                logger.exception("EC2 status refresh failed")
+                rows, missing, err = None, None, f"Unexpected error: {e}"
+
+            with self._lock:
+                if rows is not None:
+                    self._rows, self._err = rows, None
+                    if recheck:
+                        self._missing = set(missing or ())
+                        self._missing_checked_at = now
+                    else:
+                        self._missing |= set(missing or ())
+                    if self._missing:
+                        logger.warning("EC2: skipped missing instance IDs: %s",
+                                       ", ".join(sorted(self._missing)))
+                elif not self._rows:
+                    # keep serving the last good snapshot; only surface the error if we have none
+                    self._err = err
+                self._fetched_at = now
+        finally:
+            self._refresh_lock.release()
+
+    def rows(self) -> Tuple[List[dict], Optional[str]]:
+        """Last snapshot; refreshes inline only when nothing was fetched yet or it is stale."""
+        with self._lock:
+            fetched_at = self._fetched_at
+        if fetched_at is None or time.monotonic() - fetched_at > self._stale_after:
+            self.refresh(blocking=True)
+        with self._lock:
+            return [dict(r) for r in self._rows], self._err
+
+    def snapshot_age_seconds(self) -> Optional[float]:
+        with self._lock:
+            if self._fetched_at is None:
+                return None
+            return time.monotonic() - self._fetched_at
+
+    @property
+    def missing_ids(self) -> List[str]:
+        with self._lock:
+            return sorted(self._missing)
@@ -0,0 +1,406 @@
+# app/services/email_outbox.py
+#
+# Durable email outbox with pooled SMTP sessions.
+# Senders build an EmailMessage as before and hand it to queue_email(); the
+# message is stored in `email_outbox` (status pending) and a few worker threads
+# deliver it over a small pool of logged-in SMTP sessions that stay open between
+# messages, instead of a TLS handshake + login per email. Delivery is rate
+# limited, transient failures are retried with backoff, and every message keeps
+# its status (pending / sending / sent / failed) and last error.
+#
+# Senders that gate a message with a once-only flag (feedback, nudge stage,
+# production) set the flag when they enqueue, so a pending message is never
+# queued twice, and register on_delivery() hooks for their `kind`: the
+# `failed` hook undoes the flag when a message is parked as failed, and the
+# `sent` hook records what was actually delivered. Hooks get the `meta` dict
+# the message was enqueued with.
+#
+# Accounts:
+#   default - EMAIL_ADDRESS / EMAIL_PASSWORD on EMAIL_SMTP_HOST:EMAIL_SMTP_PORT
+#             (smtp.gmail.com:465, implicit TLS)
+#   export  - SMTP_USER / SMTP_PASS on SMTP_HOST:SMTP_PORT (STARTTLS unless 465)
+# For local testing point an account at a debugging server, e.g.
+#   python -m aiosmtpd -n -l localhost:1025
+#   EMAIL_SMTP_HOST=localhost EMAIL_SMTP_PORT=1025 EMAIL_SMTP_TLS=none
+# (login is skipped when no user is configured).
+import logging
+import os
+import queue
+import smtplib
+import socket
+import ssl
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from email.utils import getaddresses
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import Binary
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+EMAIL_OUTBOX_WORKERS = int(os.getenv("EMAIL_OUTBOX_WORKERS", "2"))
+EMAIL_OUTBOX_RATE_PER_SECOND = float(os.getenv("EMAIL_OUTBOX_RATE_PER_SECOND", "5"))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", "5"))
+EMAIL_OUTBOX_RETENTION_DAYS = int(os.getenv("EMAIL_OUTBOX_RETENTION_DAYS", "30"))
+SMTP_SESSION_IDLE_SECONDS = 60
+SMTP_SESSION_MAX_MESSAGES = 100  # reconnect now and then; providers cap messages per session
+_RETRY_BASE_SECONDS = 30.0
+_RETRY_MAX_SECONDS = 1800.0
+_LOCK_SECONDS = 300
+_POLL_SECONDS = 1.0
+
+
+@dataclass(frozen=True)
+class SmtpSettings:
+    host: str
+    port: int
+    user: str = ""
+    password: str = ""
+    tls: str = "ssl"  # "ssl" (implicit), "starttls" or "none"
+    timeout: float = 30.0
+
+
+def _tls_mode(env_name: str, port: int) -> str:
+    mode = (os.getenv(env_name) or "").strip().lower()
+    if mode in ("ssl", "starttls", "none"):
+        return mode
+    return "ssl" if port == 465 else "starttls"
+
+
+def settings_from_env() -> Dict[str, SmtpSettings]:
+    default_port = int(os.getenv("EMAIL_SMTP_PORT", "465"))
+    export_port = int(os.getenv("SMTP_PORT", "587"))
+    email_user = (os.getenv("EMAIL_ADDRESS") or "").strip()
+    email_pass = (os.getenv("EMAIL_PASSWORD") or "").strip()
+    return {
+        "default": SmtpSettings(
+            host=os.getenv("EMAIL_SMTP_HOST", "smtp.gmail.com"),
+            port=default_port,
+            user=email_user,
+            password=email_pass,
+            tls=_tls_mode("EMAIL_SMTP_TLS", default_port),
+        ),
+        "export": SmtpSettings(
+            host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+            port=export_port,
+            user=(os.getenv("SMTP_USER") or email_user).strip(),
+            password=(os.getenv("SMTP_PASS") or email_pass).strip(),
+            tls=_tls_mode("SMTP_TLS", export_port),
+        ),
+    }
+
+
+class _Session:
+    def __init__(self, settings: SmtpSettings):
+        s = settings
+        if s.tls == "ssl":
+            self.smtp = smtplib.SMTP_SSL(s.host, s.port, timeout=s.timeout,
+                                         context=ssl.create_default_context())
+        else:
+            self.smtp = smtplib.SMTP(s.host, s.port, timeout=s.timeout)
+            if s.tls == "starttls":
+                self.smtp.starttls(context=ssl.create_default_context())
+        if s.user:
+            self.smtp.login(s.user, s.password)
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+class SmtpPool:
+    """Up to `size` logged-in sessions for one account, reused across messages."""
+
+    def __init__(self, settings: SmtpSettings, size: int):
+        self.settings = settings
+        self._idle: "queue.LifoQueue[_Session]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, size))
+
+    def _checkout(self) -> _Session:
+        while True:
+            try:
+                sess = self._idle.get_nowait()
+            except queue.Empty:
+                return _Session(self.settings)
+            if sess.sent >= SMTP_SESSION_MAX_MESSAGES:
+                sess.close()
+                continue
+            if time.monotonic() - sess.last_used > SMTP_SESSION_IDLE_SECONDS:
+                try:
+                    if sess.smtp.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("noop failed")
+                except Exception:
+                    sess.close()
+                    continue
+            return sess
+
+    def send(self, msg: EmailMessage) -> Dict[str, tuple]:
+        """Send on a pooled session; a session that errored is discarded, not returned."""
+        with self._slots:
+            sess = self._checkout()
+            try:
+                refused = sess.smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # the server dropped an idle session: one fresh attempt
+                sess.close()
+                sess = _Session(self.settings)
+                try:
+                    refused = sess.smtp.send_message(msg)
+                except Exception:
+                    sess.close()
+                    raise
+            except Exception:
+                sess.close()
+                raise
+            sess.sent += 1
+            sess.last_used = time.monotonic()
+            self._idle.put(sess)
+            return refused
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class _RateLimiter:
+    def __init__(self, per_second: float):
+        self._interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self._interval
+        if at > now:
+            time.sleep(at - now)
+
+
+def _is_permanent(exc: Exception) -> bool:
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(exc, (smtplib.SMTPDataError, smtplib.SMTPSenderRefused)):
+        return 500 <= getattr(exc, "smtp_code", 0) < 600
+    return False
+
+
+SentHook = Callable[[Dict[str, Any]], None]
+FailedHook = Callable[[Dict[str, Any], str], None]
+
+
+class EmailOutbox:
+    def __init__(
+        self,
+        collection: Collection,
+        accounts: Optional[Dict[str, SmtpSettings]] = None,
+        workers: int = EMAIL_OUTBOX_WORKERS,
+        rate_per_second: float = EMAIL_OUTBOX_RATE_PER_SECOND,
+        max_attempts: int = EMAIL_OUTBOX_MAX_ATTEMPTS,
+    ):
+        self._coll = collection
+        self._workers = max(1, workers)
+        self._pools = {name: SmtpPool(s, self._workers) for name, s in (accounts or settings_from_env()).items()}
+        self._limiter = _RateLimiter(rate_per_second)
+        self._max_attempts = max(1, max_attempts)
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._hooks: Dict[str, Tuple[Optional[SentHook], Optional[FailedHook]]] = {}
+        self._indexes_ready = False
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index(
+                [("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt")
+            self._coll.create_index(
+                "sent_at", name="sent_at_ttl", expireAfterSeconds=EMAIL_OUTBOX_RETENTION_DAYS * 86400)
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[OUTBOX] create_index failed; continuing without it")
+
+    # ---- lifecycle ----
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._ensure_indexes()
+        self._stop.clear()
+        for i in range(self._workers):
+            t = threading.Thread(target=self._run, name=f"email-outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info("[OUTBOX] started %d workers", self._workers)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+        for pool in self._pools.values():
+            pool.close()
+
+    def on_delivery(self, kind: str, sent: Optional[SentHook] = None, failed: Optional[FailedHook] = None) -> None:
+        """Call sent(meta) when a `kind` message is delivered, failed(meta, error) when it is parked."""
+        self._hooks[kind] = (sent, failed)
+
+    def _fire(self, kind: str, meta: Dict[str, Any], error: Optional[str]) -> None:
+        sent, failed = self._hooks.get(kind, (None, None))
+        hook = sent if error is None else failed
+        if hook is None:
+            return
+        try:
+            hook(meta) if error is None else hook(meta, error)
+        except Exception:
+            logger.exception("[OUTBOX] %s hook for %s email failed", "sent" if error is None else "failed", kind)
+
+    # ---- producing ----
+    def send_now(self, msg: EmailMessage, account: str = "default") -> Dict[str, tuple]:
+        """Deliver synchronously on the pool (diagnostics / fallback); raises on failure."""
+        self._limiter.wait()
+        return self._pools[account].send(msg)
+
+    def enqueue(
+        self,
+        msg: EmailMessage,
+        account: str = "default",
+        kind: str = "",
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> Optional[object]:
+        """Store `msg` for delivery. Falls back to an immediate send if it cannot be stored."""
+        if account not in self._pools:
+            raise ValueError(f"unknown email account {account!r}")
+        recipients = [addr for _, addr in getaddresses(msg.get_all("To", []) + msg.get_all("Cc", []) + msg.get_all("Bcc", [])) if addr]
+        now = datetime.now(timezone.utc)
+        try:
+            res = self._coll.insert_one({
+                "status": "pending",
+                "account": account,
+                "kind": kind,
+                "to": recipients,
+                "subject": str(msg.get("Subject", "")),
+                "raw": Binary(msg.as_bytes()),
+                "meta": meta or {},
+                "attempts": 0,
+                "created_at": now,
+                "next_attempt_at": now,
+            })
+        except PyMongoError:
+            logger.exception("[OUTBOX] could not store %s email to %s; sending directly", kind, recipients)
+            self.send_now(msg, account)
+            self._fire(kind, meta or {}, None)
+            return None
+        self._wake.set()
+        return res.inserted_id
+
+    # ---- delivery ----
+    def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return self._coll.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "sending", "locked_until": {"$lt": now}},
+            ]},
+            {"$set": {"status": "sending", "locked_by": self._owner,
+                      "locked_until": now + timedelta(seconds=_LOCK_SECONDS)}},
+            sort=[("next_attempt_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _deliver(self, doc: dict) -> None:
+        msg = message_from_bytes(bytes(doc["raw"]), policy=policy.SMTP)
+        attempts = int(doc.get("attempts") or 0) + 1
+        base = {"_id": doc["_id"], "locked_by": self._owner}
+        unlock = {"locked_by": "", "locked_until": ""}
+        try:
+            self._limiter.wait()
+            refused = self._pools[doc["account"]].send(msg)
+        except Exception as e:
+            err = f"{type(e).__name__}: {e}"
+            if _is_permanent(e) or attempts >= self._max_attempts:
+                logger.error("[OUTBOX] %s email %s to %s failed permanently: %s",
+                             doc.get("kind"), doc["_id"], doc.get("to"), err)
+                self._coll.update_one(base, {"$set": {"status": "failed", "attempts": attempts,
+                                                      "last_error": err, "failed_at": datetime.now(timezone.utc)},
+                                             "$unset": unlock})
+                self._fire(doc.get("kind", ""), doc.get("meta") or {}, err)
+                return
+            delay = min(_RETRY_MAX_SECONDS, _RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+            logger.warning("[OUTBOX] %s email %s attempt %d failed (retry in %.0fs): %s",
+                           doc.get("kind"), doc["_id"], attempts, delay, err)
+            self._coll.update_one(base, {"$set": {
+                "status": "pending", "attempts": attempts, "last_error": err,
+                "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay)},
+                "$unset": unlock})
+            return
+
+        self._coll.update_one(base, {"$set": {
+            "status": "sent", "attempts": attempts, "sent_at": datetime.now(timezone.utc),
+            "refused": {k: list(v) for k, v in (refused or {}).items()}},
+            "$unset": {**unlock, "raw": "", "last_error": ""}})
+        logger.info("[OUTBOX] sent %s email %s to %s", doc.get("kind"), doc["_id"], doc.get("to"))
+        self._fire(doc.get("kind", ""), doc.get("meta") or {}, None)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                doc = self._claim()
+            except PyMongoError:
+                logger.exception("[OUTBOX] store unavailable; backing off")
+                self._stop.wait(_POLL_SECONDS * 5)
+                continue
+            if doc is None:
+                self._wake.wait(_POLL_SECONDS)
+                self._wake.clear()
+                continue
+            try:
+                self._deliver(doc)
+            except Exception:
+                logger.exception("[OUTBOX] worker error on %s", doc.get("_id"))
+
+
+# The app installs its outbox at startup; senders anywhere call queue_email().
+_outbox: Optional[EmailOutbox] = None
+
+
+def install(outbox: EmailOutbox) -> None:
+    global _outbox
+    _outbox = outbox
+
+
+def get_outbox() -> EmailOutbox:
+    if _outbox is None:
+        raise RuntimeError("email outbox not installed")
+    return _outbox
+
+
+def queue_email(
+    msg: EmailMessage,
+    account: str = "default",
+    kind: str = "",
+    meta: Optional[Dict[str, Any]] = None,
+) -> None:
+    get_outbox().enqueue(msg, account=account, kind=kind, meta=meta)
@@ -0,0 +1,596 @@
+# app/services/email_templates.py
+#
+# Customer email bodies, compiled once at import.
+# The production, tracking, nudge and feedback senders used to rebuild their
+# HTML as large f-strings on every send, and the production body existed in two
+# diverging copies (main.py and the ItemProduce router). Sources now live here:
+#   ${name}     per-send field, HTML-escaped (names ending in "_html" go in raw)
+#   ${>name}    static fragment, inlined at compile time
+# Plain braces are literal, so CSS needs no {{ }} escaping. Compiling splits a
+# source into literal runs and field names, with fragments and adjacent static
+# text already merged and each field's escape-or-raw choice fixed, so a send
+# only formats its fields and joins. Escaping keeps a send somewhat dearer than
+# the raw f-strings were; compare with `python bench_email_templates.py`.
+import html
+import logging
+import re
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_TOKEN = re.compile(r"\$\{(>?)(\w+)\}")
+
+TRACK_ORDER_URL = "https://diffrun.com/track-your-order"
+
+
+class CompiledTemplate:
+    """A template split into literal runs and field names: literals[0] f0 literals[1] f1 ..."""
+
+    __slots__ = ("name", "literals", "fields", "_steps")
+
+    def __init__(self, name: str, source: str, fragments: Mapping[str, str]):
+        self.name = name
+        literals: List[str] = []
+        fields: List[str] = []
+        buf: List[str] = []
+        pos = 0
+        for m in _TOKEN.finditer(source):
+            buf.append(source[pos:m.start()])
+            pos = m.end()
+            include, key = m.group(1), m.group(2)
+            if include:
+                if key not in fragments:
+                    raise KeyError(f"template {name!r}: unknown fragment {key!r}")
+                buf.append(fragments[key])
+            else:
+                literals.append("".join(buf))
+                fields.append(key)
+                buf = []
+        buf.append(source[pos:])
+        literals.append("".join(buf))
+        self.literals: Tuple[str, ...] = tuple(literals)
+        self.fields: Tuple[str, ...] = tuple(fields)
+        # (field, escape or None for raw "_html" fields, literal after it)
+        self._steps: Tuple[Tuple[str, Optional[Callable[[str], str]], str], ...] = tuple(
+            (key, None if key.endswith("_html") else html.escape, literals[i + 1])
+            for i, key in enumerate(fields)
+        )
+
+    def render(self, ctx: Mapping[str, Any]) -> str:
+        out = [self.literals[0]]
+        for key, escape, lit in self._steps:
+            value = ctx[key]
+            if value is None:
+                value = ""
+            elif type(value) is not str:
+                value = str(value)
+            out.append(escape(value) if escape is not None else value)
+            out.append(lit)
+        return "".join(out)
+
+
+class TemplateRegistry:
+    def __init__(self, sources: Mapping[str, str], fragments: Mapping[str, str]):
+        self._sources = dict(sources)
+        # fragments may include earlier fragments, but carry no fields
+        resolved: Dict[str, str] = {}
+        for key, src in fragments.items():
+            t = CompiledTemplate(key, src, resolved)
+            if t.fields:
+                raise ValueError(f"fragment {key!r} has fields {t.fields}; fragments must be static")
+            resolved[key] = t.literals[0]
+        self._fragments = resolved
+        self._compiled = {key: CompiledTemplate(key, src, resolved) for key, src in self._sources.items()}
+        logger.debug("[MAIL-TPL] compiled %d templates, %d fragments", len(self._compiled), len(resolved))
+
+    def get(self, name: str) -> CompiledTemplate:
+        return self._compiled[name]
+
+    def source(self, name: str) -> str:
+        return self._sources[name]
+
+    def fragments(self) -> Dict[str, str]:
+        return dict(self._fragments)
+
+    def names(self) -> List[str]:
+        return sorted(self._compiled)
+
+    def render(self, name: str, **ctx: Any) -> str:
+        return self._compiled[name].render(ctx)
+
+
+# ---------------------------------------------------------------- fragments
+
+_FRAGMENTS: Dict[str, str] = {
+    "email_image_url": "https://diffrungenerations.s3.ap-south-1.amazonaws.com/email_image+(2).jpg",
+    "logo_url": "https://diffrungenerations.s3.ap-south-1.amazonaws.com/Diffrun_logo+(1).png",
+    "google_review_url": "https://search.google.com/local/writereview?placeid=ChIJn5mGENoTrjsRPHxH86vgui0",
+
+    "light_meta": """\
+  <meta charset="UTF-8">
+  <meta name="color-scheme" content="light">
+  <meta name="supported-color-schemes" content="light">""",
+
+    "card_mobile_style": """\
+  <style>
+    @media only screen and (max-width: 480px) {
+      .container { width: 100% !important; max-width: 100% !important; padding: 16px !important; }
+      .col, .img-col { display: block !important; width: 100% !important; }
+      .img-col img { width: 100% !important; height: auto !important; }
+      .browse-now-btn { font-size: 14px !important; padding: 12px 16px !important; }
+      p, li, a { font-size: 15px !important; line-height: 1.5 !important; }
+    }
+  </style>""",
+
+    "explore_more_row": """\
+                  <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0"
+                         style="margin-top: 30px; background-color: #f7f6cf; border-radius: 8px;">
+                    <tr>
+                      <td class="col" style="padding: 20px; vertical-align: middle;">
+                        <p style="font-size: 15px; margin: 0;">
+                          Explore more magical books in our growing collection &nbsp;
+                          <button class="browse-now-btn"
+                                  style="background-color:#5784ba; margin-top: 20px; border-radius: 30px; border: none; padding:10px 15px;">
+                            <a href="https://diffrun.com"
+                               style="color:white; font-weight: bold; text-decoration: none; display:inline-block;">
+                              Browse Now
+                            </a>
+                          </button>
+                        </p>
+                      </td>
+                      <td class="img-col" width="300" style="padding: 0 20px 0 0; margin: 0; vertical-align: middle;">
+                        <img src="${>email_image_url}"
+                             alt="Storybook Preview" width="300"
+                             style="display: block; border-radius: 0; margin: 0; padding: 0;">
+                      </td>
+                    </tr>
+                  </table>""",
+
+    "team_signoff": """\
+    <p>
+      Warm wishes,<br>
+      <strong>The Diffrun Team</strong>
+    </p>""",
+}
+
+
+# ---------------------------------------------------------------- templates
+
+_SOURCES: Dict[str, str] = {
+    # fields: display, child, track_href
+    "production": """<!doctype html>
+<html>
+<head>
+${>light_meta}
+  <meta name="x-apple-disable-message-reformatting">
+  <meta name="viewport" content="width=device-width, initial-scale=1">
+  <style>
+    body { margin:0; padding:20px; background:#f7f7f7; -webkit-text-size-adjust:100%; -ms-text-size-adjust:100%; }
+    .container { width:100%; max-width:768px; margin:0 auto; background:#ffffff; border-radius:8px; box-shadow:0 0 10px rgba(0,0,0,0.08); overflow:hidden; }
+    .inner { padding:24px; font-family:Arial, Helvetica, sans-serif; color:#111; }
+    p { margin:0 0 14px 0; font-size:16px; line-height:1.5; }
+    .row { width:100%; }
+    .col { vertical-align:top; }
+    .col-text { padding:20px; }
+    .col-img { padding:0 20px 0 0; }
+    img { border:0; outline:none; text-decoration:none; display:block; height:auto; }
+
+    @keyframes shine-sweep {
+      0%   { transform: translateX(-100%) rotate(45deg); }
+      50%  { transform: translateX(100%)  rotate(45deg); }
+      100% { transform: translateX(100%)  rotate(45deg); }
+    }
+
+    .cta {
+      position: relative;
+      overflow: hidden;
+      border-radius:9999px; text-align:center; mso-line-height-rule:exactly;
+      font-family:Arial, Helvetica, sans-serif; font-weight:bold; text-decoration:none; display:block;
+      color:#ffffff !important; background:#5784ba;
+    }
+    .cta::before {
+      content: "";
+      position: absolute;
+      top: 0;
+      left: -50%;
+      height: 100%;
+      width: 200%;
+      background: linear-gradient(120deg, transparent 0%, rgba(255,255,255,0.6) 50%, transparent 100%);
+      animation: shine-sweep 4s infinite;
+    }
+
+    .cta-wrap { width:auto; }
+    .cta-text { font-size:15px; line-height:1.2; padding:12px 24px; display:block; color:#ffffff !important; text-decoration:none; }
+    .cta-secondary { background:#5784ba; }
+
+    .banner { background:#f7f6cf; border-radius:8px; }
+    .banner p { font-size:15px; }
+
+    @media only screen and (max-width:480px) {
+      .inner { padding:16px !important; }
+      p { font-size:15px !important; }
+      .stack { display:block !important; width:100% !important; }
+      .col-text { padding:0px !important; text-align:center !important; }
+      .col-img { padding:16px 0 0 0 !important; text-align:center !important; }
+      .cta-wrap { width:100% !important; }
+      .cta-text { font-size:13px !important; padding:10px 14px !important; }
+      .banner { padding:12px !important; }
+      .mt-sm { margin-top:12px !important; }
+      .banner .row { display:block !important; width:100% !important; }
+      .banner .col { display:block !important; width:100% !important; }
+      .banner img { margin:0 auto !important; }
+    }
+  </style>
+</head>
+<body>
+  <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0">
+    <tr>
+      <td align="center">
+        <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" class="container">
+          <tr>
+            <td class="inner">
+              <p>Hey ${display},</p>
+              <p><strong>${child}'s storybook</strong> has been moved to production at our print factory. 🎉</p>
+              <p>It will be shipped within the next 3–4 business days. We will notify you with the tracking ID once your order is shipped.</p>
+
+              <table role="presentation" cellpadding="0" cellspacing="0" border="0" class="cta-wrap" style="margin:8px 0 18px 0;">
+                <tr>
+                  <td>
+                    <a href="${track_href}" class="cta">
+                      <span class="cta-text">Track your order</span>
+                    </a>
+                  </td>
+                </tr>
+              </table>
+
+              <p>Thanks,<br>Team Diffrun</p>
+
+              <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" class="banner" style="margin-top:24px;">
+                <tr>
+                  <td>
+                    <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" class="row">
+                      <tr>
+                        <td class="col col-text stack" width="60%">
+                          <p>Explore more magical books in our growing collection</p>
+
+                          <table role="presentation" cellpadding="0" cellspacing="0" border="0" class="cta-wrap mt-sm" style="margin-top:16px;">
+                            <tr>
+                              <td>
+                                <a href="https://diffrun.com" class="cta cta-secondary">
+                                  <span class="cta-text">Browse Now</span>
+                                </a>
+                              </td>
+                            </tr>
+                          </table>
+                        </td>
+
+                        <td class="col col-img stack" width="40%" align="right">
+                          <img src="${>email_image_url}"
+                               alt="Storybook Preview" width="300" style="max-width:100%;">
+                        </td>
+                      </tr>
+                    </table>
+                  </td>
+                </tr>
+              </table>
+
+            </td>
+          </tr>
+        </table>
+      </td>
+    </tr>
+  </table>
+</body>
+</html>""",
+
+    # fields: track_url (rendered into tracking's track_button_html when a URL exists)
+    "tracking_button": """
+                  <p style="margin: 20px 0;">
+                    <a href="${track_url}"
+                       style="background-color:#5784ba; color:#ffffff; text-decoration:none; font-weight:bold;
+                              padding:12px 18px; border-radius:30px; display:inline-block;">
+                      Track your order
+                    </a>
+                  </p>""",
+
+    # fields: display_name, child_name, order_ref, tracking, track_button_html
+    "tracking": """
+<html>
+<head>
+${>light_meta}
+${>card_mobile_style}
+</head>
+<body style="font-family: Arial, sans-serif; background:#f7f7f7; margin:0; padding:20px;">
+  <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse:collapse;">
+    <tr>
+      <td align="center">
+        <table role="presentation" class="container" width="100%" cellpadding="0" cellspacing="0" border="0"
+               style="max-width: 48rem; margin: 0 auto; background:#ffffff; border-radius:8px; box-shadow:0 0 10px rgba(0,0,0,0.08); overflow:hidden;">
+          <tr>
+            <td style="padding:24px;">
+                  <p>Hey ${display_name},</p>
+                  Order Update! <strong>${child_name}'s storybook</strong> has been printed and is ready to be shipped. 🚚✨
+
+                  <ul>
+                    <li><strong>Order:</strong> ${order_ref}</li>
+                    <li><strong>Tracking:</strong> ${tracking}</li>
+                  </ul>
+${track_button_html}
+
+                  <p>Thanks,<br />Team Diffrun</p>
+
+${>explore_more_row}
+
+            </td>
+          </tr>
+        </table>
+      </td>
+    </tr>
+  </table>
+</body>
+</html>
+""",
+
+    # fields: user_name, child_name, preview_link
+    "nudge_stage1": """
+<html>
+  <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+    <p>Hi <strong>${user_name}</strong>,</p>
+
+    <p>
+      We noticed you began crafting a personalized storybook for
+      <strong>${child_name}</strong> — and it’s already looking magical!
+    </p>
+
+    <p>
+      Just one more step to bring it to life:
+      preview the story and place your order whenever you’re ready.
+    </p>
+
+    <p style="margin: 32px 0;">
+      <a href="${preview_link}"
+         style="background-color: #5784ba; color: white;
+                padding: 14px 28px; border-radius: 6px;
+                text-decoration: none; font-weight: bold;">
+        Preview & Continue
+      </a>
+    </p>
+
+    <p>
+      Your story is safe and waiting.
+      We’d love for <strong>${child_name}</strong> to see themselves in a story
+      made just for them.
+    </p>
+
+${>team_signoff}
+  </body>
+</html>
+""",
+
+    # fields: user_name, child_name, preview_link
+    # One-off reminder (send_nudge_email_to_user): the stage-1 body plus the 💫 close.
+    "nudge_reminder": """
+<html>
+  <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+    <p>Hi <strong>${user_name}</strong>,</p>
+
+    <p>
+      We noticed you began crafting a personalized storybook for
+      <strong>${child_name}</strong> — and it’s already looking magical!
+    </p>
+
+    <p>
+      Just one more step to bring it to life:
+      preview the story and place your order whenever you’re ready.
+    </p>
+
+    <p style="margin: 32px 0;">
+      <a href="${preview_link}"
+         style="background-color: #5784ba; color: white;
+                padding: 14px 28px; border-radius: 6px;
+                text-decoration: none; font-weight: bold;">
+        Preview & Continue
+      </a>
+    </p>
+
+    <p>
+      Your story is safe and waiting.
+      We’d love for <strong>${child_name}</strong> to see themselves in a story
+      made just for them. 💫
+    </p>
+
+${>team_signoff}
+  </body>
+</html>
+""",
+
+    # fields: user_name, child_name, preview_link
+    "nudge_stage2": """
+<html>
+  <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #222;">
+    <p>Hi <strong>${user_name}</strong>,</p>
+
+    <p>
+      ${child_name}’s personalised story is ready —
+      over 300 parents completed their orders within 48 hours
+      and loved the results.
+    </p>
+
+    <p>
+      Complete the order now for faster dispatch
+      and a keepsake ${child_name} will treasure.
+    </p>
+
+    <p style="margin: 22px 0;">
+      <a href="${preview_link}"
+         style="display: inline-block;
+                padding: 12px 20px;
+                border-radius: 6px;
+                text-decoration: none;
+                font-weight: 600;">
+        Finish & Order Now
+      </a>
+    </p>
+
+    <p>
+      Use code <strong>FAST10</strong> for 10% off —
+      valid for the next 24 hours only.
+    </p>
+
+    <p>
+      Need help finishing up?
+      Reply to this email and we’ll take care of the last steps.
+    </p>
+
+    <p>
+      Warmly,<br>
+      <strong>The Diffrun Team</strong>
+    </p>
+  </body>
+</html>
+""",
+
+    # fields: user_name, child_name, pronoun, book_title, order_id, ordered_on
+    "feedback": """
+<html>
+<head>
+${>light_meta}
+<title>We'd love your feedback</title>
+<style>
+@keyframes shine-sweep {
+  0%   { transform: translateX(-100%) rotate(45deg); }
+  50%  { transform: translateX(100%)  rotate(45deg); }
+  100% { transform: translateX(100%)  rotate(45deg); }
+}
+.review-btn {
+  position: relative;
+  display: inline-block;
+  border-radius: 20px;
+  font-family: Arial, Helvetica, sans-serif;
+  font-weight: bold;
+  text-decoration: none;
+  color: #ffffff !important;
+  background-color: #5784ba;
+  overflow: hidden;
+  padding: 12px 24px;
+  font-size: 16px;
+}
+.review-btn::before {
+  content: "";
+  position: absolute;
+  top: 0;
+  left: -50%;
+  height: 100%;
+  width: 200%;
+  background: linear-gradient(120deg, transparent 0%, rgba(255,255,255,0.6) 50%, transparent 100%);
+  animation: shine-sweep 4s infinite;
+}
+@media only screen and (max-width: 480px) {
+    h2 { font-size: 15px !important; }
+    p { font-size: 15px !important; }
+    a { font-size: 15px !important; }
+    .title-text { font-size: 18px !important; }
+    .small-text { font-size: 12px !important; }
+    .logo-img { width: 300px !important; }
+    .review-btn { font-size: 13px !important; padding: 10px 16px !important; width: 100% !important; text-align: center !important; }
+    .browse-now-btn { font-size: 12px !important; padding: 8px 12px !important; }
+}
+</style>
+</head>
+<body style="font-family: Arial, sans-serif; background-color: #f7f7f7; padding: 20px; margin: 0;">
+<table width="100%" cellpadding="0" cellspacing="0" border="0" bgcolor="#ffffff" style="max-width: 600px; margin: 0 auto; border-radius: 8px; box-shadow: 0 0 10px rgba(0,0,0,0.1);">
+    <tr>
+    <td style="padding: 20px;">
+        <div style="text-align: left; margin-bottom: 20px;">
+        <img src="${>logo_url}" alt="Diffrun" class="logo-img" style="max-width: 100px;">
+        </div>
+
+        <h2 style="color: #333; font-size: 15px;">Hey ${user_name},</h2>
+
+        <p style="font-size: 14px; color: #555;">
+        We truly hope ${child_name} is enjoying ${pronoun} magical storybook, <strong>${book_title}</strong>!
+        At Diffrun, we are dedicated to crafting personalized storybooks that inspire joy, imagination, and lasting memories for every child.
+        Your feedback means the world to us. We'd be grateful if you could share your experience.
+        </p>
+
+        <p style="font-size: 14px; color: #555;">Please share your feedback with us:</p>
+
+        <p style="text-align: left; margin: 30px 0;">
+        <a href="${>google_review_url}"
+            class="review-btn"
+            style="background-color: #5784ba; color: #ffffff; text-decoration: none; border-radius: 20px;">
+            Leave a Google Review
+        </a>
+        </p>
+
+        <p style="font-size: 14px; color: #555; text-align: left;">
+        Thanks,<br>Team Diffrun
+        </p>
+
+        <hr style="border: none; border-top: 1px solid #eee; margin: 20px 0;">
+
+        <table width="100%" cellpadding="0" cellspacing="0" border="0" style="margin-top: 30px;">
+        <tr>
+            <td colspan="2" style="padding: 10px 0; text-align: left;">
+            <p class="title-text" style="font-size: 18px; margin: 0; font-weight: bold; color: #000;">
+                ${book_title}
+            </p>
+            </td>
+        </tr>
+
+        <tr>
+            <td style="padding: 0; vertical-align: top; font-size: 12px; color: #333; font-weight: 500;">
+            Order reference ID: <span>${order_id}</span>
+            </td>
+            <td style="padding: 0; text-align: right; font-size: 12px; color: #333; font-weight: 500;">
+            Ordered: <span>${ordered_on}</span>
+            </td>
+        </tr>
+
+        <tr>
+            <td colspan="2" style="padding: 0; margin: 0; background-color: #f7f6cf;">
+            <table width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse: collapse; padding: 0; margin: 0;">
+                <tr>
+                <td style="padding: 20px; vertical-align: middle; margin: 0;">
+                    <p style="font-size: 15px; margin: 0;">
+                    Explore more magical books in our growing collection &nbsp;
+                    <button class="browse-now-btn" style="background-color:#5784ba; margin-top: 20px; border-radius: 30px;border: none;padding:10px 15px"><a href="https://diffrun.com" style="color:white; font-weight: bold; text-decoration: none;">
+                    Browse Now
+                    </a></button>
+                    </p>
+                </td>
+
+                <td width="300" style="padding: 0; margin: 0; vertical-align: middle;">
+                    <table width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse: collapse;">
+                    <tr>
+                        <td align="right" style="padding: 0; margin: 0;">
+                        <img src="${>email_image_url}"
+                            alt="Cover Image"
+                            width="300"
+                            style="display: block; border-radius: 0; margin: 0; padding: 0;">
+                        </td>
+                    </tr>
+                    </table>
+                </td>
+                </tr>
+            </table>
+            </td>
+        </tr>
+
+        </table>
+
+    </td>
+    </tr>
+</table>
+</body>
+</html>
+""",
+}
+
+
+registry = TemplateRegistry(_SOURCES, _FRAGMENTS)
+
+
+def render(name: str, **ctx: Any) -> str:
+    """Render a registered email body; a missing context field raises KeyError."""
+    return registry.render(name, **ctx)
@@ -0,0 +1,91 @@
+# app/services/fanout.py
+#
+# Run independent blocking I/O legs (Mongo clusters, AWS calls, ...) concurrently
+# on a shared thread pool, with a timeout per leg and per-leg timing. A slow or
+# failing leg comes back as an error result instead of stalling or failing the
+# caller.
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "8"))
+
+# Module-level pool: a timed-out leg keeps its thread until the call returns,
+# so the pool must outlive any single fan-out (no `with` / shutdown per call).
+# It is meant for short interactive fan-outs; bulk callers (S3 moves, nudge
+# batches, ...) pass their own module-level pool so a long queue of theirs
+# cannot eat the deadlines of page loads and exports.
+_POOL = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix="fanout")
+
+
+@dataclass
+class LegResult:
+    name: str
+    ok: bool
+    value: Any = None
+    error: Optional[str] = None
+    elapsed_ms: float = 0.0
+
+
+def run_legs(
+    legs: Dict[str, Callable[[], Any]],
+    timeout_s: Union[float, Dict[str, float]],
+    label: str = "FANOUT",
+    pool: Optional[ThreadPoolExecutor] = None,
+) -> Dict[str, LegResult]:
+    """
+    Submit every leg at once and wait for each up to its timeout, measured from
+    submission. `timeout_s` is one value for every leg or {name: seconds}; a leg
+    missing from the mapping gets the largest timeout given. `pool` defaults to
+    the shared interactive pool.
+    Returns {name: LegResult}; never raises for a leg failure.
+    """
+    if isinstance(timeout_s, dict):
+        default_s = max(timeout_s.values(), default=0.0)
+        timeouts = {name: float(timeout_s.get(name, default_s)) for name in legs}
+    else:
+        timeouts = {name: float(timeout_s) for name in legs}
+
+    t0 = time.perf_counter()
+    started: Dict[str, float] = {}
+    finished: Dict[str, float] = {}
+
+    def _timed(name: str, fn: Callable[[], Any]) -> Any:
+        started[name] = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            finished[name] = time.perf_counter()
+
+    executor = pool or _POOL
+    futures = {name: executor.submit(_timed, name, fn) for name, fn in legs.items()}
+    results: Dict[str, LegResult] = {}
+
+    for name, fut in futures.items():
+        remaining = max(0.0, t0 + timeouts[name] - time.perf_counter())
+        try:
+            value = fut.result(timeout=remaining)
+            res = LegResult(name=name, ok=True, value=value)
+        except FutureTimeout:
+            fut.cancel()  # only helps if it never started
+            res = LegResult(name=name, ok=False, error=f"timed out after {timeouts[name]:g}s")
+        except Exception as e:
+            logger.exception("[%s] leg %s failed", label, name)
+            res = LegResult(name=name, ok=False, error=f"{type(e).__name__}: {e}")
+
+        end = finished.get(name, time.perf_counter())
+        res.elapsed_ms = (end - started.get(name, t0)) * 1000.0
+        results[name] = res
+
+    logger.info(
+        "[%s] total=%.0fms %s", label, (time.perf_counter() - t0) * 1000.0,
+        " ".join(
+            f"{r.name}={'ok' if r.ok else 'ERR'}/{r.elapsed_ms:.0f}ms" for r in results.values()
+        ),
+    )
+    return results
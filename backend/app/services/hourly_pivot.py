@@ -0,0 +1,114 @@
+# app/services/hourly_pivot.py
+#
+# IST date x hour request counts for the darkfantasy / yippee "user-data"
+# collections. The grouping runs inside Mongo, so only (date, hour, count)
+# triples ever leave the cluster instead of every full document in the window.
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+
+import pandas as pd
+from pymongo.collection import Collection
+
+TIMESTAMP_FIELD = "time_req_recieved"
+COUNT_FIELD = "room_id"
+IST_TZ_OFFSET = "+05:30"  # Asia/Kolkata has no DST; same as the old IST_OFFSET shift
+DATE_FMT = "%d/%m/%Y"     # label used in the sheet index ("ist-date")
+HOURS = [f"{h:02d}" for h in range(24)]
+
+# (ist_date "YYYY-MM-DD", hour 0..23) -> count
+HourlyCounts = Dict[Tuple[str, int], int]
+
+
+def hourly_counts_pipeline(
+    from_dt: datetime, to_dt: datetime, inclusive_end: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Aggregation that counts non-null room_id per (IST date, IST hour) in
+    [from_dt, to_dt] (or [from_dt, to_dt) when inclusive_end=False).
+    """
+    end_op = "$lte" if inclusive_end else "$lt"
+    return [
+        {"$match": {TIMESTAMP_FIELD: {"$gte": from_dt, end_op: to_dt}}},
+        {"$project": {"_id": 0, TIMESTAMP_FIELD: 1, COUNT_FIELD: 1}},
+        {"$group": {
+            "_id": {
+                "d": {"$dateToString": {
+                    "format": "%Y-%m-%d",
+                    "date": f"${TIMESTAMP_FIELD}",
+                    "timezone": IST_TZ_OFFSET,
+                }},
+                "h": {"$hour": {"date": f"${TIMESTAMP_FIELD}", "timezone": IST_TZ_OFFSET}},
+            },
+            # pandas' pivot "count" skipped null/missing room_id; keep that behaviour
+            "count": {"$sum": {"$cond": [{"$gt": [f"${COUNT_FIELD}", None]}, 1, 0]}},
+            "docs": {"$sum": 1},
+        }},
+    ]
+
+
+def fetch_hourly_rows(
+    collection: Collection, from_dt: datetime, to_dt: datetime, inclusive_end: bool = True
+) -> List[Dict[str, Any]]:
+    """Raw $group output as [{"d": "YYYY-MM-DD", "h": 0..23, "count": n, "docs": n}, ...]."""
+    out: List[Dict[str, Any]] = []
+    pipeline = hourly_counts_pipeline(from_dt, to_dt, inclusive_end)
+    for row in collection.aggregate(pipeline, allowDiskUse=True):
+        key = row.get("_id") or {}
+        if key.get("d") is None or key.get("h") is None:
+            continue
+        out.append({
+            "d": key["d"],
+            "h": int(key["h"]),
+            "count": int(row.get("count") or 0),
+            "docs": int(row.get("docs") or 0),
+        })
+    return out
+
+
+def fetch_hourly_counts(
+    collection: Collection, from_dt: datetime, to_dt: datetime, inclusive_end: bool = True
+) -> Tuple[HourlyCounts, int]:
+    """
+    Run the (IST date, hour) $group on `collection` for the given naive-UTC window.
+    Returns (counts, matched_docs). matched_docs == 0 means the window is empty.
+    """
+    counts: HourlyCounts = {}
+    matched = 0
+    for row in fetch_hourly_rows(collection, from_dt, to_dt, inclusive_end):
+        key = (row["d"], row["h"])
+        counts[key] = counts.get(key, 0) + row["count"]
+        matched += row["docs"]
+    return counts, matched
+
+
+def counts_to_matrix(counts: HourlyCounts, total_label: str = "Total") -> pd.DataFrame:
+    """
+    Shape counts into the sheet layout: index = IST date (DD/MM/YYYY, sorted as dates),
+    columns = "00".."23" + "Total", plus a trailing `total_label` row.
+    Dates without any matching doc are not emitted (same as the old pivot_table).
+    """
+    days = sorted({d for d, _ in counts})
+    matrix = pd.DataFrame(0, index=days, columns=HOURS, dtype="int64")
+    for (d, h), n in counts.items():
+        matrix.at[d, HOURS[h]] += n
+    matrix.index = [datetime.strptime(d, "%Y-%m-%d").strftime(DATE_FMT) for d in days]
+    matrix.index.name = "ist-date"
+    matrix.columns.name = "ist-hour"
+    matrix["Total"] = matrix.sum(axis=1)
+    matrix.loc[total_label] = matrix.sum(numeric_only=True)
+    return matrix
+
+
+def merge_counts(*parts: Iterable[Tuple[Tuple[str, int], int]]) -> HourlyCounts:
+    """Sum several count maps (given as .items()) into one."""
+    out: HourlyCounts = {}
+    for part in parts:
+        for key, n in part:
+            out[key] = out.get(key, 0) + int(n)
+    return out
+
+
+def hourly_pivot(collection: Collection, from_dt: datetime, to_dt: datetime) -> Tuple[pd.DataFrame, int]:
+    """Convenience wrapper: (matrix, matched_docs) for one collection/window."""
+    counts, matched = fetch_hourly_counts(collection, from_dt, to_dt)
+    return counts_to_matrix(counts), matched
@@ -0,0 +1,252 @@
+# app/services/nudge_candidates.py
+#
+# Nudge candidate selection without pulling whole orders through $group.
+# The old pipeline grouped by email with {"$push": "$$ROOT"}, so every order in
+# the window (including its large `workflows` map) was held in memory just to
+# keep the latest one, and it ran $objectToArray twice per doc to check that
+# all workflows were completed. Now:
+#   - `workflows_count` / `workflows_completed_count` are kept on the order and
+#     compared directly (exactly 13 workflows, all 13 completed);
+#   - the pipeline projects the handful of fields the nudge job reads before
+#     anything else, sorts newest-first and keeps the $first doc per email.
+# The group stage therefore carries one small doc per email.
+#
+# `workflows` is written by the generation service, not by this app, so the
+# counts are maintained from a change stream (WorkflowCountWatcher): every
+# insert/update touching `workflows` recounts that one order. The nudge run then
+# only counts orders the watcher has not seen yet (created before it started);
+# a full recount of incomplete orders is the fallback when no stream is open.
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+NUDGE_WORKFLOW_COUNT = int(os.getenv("NUDGE_WORKFLOW_COUNT", "13"))
+
+_EMAIL_FILTER = {"$exists": True, "$ne": None, "$not": {"$regex": "@lhmm\\.in$", "$options": "i"}}
+
+# what send_nudge_batches reads from a candidate
+_CANDIDATE_FIELDS = (
+    "email", "name", "user_name", "job_id", "book_id", "preview_url",
+    "created_at", "paid", "nudge_stage", "nudge_history",
+    "workflows_count", "workflows_completed_count",
+)
+
+
+def workflows_completed_count_expr() -> Dict[str, Any]:
+    """Aggregation expression counting entries of `workflows` whose status is "completed"."""
+    return {"$size": {"$filter": {
+        "input": {"$objectToArray": {"$ifNull": ["$workflows", {}]}},
+        "as": "w",
+        "cond": {"$eq": ["$$w.v.status", "completed"]},
+    }}}
+
+
+def workflow_counts_update() -> List[Dict[str, Any]]:
+    """Pipeline update setting both counts from the doc's current `workflows`."""
+    return [{"$set": {
+        "workflows_count": {"$size": {"$objectToArray": {"$ifNull": ["$workflows", {}]}}},
+        "workflows_completed_count": workflows_completed_count_expr(),
+    }}]
+
+
+def refresh_workflow_counts(orders: Collection, since: datetime, full: bool = False) -> int:
+    """
+    Count workflows for unpaid orders in the window that have no counts yet; the
+    watcher keeps counted orders current. `full` also recounts every counted order
+    that is not complete -- the fallback when the watcher is not running.
+    """
+    uncounted = {"workflows_count": {"$exists": False}}
+    filt: Dict[str, Any] = {
+        "created_at": {"$gte": since},
+        "paid": {"$ne": True},
+        "workflows": {"$exists": True},
+    }
+    if full:
+        filt["$or"] = [
+            uncounted,
+            {"workflows_completed_count": {"$lt": NUDGE_WORKFLOW_COUNT}},
+            {"workflows_count": {"$ne": NUDGE_WORKFLOW_COUNT}},
+        ]
+    else:
+        filt.update(uncounted)
+    try:
+        res = orders.update_many(filt, workflow_counts_update())
+    except PyMongoError:
+        logger.exception("[NUDGE] workflow count refresh failed")
+        return 0
+    return res.modified_count
+
+
+def _touches_workflows(path_expr: str) -> Dict[str, Any]:
+    # "workflows" or "workflows.<name>...", but not our own workflows_* counters
+    return {"$or": [{"$eq": [path_expr, "workflows"]},
+                    {"$eq": [{"$substrCP": [path_expr, 0, 10]}, "workflows."]}]}
+
+
+_WORKFLOW_CHANGES = [
+    {"$match": {"$expr": {"$or": [
+        {"$in": ["$operationType", ["insert", "replace"]]},
+        {"$and": [
+            {"$eq": ["$operationType", "update"]},
+            {"$or": [
+                {"$gt": [{"$size": {"$filter": {
+                    "input": {"$objectToArray": {"$ifNull": ["$updateDescription.updatedFields", {}]}},
+                    "as": "f", "cond": _touches_workflows("$$f.k")}}}, 0]},
+                {"$gt": [{"$size": {"$filter": {
+                    "input": {"$ifNull": ["$updateDescription.removedFields", []]},
+                    "as": "r", "cond": _touches_workflows("$$r")}}}, 0]},
+            ]},
+        ]},
+    ]}}},
+    {"$project": {"documentKey": 1, "operationType": 1}},
+]
+
+
+class WorkflowCountWatcher:
+    """
+    Recounts an order's workflows whenever a change stream reports a write to
+    `workflows`. The resume token is stored in `state` so a restart continues
+    where it stopped; if it is too old to resume, the watcher starts fresh and
+    the next nudge run does a full recount.
+    """
+    STATE_ID = "workflow_counts"
+
+    def __init__(self, orders: Collection, state: Collection):
+        self._orders = orders
+        self._state = state
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._open = threading.Event()
+        self._gap = True  # changes may have been missed until the stream opens
+        self._opened_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        """True while the stream is open and no changes were missed since it opened."""
+        return self._open.is_set() and not self._gap
+
+    def caught_up(self, started: float) -> None:
+        """
+        Report a full recount that began at `started` (time.monotonic()). If the
+        stream was already open then, changes it missed are now reflected.
+        """
+        if self._open.is_set() and started >= self._opened_at:
+            self._gap = False
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="workflow-counts", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def _token(self) -> Optional[Dict[str, Any]]:
+        doc = self._state.find_one({"_id": self.STATE_ID}) or {}
+        return doc.get("resume_token")
+
+    def _save_token(self, token: Optional[Dict[str, Any]]) -> None:
+        if token is not None:
+            self._state.update_one(
+                {"_id": self.STATE_ID},
+                {"$set": {"resume_token": token, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                token = self._token()
+                try:
+                    stream = self._orders.watch(_WORKFLOW_CHANGES, resume_after=token, max_await_time_ms=1000)
+                except OperationFailure:
+                    if token is None:
+                        raise
+                    logger.warning("[NUDGE] workflow change stream cannot resume; starting fresh")
+                    stream = self._orders.watch(_WORKFLOW_CHANGES, max_await_time_ms=1000)
+                    token = None
+                with stream:
+                    self._gap = token is None
+                    self._opened_at = time.monotonic()
+                    self._open.set()
+                    backoff = 1.0
+                    last_saved = time.monotonic()
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            self._orders.update_one(
+                                {"_id": change["documentKey"]["_id"]}, workflow_counts_update())
+                        if time.monotonic() - last_saved >= 5:
+                            self._save_token(stream.resume_token)
+                            last_saved = time.monotonic()
+                    self._save_token(stream.resume_token)
+            except PyMongoError:
+                logger.exception("[NUDGE] workflow change stream failed; retrying in %.0fs", backoff)
+            finally:
+                self._open.clear()
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+
+def ensure_workflow_counts(orders: Collection, since: datetime, watcher: WorkflowCountWatcher) -> int:
+    """Counts for a nudge run: only uncounted orders while the watcher is running, else a full recount."""
+    started = time.monotonic()
+    full = not watcher.running
+    n = refresh_workflow_counts(orders, since, full=full)
+    if full:
+        watcher.caught_up(started)
+    return n
+
+
+def fetch_nudge_candidates(orders: Collection, since: datetime) -> List[Dict[str, Any]]:
+    """Latest order per email since `since`, for emails with no paid order and all workflows done."""
+    pipeline = [
+        {"$match": {
+            "created_at": {"$gte": since},
+            "email": _EMAIL_FILTER,
+            "workflows": {"$exists": True},
+        }},
+        # narrow first: nothing downstream sees `workflows` or the rest of the order
+        {"$project": {f: 1 for f in _CANDIDATE_FIELDS}},
+        {"$sort": {"email": 1, "created_at": -1}},
+        {"$group": {
+            "_id": "$email",
+            "latest": {"$first": "$$ROOT"},
+            "has_paid_order": {"$max": {"$cond": [{"$eq": ["$paid", True]}, 1, 0]}},
+        }},
+        {"$match": {"has_paid_order": 0}},
+        {"$replaceRoot": {"newRoot": "$latest"}},
+        {"$match": {
+            "paid": False,
+            "workflows_count": NUDGE_WORKFLOW_COUNT,
+            "workflows_completed_count": NUDGE_WORKFLOW_COUNT,
+            "$or": [{"nudge_stage": {"$exists": False}}, {"nudge_stage": {"$in": [0, 1]}}],
+        }},
+        {"$project": {
+            "_id": 0,
+            "email": 1,
+            "name": 1,
+            "user_name": 1,
+            "job_id": 1,
+            "book_id": 1,
+            "preview_url": 1,
+            "created_at": 1,
+            "nudge_stage": {"$ifNull": ["$nudge_stage", 0]},
+            "nudge_history": {"$ifNull": ["$nudge_history", []]},
+        }},
+    ]
+    return list(orders.aggregate(pipeline, allowDiskUse=True))
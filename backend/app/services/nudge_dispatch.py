@@ -0,0 +1,161 @@
+# app/services/nudge_dispatch.py
+#
+# Batched nudge dispatch.
+# send_nudge_batches used to send one nudge at a time, following every send
+# with an update_one to advance nudge_stage and up to two more for
+# nudge_history. A batch now claims its orders first -- one guarded UpdateOne
+# per order that advances nudge_stage and records the history entry, flushed
+# with a single bulk_write -- and only then enqueues the claimed sends,
+# concurrently on a pool of their own (its worker count is the in-flight
+# window; the shared fan-out pool is left to interactive requests). Sends that
+# fail to enqueue are rolled back with one more bulk_write.
+# Because the stage is advanced before a message reaches the email outbox,
+# record_parked() (run from the outbox's failed hook) can undo a parked nudge
+# with a single update; it never waits on this batch.
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from app.services.fanout import run_legs
+
+logger = logging.getLogger(__name__)
+
+NUDGE_BATCH_TIMEOUT_SECONDS = float(os.getenv("NUDGE_BATCH_TIMEOUT_SECONDS", "300"))
+NUDGE_MAX_WORKERS = int(os.getenv("NUDGE_MAX_WORKERS", "8"))
+
+_NUDGE_POOL = ThreadPoolExecutor(max_workers=NUDGE_MAX_WORKERS, thread_name_prefix="nudge")
+
+
+@dataclass
+class NudgeSend:
+    job_id: str
+    email: str
+    stage: int
+    from_stage: int
+    history_exists: bool  # candidate already has a nudge_history entry for `stage`
+    send: Callable[[], Any]
+
+
+def _history_entry(stage: int, status: str, error: Optional[str], now: datetime) -> Dict[str, Any]:
+    return {
+        "stage": stage,
+        "status": status,
+        "via": "email",
+        "attempts": 1,
+        "at": now,
+        "error": error[:1000] if error else None,
+    }
+
+
+def claim_op(item: NudgeSend, now: datetime) -> UpdateOne:
+    """Advance nudge_stage and record the attempt as sent, guarded on the stage it was planned from."""
+    # stage guard: a concurrent run that already advanced the order wins
+    filt: Dict[str, Any] = {
+        "job_id": item.job_id,
+        "nudge_stage": item.from_stage if item.from_stage else {"$in": [0, None]},
+    }
+    set_: Dict[str, Any] = {"nudge_stage": item.stage, "nudge_last_sent_at": now}
+    if item.history_exists:
+        filt["nudge_history.stage"] = item.stage
+        set_.update({
+            "nudge_history.$.status": "sent",
+            "nudge_history.$.at": now,
+            "nudge_history.$.error": None,
+        })
+        return UpdateOne(filt, {"$set": set_, "$inc": {"nudge_history.$.attempts": 1}})
+    return UpdateOne(filt, {"$set": set_,
+                            "$push": {"nudge_history": _history_entry(item.stage, "sent", None, now)}})
+
+
+def _rollback(
+    job_id: str, stage: int, from_stage: int, error: str, now: datetime,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Put nudge_stage back and mark the stage's history entry failed (the retry cap still applies)."""
+    return (
+        {"job_id": job_id, "nudge_stage": stage, "nudge_history.stage": stage},
+        {"$set": {
+            "nudge_stage": from_stage,
+            "nudge_history.$.status": "failed",
+            "nudge_history.$.at": now,
+            "nudge_history.$.error": error[:1000],
+        }},
+    )
+
+
+def record_parked(orders: Collection, job_id: str, stage: int, from_stage: int, error: str) -> bool:
+    """
+    A claimed nudge was parked by the outbox: roll the claim back so the stage can be
+    sent again. Returns False if the order moved on meanwhile.
+    """
+    filt, update = _rollback(job_id, stage, from_stage, error, datetime.now(timezone.utc))
+    return orders.update_one(filt, update).modified_count == 1
+
+
+def dispatch_batch(
+    orders: Collection,
+    items: List[NudgeSend],
+    timeout_s: float = NUDGE_BATCH_TIMEOUT_SECONDS,
+    on_sent: Optional[Callable[[List[NudgeSend]], None]] = None,
+) -> Dict[str, int]:
+    """
+    Claim a batch with one bulk_write, enqueue the claimed sends concurrently, then
+    roll back the ones that failed with one more. `on_sent` gets the successfully
+    sent items afterwards (best effort).
+    """
+    if not items:
+        return {"sent": 0, "failed": 0, "not_recorded": 0}
+
+    # millisecond precision, so the stamp reads back equal from Mongo
+    now = datetime.now(timezone.utc)
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    try:
+        orders.bulk_write([claim_op(it, now) for it in items], ordered=False)
+        claimed = {
+            d["job_id"] for d in orders.find(
+                {"job_id": {"$in": [it.job_id for it in items]}, "nudge_last_sent_at": now},
+                {"job_id": 1, "_id": 0},
+            )
+        }
+    except PyMongoError:
+        logger.exception("[NUDGE] claiming %d orders failed; nothing sent", len(items))
+        return {"sent": 0, "failed": 0, "not_recorded": len(items)}
+
+    to_send = [it for it in items if it.job_id in claimed]
+    not_recorded = len(items) - len(to_send)
+    if not_recorded:
+        # guard misses: the order's stage moved under us (another run, or a manual change)
+        logger.warning("[NUDGE] %d of %d orders not claimed; skipped", not_recorded, len(items))
+
+    results = run_legs({it.job_id: it.send for it in to_send}, timeout_s=timeout_s, label="NUDGE",
+                       pool=_NUDGE_POOL)
+    rollbacks = []
+    sent_items: List[NudgeSend] = []
+    for it in to_send:
+        res = results[it.job_id]
+        if res.ok:
+            sent_items.append(it)
+            logger.info("[NUDGE] sent stage %d to %s (job_id=%s)", it.stage, it.email, it.job_id)
+        else:
+            logger.warning("[NUDGE] stage %d to %s failed (job_id=%s): %s",
+                           it.stage, it.email, it.job_id, res.error)
+            rollbacks.append(UpdateOne(*_rollback(it.job_id, it.stage, it.from_stage,
+                                                  res.error or "unknown error", datetime.now(timezone.utc))))
+
+    if rollbacks:
+        try:
+            orders.bulk_write(rollbacks, ordered=False)
+        except PyMongoError:
+            logger.exception("[NUDGE] rolling back %d failed sends failed", len(rollbacks))
+    if on_sent is not None and sent_items:
+        try:
+            on_sent(sent_items)
+        except Exception:
+            logger.exception("[NUDGE] on_sent callback failed")
+    return {"sent": len(sent_items), "failed": len(rollbacks), "not_recorded": not_recorded}
@@ -0,0 +1,53 @@
+# app/services/order_reconcile.py
+#
+# Marking orders as reconciled against a Razorpay payment.
+# Shared by the /reconcile/mark route and the auto-reconcile job, which used to
+# reach the same logic by POSTing back to our own API.
+import logging
+from datetime import datetime, timezone
+from typing import Iterable, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.results import UpdateResult
+
+from app.services.timing import timed
+
+logger = logging.getLogger(__name__)
+
+
+def _mark_update(razorpay_payment_id: Optional[str], now: datetime) -> dict:
+    update = {
+        "reconcile": True,
+        "reconciled_at": now,
+    }
+    if razorpay_payment_id:
+        # doesn’t overwrite the verify logic—just stores the payment id on the order
+        update["transaction_id"] = razorpay_payment_id
+    return {"$set": update}
+
+
+@timed("order_reconcile.mark_reconciled")
+def mark_reconciled(
+    collection: Collection,
+    job_id: str,
+    razorpay_payment_id: Optional[str] = None,
+) -> UpdateResult:
+    return collection.update_one(
+        {"job_id": job_id},
+        _mark_update(razorpay_payment_id, datetime.now(timezone.utc)),
+    )
+
+
+@timed("order_reconcile.mark_reconciled_many")
+def mark_reconciled_many(collection: Collection, pairs: Iterable[Tuple[str, str]]) -> int:
+    """Bulk variant for (payment_id, job_id) pairs; returns matched count."""
+    now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne({"job_id": job_id}, _mark_update(payment_id, now))
+        for payment_id, job_id in pairs
+        if job_id
+    ]
+    if not ops:
+        return 0
+    return collection.bulk_write(ops, ordered=False).matched_count
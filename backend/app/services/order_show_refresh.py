@@ -0,0 +1,177 @@
+# app/services/order_show_refresh.py
+#
+# Debounced, coalesced Shiprocket order/show refreshes.
+# Every tracking event used to re-fetch the order from Shiprocket (login + fetch
+# + full shiprocket_raw upsert), although courier and charges rarely change after
+# the first sync. Events now only mark the order as "wants refresh" (one doc per
+# order in a queue collection, so a burst of scans coalesces into one entry).
+# A scheduler tick picks entries that have been quiet for the debounce window,
+# skips orders whose stored data is still fresh, and refreshes the rest in
+# bounded batches on the fan-out pool.
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, Callable, Dict, List
+
+from fastapi import HTTPException
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from app.services.fanout import run_legs
+from app.services.run_lease import RunLease
+
+logger = logging.getLogger(__name__)
+
+SR_REFRESH_DEBOUNCE_SECONDS = int(os.getenv("SR_REFRESH_DEBOUNCE_SECONDS", "120"))
+# a burst that never goes quiet is still refreshed after this long
+SR_REFRESH_MAX_WAIT_SECONDS = int(os.getenv("SR_REFRESH_MAX_WAIT_SECONDS", "900"))
+SR_REFRESH_FRESH_SECONDS = int(os.getenv("SR_REFRESH_FRESH_SECONDS", str(6 * 3600)))
+SR_REFRESH_BATCH_SIZE = int(os.getenv("SR_REFRESH_BATCH_SIZE", "20"))
+SR_REFRESH_BATCH_TIMEOUT_SECONDS = float(os.getenv("SR_REFRESH_BATCH_TIMEOUT_SECONDS", "120"))
+SR_REFRESH_MAX_ATTEMPTS = 5
+
+
+class OrderShowRefresher:
+    def __init__(
+        self,
+        queue_collection: Collection,
+        shipping_collection: Collection,
+        refresh: Callable[[str], Any],
+        lease: RunLease,
+        debounce_seconds: int = SR_REFRESH_DEBOUNCE_SECONDS,
+        fresh_seconds: int = SR_REFRESH_FRESH_SECONDS,
+        batch_size: int = SR_REFRESH_BATCH_SIZE,
+    ):
+        self._queue = queue_collection
+        self._shipping = shipping_collection
+        self._refresh = refresh
+        self._lease = lease
+        self._debounce = timedelta(seconds=debounce_seconds)
+        self._max_wait = timedelta(seconds=max(debounce_seconds, SR_REFRESH_MAX_WAIT_SECONDS))
+        self._fresh = timedelta(seconds=fresh_seconds)
+        self._batch_size = max(1, batch_size)
+        self._indexes_ready = False
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._queue.create_index([("last_requested_at", ASCENDING)], name="last_requested_at")
+            self._queue.create_index([("first_requested_at", ASCENDING)], name="first_requested_at")
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[SR-REFRESH] create_index failed; continuing without it")
+
+    def request(self, internal_order_id: str) -> None:
+        """Ask for a refresh; repeated calls for the same order coalesce into one entry."""
+        if not internal_order_id:
+            return
+        now = datetime.now(timezone.utc)
+        self._queue.update_one(
+            {"_id": internal_order_id},
+            {
+                "$set": {"last_requested_at": now},
+                "$setOnInsert": {"first_requested_at": now, "attempts": 0},
+                "$inc": {"requests": 1},
+            },
+            upsert=True,
+        )
+
+    def _due(self, now: datetime) -> List[Dict[str, Any]]:
+        return list(
+            self._queue.find({
+                "$or": [
+                    {"last_requested_at": {"$lte": now - self._debounce}},
+                    {"first_requested_at": {"$lte": now - self._max_wait}},
+                ]
+            })
+            .sort("first_requested_at", ASCENDING)
+            .limit(self._batch_size)
+        )
+
+    def _fresh_ids(self, ids: List[str], now: datetime) -> set:
+        cur = self._shipping.find(
+            {
+                "order_id": {"$in": ids},
+                "shiprocket_synced_at": {"$gte": now - self._fresh},
+                "courier_name": {"$nin": [None, ""]},
+            },
+            {"order_id": 1, "_id": 0},
+        )
+        return {d["order_id"] for d in cur}
+
+    def _done(self, entry: Dict[str, Any]) -> None:
+        # a request that arrived while we were refreshing keeps the entry alive
+        self._queue.delete_one({"_id": entry["_id"], "last_requested_at": entry["last_requested_at"]})
+
+    def _retry_later(self, entry: Dict[str, Any], err: str) -> None:
+        attempts = int(entry.get("attempts") or 0) + 1
+        if attempts >= SR_REFRESH_MAX_ATTEMPTS:
+            logger.warning("[SR-REFRESH] giving up on %s after %d attempts: %s", entry["_id"], attempts, err)
+            self._queue.delete_one({"_id": entry["_id"]})
+            return
+        now = datetime.now(timezone.utc)
+        self._queue.update_one(
+            {"_id": entry["_id"]},
+            # pushes it one debounce window out and stops it counting as overdue
+            {"$set": {"attempts": attempts, "last_error": err,
+                      "last_requested_at": now, "first_requested_at": now}},
+        )
+
+    def _run_batch(self, now: datetime) -> int:
+        due = self._due(now)
+        if not due:
+            return 0
+        ids = [e["_id"] for e in due]
+        fresh = self._fresh_ids(ids, now)
+        stale = [e for e in due if e["_id"] not in fresh]
+        for e in due:
+            if e["_id"] in fresh:
+                self._done(e)
+
+        results = run_legs(
+            {e["_id"]: partial(self._refresh, e["_id"]) for e in stale},
+            timeout_s=SR_REFRESH_BATCH_TIMEOUT_SECONDS,
+            label="SR-REFRESH",
+        ) if stale else {}
+
+        for e in stale:
+            res = results[e["_id"]]
+            if res.ok:
+                self._done(e)
+            else:
+                self._retry_later(e, res.error or "unknown error")
+        logger.info("[SR-REFRESH] batch: %d due, %d fresh (skipped), %d refreshed, %d failed",
+                    len(due), len(fresh), sum(1 for r in results.values() if r.ok),
+                    sum(1 for r in results.values() if not r.ok))
+        return len(due)
+
+    def tick(self) -> None:
+        """Scheduler entry point: drain due entries batch by batch under a lease."""
+        token = self._lease.acquire()
+        if token is None:
+            return
+        try:
+            self._ensure_indexes()
+            while self._run_batch(datetime.now(timezone.utc)) >= self._batch_size:
+                pass
+        except PyMongoError:
+            logger.exception("[SR-REFRESH] tick failed")
+        finally:
+            self._lease.release(token)
+
+
+def refresh_order_show(sync: Callable[[str], Any], internal_order_id: str) -> Any:
+    """
+    Wrap sync_order_show for the refresher: 4xx answers (order unknown, no Shiprocket
+    order linked) are final and must not be retried.
+    """
+    try:
+        return sync(internal_order_id)
+    except HTTPException as e:
+        if 400 <= e.status_code < 500:
+            logger.info("[SR-REFRESH] %s not refreshable: %s", internal_order_id, e.detail)
+            return None
+        raise
@@ -0,0 +1,164 @@
+# app/services/pivot_cache.py
+#
+# Cache of finalized IST hours for the hourly request pivot.
+# An IST hour that ended more than `settle` ago can never change, so its
+# (source, IST date, hour) count is stored once in Mongo and reused by every
+# later export. Only the still-open edges of a window hit the source cluster.
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from app.services.hourly_pivot import HourlyCounts, fetch_hourly_counts, fetch_hourly_rows
+
+logger = logging.getLogger(__name__)
+
+IST_OFFSET = timedelta(hours=5, minutes=30)
+ONE_HOUR = timedelta(hours=1)
+PIVOT_CACHE_SETTLE_MINUTES = int(os.getenv("PIVOT_CACHE_SETTLE_MINUTES", "10"))
+
+
+def _floor_ist_hour(dt_utc: datetime) -> datetime:
+    """Naive-UTC start of the IST hour containing dt_utc (IST hours begin at UTC hh:30)."""
+    ist = dt_utc + IST_OFFSET
+    return ist.replace(minute=0, second=0, microsecond=0) - IST_OFFSET
+
+
+def _ceil_ist_hour(dt_utc: datetime) -> datetime:
+    floor = _floor_ist_hour(dt_utc)
+    return floor if floor == dt_utc else floor + ONE_HOUR
+
+
+def _ist_key(hour_start_utc: datetime) -> Tuple[str, int]:
+    ist = hour_start_utc + IST_OFFSET
+    return ist.strftime("%Y-%m-%d"), ist.hour
+
+
+def _naive_utc(dt: datetime) -> datetime:
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+class HourlyPivotCache:
+    """
+    Mongo-backed store of finalized hourly counts, one doc per (source, hour_start):
+      {source, hour_start (UTC), ist_date "YYYY-MM-DD", hour 0..23, count, docs, cached_at}
+
+    Zero-count hours are stored too, so "hour is cached" and "hour had no traffic"
+    are distinguishable and empty hours are never re-queried.
+    """
+
+    def __init__(self, cache_collection: Collection, settle_minutes: int = PIVOT_CACHE_SETTLE_MINUTES):
+        self._coll = cache_collection
+        self._settle = timedelta(minutes=settle_minutes)
+        self._indexes_ready = False
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index(
+                [("source", ASCENDING), ("hour_start", ASCENDING)],
+                unique=True, name="source_hour_start_uniq",
+            )
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[PIVOT-CACHE] create_index failed; continuing without it")
+
+    def hourly_counts(
+        self,
+        source: str,
+        collection: Collection,
+        from_dt: datetime,
+        to_dt: datetime,
+        now: Optional[datetime] = None,
+    ) -> Tuple[HourlyCounts, int]:
+        """
+        Same contract as fetch_hourly_counts(collection, from_dt, to_dt): counts for
+        the inclusive naive-UTC window plus the number of matched docs.
+        Finalized whole IST hours come from the cache (missing ones are filled with a
+        single aggregation and stored); the partial head/tail is always queried live.
+        """
+        now = _naive_utc(now) if now else datetime.utcnow()
+        cutoff = _floor_ist_hour(now - self._settle)
+        lo = _ceil_ist_hour(from_dt)
+        hi = min(_floor_ist_hour(to_dt), cutoff)
+        if lo >= hi:
+            return fetch_hourly_counts(collection, from_dt, to_dt)
+
+        self._ensure_indexes()
+        counts: HourlyCounts = {}
+        matched = 0
+
+        def _add(key: Tuple[str, int], n: int, docs: int) -> None:
+            nonlocal matched
+            counts[key] = counts.get(key, 0) + n
+            matched += docs
+
+        # head: [from_dt, lo) — only when the window does not start on an IST hour
+        if from_dt < lo:
+            head, head_docs = fetch_hourly_counts(collection, from_dt, lo, inclusive_end=False)
+            for key, n in head.items():
+                _add(key, n, 0)
+            matched += head_docs
+
+        # finalized hours: [lo, hi)
+        cached: Dict[datetime, Dict] = {}
+        try:
+            for doc in self._coll.find(
+                {"source": source, "hour_start": {"$gte": lo, "$lt": hi}},
+                {"_id": 0, "hour_start": 1, "ist_date": 1, "hour": 1, "count": 1, "docs": 1},
+            ):
+                cached[_naive_utc(doc["hour_start"])] = doc
+        except PyMongoError:
+            logger.exception("[PIVOT-CACHE] read failed for %s; querying source directly", source)
+
+        n_hours = int((hi - lo) / ONE_HOUR)
+        wanted = [lo + i * ONE_HOUR for i in range(n_hours)]
+        missing = [h for h in wanted if h not in cached]
+        for h in wanted:
+            doc = cached.get(h)
+            if doc is not None and (doc.get("count") or doc.get("docs")):
+                _add((doc["ist_date"], int(doc["hour"])), int(doc["count"]), int(doc.get("docs") or 0))
+
+        if missing:
+            fill_from, fill_to = missing[0], missing[-1] + ONE_HOUR
+            fetched = {
+                (r["d"], r["h"]): r
+                for r in fetch_hourly_rows(collection, fill_from, fill_to, inclusive_end=False)
+            }
+            ops: List[UpdateOne] = []
+            cached_at = datetime.utcnow()
+            for h in missing:
+                key = _ist_key(h)
+                row = fetched.get(key) or {}
+                n, docs = int(row.get("count") or 0), int(row.get("docs") or 0)
+                if n or docs:
+                    _add(key, n, docs)
+                ops.append(UpdateOne(
+                    {"source": source, "hour_start": h},
+                    {"$set": {
+                        "ist_date": key[0], "hour": key[1],
+                        "count": n, "docs": docs, "cached_at": cached_at,
+                    }},
+                    upsert=True,
+                ))
+            try:
+                self._coll.bulk_write(ops, ordered=False)
+            except PyMongoError:
+                logger.exception("[PIVOT-CACHE] write failed for %s (%d hours)", source, len(ops))
+            logger.info("[PIVOT-CACHE] %s: %d cached hours, %d filled",
+                        source, n_hours - len(missing), len(missing))
+
+        # tail: [hi, to_dt] — open / not-yet-settled hours, never cached
+        tail, tail_docs = fetch_hourly_counts(collection, hi, to_dt)
+        for key, n in tail.items():
+            _add(key, n, 0)
+        matched += tail_docs
+
+        return counts, matched
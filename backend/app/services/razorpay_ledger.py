@@ -0,0 +1,194 @@
+# app/services/razorpay_ledger.py
+#
+# Local copy of Razorpay payments, kept in Mongo and synced incrementally.
+# The state doc tracks the created_at range already mirrored
+# ([covered_from, covered_to], unix seconds). Each read first pulls only what is
+# missing: a forward sync from covered_to - overlap (the overlap re-reads recent
+# payments so status changes such as authorized -> captured are picked up) and,
+# if the caller asks for older data than we hold, a one-off backfill.
+# Refunds usually land days after the payment, past that overlap, so every
+# RZP_LEDGER_REFRESH_INTERVAL the last RZP_LEDGER_REFRESH_DAYS of payments are
+# re-pulled as well. Status and refund fields of payments older than that are
+# only as fresh as their last pull.
+# Reads are then plain indexed Mongo queries instead of re-downloading history.
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import DESCENDING, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+RZP_LEDGER_OVERLAP_SECONDS = int(os.getenv("RZP_LEDGER_OVERLAP_SECONDS", str(2 * 3600)))
+RZP_LEDGER_MIN_SYNC_INTERVAL = int(os.getenv("RZP_LEDGER_MIN_SYNC_INTERVAL", "60"))
+RZP_LEDGER_REFRESH_DAYS = int(os.getenv("RZP_LEDGER_REFRESH_DAYS", "15"))
+RZP_LEDGER_REFRESH_INTERVAL = int(os.getenv("RZP_LEDGER_REFRESH_INTERVAL", str(6 * 3600)))
+RZP_LEDGER_SYNC_MAX_FETCH = 1_000_000
+
+# fetch_payments(client, *, status_filter, from_unix, to_unix, max_fetch) -> list
+PaymentsFetcher = Callable[..., Awaitable[List[Dict[str, Any]]]]
+
+
+class RazorpayLedger:
+    STATE_ID = "payments"
+
+    def __init__(
+        self,
+        payments_collection: Collection,
+        state_collection: Collection,
+        fetcher: PaymentsFetcher,
+        overlap_seconds: int = RZP_LEDGER_OVERLAP_SECONDS,
+        min_sync_interval: int = RZP_LEDGER_MIN_SYNC_INTERVAL,
+        refresh_days: int = RZP_LEDGER_REFRESH_DAYS,
+        refresh_interval: int = RZP_LEDGER_REFRESH_INTERVAL,
+    ):
+        self._coll = payments_collection
+        self._state_coll = state_collection
+        self._fetch = fetcher
+        self._overlap = overlap_seconds
+        self._min_interval = min_sync_interval
+        self._refresh_window = max(0, refresh_days) * 86400
+        self._refresh_interval = refresh_interval
+        self._lock = asyncio.Lock()
+        self._indexes_ready = False
+
+    # ---- storage ----
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index([("created_at", DESCENDING)], name="created_at_desc")
+            self._coll.create_index(
+                [("status", 1), ("created_at", DESCENDING)], name="status_created_at")
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[RZP-LEDGER] create_index failed; continuing without it")
+
+    def _state(self) -> Dict[str, Any]:
+        return self._state_coll.find_one({"_id": self.STATE_ID}) or {}
+
+    def _save_state(self, **fields: Any) -> None:
+        fields["updated_at"] = datetime.now(timezone.utc)
+        self._state_coll.update_one({"_id": self.STATE_ID}, {"$set": fields}, upsert=True)
+
+    def _upsert(self, payments: List[Dict[str, Any]]) -> int:
+        now = datetime.now(timezone.utc)
+        ops = []
+        for p in payments:
+            pid = p.get("id")
+            if not pid:
+                continue
+            doc = dict(p)
+            doc["_synced_at"] = now
+            ops.append(UpdateOne({"_id": pid}, {"$set": doc}, upsert=True))
+        for i in range(0, len(ops), 1000):
+            self._coll.bulk_write(ops[i:i + 1000], ordered=False)
+        return len(ops)
+
+    async def _pull(self, client, from_unix: Optional[int], to_unix: Optional[int]) -> int:
+        t0 = time.perf_counter()
+        payments = await self._fetch(
+            client,
+            status_filter=None,  # keep every status; filtering happens on read
+            from_unix=from_unix,
+            to_unix=to_unix,
+            max_fetch=RZP_LEDGER_SYNC_MAX_FETCH,
+        )
+        n = await asyncio.to_thread(self._upsert, payments)
+        logger.info("[RZP-LEDGER] synced %d payments for [%s, %s] in %.0fms",
+                    n, from_unix, to_unix, (time.perf_counter() - t0) * 1000.0)
+        return n
+
+    # ---- sync ----
+    async def ensure_covered(self, client, from_unix: Optional[int], to_unix: Optional[int]) -> None:
+        """Make sure [from_unix, to_unix] (None = open-ended) is mirrored locally."""
+        async with self._lock:
+            self._ensure_indexes()
+            now = int(time.time())
+            st = await asyncio.to_thread(self._state)
+            want_from = from_unix if from_unix is not None else 0
+
+            if not st:
+                await self._pull(client, from_unix, now)
+                await asyncio.to_thread(self._save_state, covered_from=want_from, covered_to=now,
+                                        refreshed_at=now)
+                return
+
+            covered_from = int(st.get("covered_from") or 0)
+            covered_to = int(st.get("covered_to") or 0)
+
+            # rolling refresh: re-pull recent, already-settled payments for late refunds
+            # and status changes (also moves the forward edge to now)
+            if self._refresh_window and now - int(st.get("refreshed_at") or 0) >= self._refresh_interval:
+                await self._pull(client, max(covered_from, now - self._refresh_window), now)
+                await asyncio.to_thread(self._save_state, covered_to=now, refreshed_at=now)
+                covered_to = now
+
+            # forward: only when the window reaches into not-yet-settled data
+            if (to_unix is None or to_unix >= covered_to - self._overlap) \
+                    and now - covered_to >= self._min_interval:
+                await self._pull(client, max(0, covered_to - self._overlap), now)
+                await asyncio.to_thread(self._save_state, covered_to=now)
+
+            # backward: caller wants older payments than we hold
+            if want_from < covered_from:
+                await self._pull(client, from_unix, covered_from)
+                await asyncio.to_thread(self._save_state, covered_from=want_from)
+
+    async def sync(self, client) -> None:
+        """Forward-only sync (for schedulers)."""
+        await self.ensure_covered(client, int(time.time()), None)
+
+    # ---- read ----
+    def _query(
+        self,
+        status_filter: Optional[str],
+        from_unix: Optional[int],
+        to_unix: Optional[int],
+        max_fetch: int,
+    ) -> List[Dict[str, Any]]:
+        q: Dict[str, Any] = {}
+        rng: Dict[str, int] = {}
+        if from_unix is not None:
+            rng["$gte"] = from_unix
+        if to_unix is not None:
+            rng["$lte"] = to_unix
+        if rng:
+            q["created_at"] = rng
+        if status_filter:
+            q["status"] = status_filter.lower()
+        cur = (self._coll.find(q, {"_id": 0, "_synced_at": 0})
+               .sort("created_at", DESCENDING)  # Razorpay list order
+               .limit(max_fetch))
+        return list(cur)
+
+    async def payments(
+        self,
+        client,
+        *,
+        status_filter: Optional[str],
+        from_unix: Optional[int],
+        to_unix: Optional[int],
+        max_fetch: int = 10000,
+    ) -> List[Dict[str, Any]]:
+        """
+        Drop-in for fetch_payments(): sync what is missing, then read from Mongo.
+        Falls back to a live Razorpay fetch if the ledger is unavailable.
+        """
+        try:
+            await self.ensure_covered(client, from_unix, to_unix)
+            return await asyncio.to_thread(self._query, status_filter, from_unix, to_unix, max_fetch)
+        except PyMongoError:
+            logger.exception("[RZP-LEDGER] Mongo unavailable; fetching from Razorpay directly")
+            return await self._fetch(
+                client,
+                status_filter=status_filter,
+                from_unix=from_unix,
+                to_unix=to_unix,
+                max_fetch=max_fetch,
+            )
@@ -0,0 +1,63 @@
+# app/services/run_lease.py
+#
+# Mongo-backed mutual exclusion for scheduled jobs.
+# APScheduler's max_instances only guards one process; with several uvicorn
+# workers (or a run that outlives its trigger interval) the same job can start
+# twice. A lease is one doc per job name holding an owner and an expiry; a new
+# run takes it only when it is free or expired, otherwise it skips cleanly.
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class RunLease:
+    def __init__(self, collection: Collection, name: str, ttl_seconds: int):
+        self._coll = collection
+        self.name = name
+        self._ttl = timedelta(seconds=ttl_seconds)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def acquire(self) -> Optional[str]:
+        """
+        Take the lease if free/expired. Never raises; returns this run's owner token,
+        or None when held elsewhere. The token is per call, so overlapping runs in one
+        process (the same instance) cannot release each other's lease.
+        """
+        now = datetime.now(timezone.utc)
+        token = f"{self.owner}:{uuid.uuid4().hex[:8]}"
+        try:
+            self._coll.find_one_and_update(
+                {"_id": self.name, "expires_at": {"$lte": now}},
+                {"$set": {"owner": token, "acquired_at": now, "expires_at": now + self._ttl}},
+                upsert=True,
+            )
+            return token
+        except DuplicateKeyError:
+            # doc exists and is held by someone else (the filter did not match, upsert collided)
+            return None
+        except PyMongoError:
+            logger.exception("[LEASE] %s: acquire failed", self.name)
+            return None
+
+    def release(self, token: Optional[str]) -> None:
+        if not token:
+            return
+        try:
+            self._coll.update_one(
+                {"_id": self.name, "owner": token},
+                {"$set": {"expires_at": datetime.now(timezone.utc)}},
+            )
+        except PyMongoError:
+            logger.exception("[LEASE] %s: release failed (expires on its own)", self.name)
+
+    def holder(self) -> Optional[str]:
+        doc = self._coll.find_one({"_id": self.name}, {"owner": 1, "expires_at": 1})
+        return (doc or {}).get("owner")
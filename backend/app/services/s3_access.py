@@ -0,0 +1,153 @@
+# app/services/s3_access.py
+#
+# Shared S3 access for the admin views.
+# Every helper used to build a fresh boto3 client, and every input image was
+# head_object'ed (serially) before being signed, so opening an order cost 6-10
+# S3 round-trips. Here:
+#   - one client per region for the whole process (boto3 clients are thread-safe);
+#   - presigned URLs are cached per (bucket, key, expiry, params) and re-signed
+#     once less than S3_PRESIGN_REFRESH_FRACTION of their lifetime is left;
+#   - existence is remembered in a known-keys cache (longer for hits, short for
+#     misses); keys not in it are head_object'ed concurrently on a HEAD pool of
+#     their own, so a big round cannot queue ahead of other fan-outs.
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from app.services.fanout import run_legs
+
+logger = logging.getLogger(__name__)
+
+S3_PRESIGN_REFRESH_FRACTION = float(os.getenv("S3_PRESIGN_REFRESH_FRACTION", "0.2"))
+S3_KNOWN_KEY_TTL_SECONDS = int(os.getenv("S3_KNOWN_KEY_TTL_SECONDS", "3600"))
+S3_MISSING_KEY_TTL_SECONDS = int(os.getenv("S3_MISSING_KEY_TTL_SECONDS", "60"))
+S3_HEAD_TIMEOUT_SECONDS = float(os.getenv("S3_HEAD_TIMEOUT_SECONDS", "10"))
+S3_HEAD_MAX_WORKERS = int(os.getenv("S3_HEAD_MAX_WORKERS", "16"))
+_CACHE_MAX_ENTRIES = 20_000
+
+MISSING_CODES = ("404", "NoSuchKey", "NotFound", "AccessDenied")
+
+_CLIENT_CONFIG = Config(retries={"max_attempts": 3, "mode": "standard"},
+                        max_pool_connections=max(10, S3_HEAD_MAX_WORKERS))
+# keys per HEAD round: a few requests per worker, well inside one timeout
+_HEAD_CHUNK = S3_HEAD_MAX_WORKERS * 4
+_HEAD_POOL = ThreadPoolExecutor(max_workers=S3_HEAD_MAX_WORKERS, thread_name_prefix="s3-head")
+
+
+class S3Access:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Any] = {}
+        # (bucket, key, expires_in, params) -> (url, refresh_at)
+        self._urls: Dict[Tuple[str, str, int, Tuple], Tuple[str, float]] = {}
+        # (bucket, key) -> (exists, valid_until)
+        self._known: Dict[Tuple[str, str], Tuple[bool, float]] = {}
+
+    # ---- clients ----
+    def client(self, region: str) -> Any:
+        c = self._clients.get(region)
+        if c is None:
+            with self._lock:
+                c = self._clients.get(region)
+                if c is None:
+                    c = self._clients[region] = boto3.client("s3", region_name=region, config=_CLIENT_CONFIG)
+        return c
+
+    # ---- presigned URLs ----
+    def presign(self, region: str, bucket: str, key: str, expires_in: int = 3600, **params: Any) -> str:
+        """Presigned GET URL, reused until it gets close to expiry. Signing errors propagate."""
+        ck = (bucket, key, int(expires_in), tuple(sorted(params.items())))
+        now = time.monotonic()
+        hit = self._urls.get(ck)
+        if hit is not None and hit[1] > now:
+            return hit[0]
+        url = self.client(region).generate_presigned_url(
+            "get_object",
+            Params={"Bucket": bucket, "Key": key, **params},
+            ExpiresIn=int(expires_in),
+        )
+        if len(self._urls) >= _CACHE_MAX_ENTRIES:
+            self._urls.clear()
+        self._urls[ck] = (url, now + expires_in * (1.0 - S3_PRESIGN_REFRESH_FRACTION))
+        return url
+
+    # ---- existence ----
+    def remember(self, bucket: str, keys: Iterable[str], exists: bool = True) -> None:
+        """Record keys known to exist (e.g. just listed or written) so no HEAD is needed."""
+        ttl = S3_KNOWN_KEY_TTL_SECONDS if exists else S3_MISSING_KEY_TTL_SECONDS
+        until = time.monotonic() + ttl
+        if len(self._known) >= _CACHE_MAX_ENTRIES:
+            self._known.clear()
+        for k in keys:
+            self._known[(bucket, k)] = (exists, until)
+
+    def existing(self, region: str, bucket: str, keys: List[str]) -> Set[str]:
+        """
+        Subset of `keys` that exist. Unknown keys are HEAD-checked concurrently, in
+        chunks that each get their own S3_HEAD_TIMEOUT_SECONDS. A missing/forbidden
+        key is just absent from the result, and so is one whose HEAD timed out (it
+        is not remembered, so the next call retries it). Any other error
+        (credentials, throttling) is raised as-is.
+        """
+        now = time.monotonic()
+        found: Set[str] = set()
+        unknown: List[str] = []
+        for k in dict.fromkeys(keys):
+            hit = self._known.get((bucket, k))
+            if hit is not None and hit[1] > now:
+                if hit[0]:
+                    found.add(k)
+            else:
+                unknown.append(k)
+        if not unknown:
+            return found
+
+        s3 = self.client(region)
+
+        def _head(key: str):
+            try:
+                s3.head_object(Bucket=bucket, Key=key)
+                return True
+            except ClientError as e:
+                code = getattr(e, "response", {}).get("Error", {}).get("Code")
+                if code in MISSING_CODES:
+                    return False
+                return e
+            except Exception as e:
+                return e
+
+        timed_out = 0
+        for i in range(0, len(unknown), _HEAD_CHUNK):
+            chunk = unknown[i:i + _HEAD_CHUNK]
+            results = run_legs({k: (lambda k=k: _head(k)) for k in chunk},
+                               timeout_s=S3_HEAD_TIMEOUT_SECONDS, label="S3-HEAD", pool=_HEAD_POOL)
+            hits, misses = [], []
+            for k in chunk:
+                res = results[k]
+                if not res.ok:
+                    timed_out += 1
+                    continue
+                if isinstance(res.value, Exception):
+                    raise res.value
+                (hits if res.value else misses).append(k)
+            self.remember(bucket, hits, exists=True)
+            self.remember(bucket, misses, exists=False)
+            found.update(hits)
+        if timed_out:
+            logger.warning("[S3-HEAD] %d of %d keys in %s timed out; skipped", timed_out, len(unknown), bucket)
+        return found
+
+    def presign_existing(self, region: str, bucket: str, keys: List[str], expires_in: int = 3600) -> Dict[str, str]:
+        """{key: url} for the keys that exist; one concurrent existence round for the lot."""
+        present = self.existing(region, bucket, keys)
+        return {k: self.presign(region, bucket, k, expires_in) for k in keys if k in present}
+
+
+s3_access = S3Access()
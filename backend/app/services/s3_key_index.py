@@ -0,0 +1,196 @@
+# app/services/s3_key_index.py
+#
+# Known S3 output keys per job, kept in Mongo (`s3_key_index`).
+# Finding a job's cover used to page list_objects_v2 over up to 2,000 objects
+# under jpg_output/{job_id}_pg0_, and unapprove listed the output folders
+# again, on every request. One doc per (bucket, prefix) now holds the keys with
+# their LastModified. It is filled from a full listing on first access, or up
+# front by whatever writes the objects (record()). Moves update it in place.
+#
+#   {_id: "bucket/prefix", bucket, prefix, job_id, objects: [{k, m}], listed_at}
+#
+# A prefix that listed empty is only trusted briefly, since generation may
+# still be writing; a non-empty listing is trusted for S3_KEY_INDEX_TTL_SECONDS.
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+from app.services.fanout import run_legs
+
+logger = logging.getLogger(__name__)
+
+S3_KEY_INDEX_TTL_SECONDS = int(os.getenv("S3_KEY_INDEX_TTL_SECONDS", str(6 * 3600)))
+S3_KEY_INDEX_EMPTY_TTL_SECONDS = int(os.getenv("S3_KEY_INDEX_EMPTY_TTL_SECONDS", "300"))
+S3_LIST_MAX_KEYS = 2000
+S3_LIST_TIMEOUT_SECONDS = float(os.getenv("S3_LIST_TIMEOUT_SECONDS", "20"))
+
+
+def list_all(s3: Any, bucket: str, prefix: str, max_collect: int = S3_LIST_MAX_KEYS) -> List[Dict[str, Any]]:
+    """Every object under `prefix` (following continuation tokens), up to max_collect."""
+    out: List[Dict[str, Any]] = []
+    token: Optional[str] = None
+    while True:
+        kwargs = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": 1000}
+        if token:
+            kwargs["ContinuationToken"] = token
+        resp = s3.list_objects_v2(**kwargs)
+        out.extend(resp.get("Contents", []) or [])
+        if not resp.get("IsTruncated") or len(out) >= max_collect:
+            break
+        token = resp.get("NextContinuationToken")
+    return out[:max_collect]
+
+
+class S3KeyIndex:
+    def __init__(self, collection: Collection):
+        self._coll = collection
+        self._indexes_ready = False
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index([("job_id", ASCENDING)], name="job_id")
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[S3-INDEX] create_index failed; continuing without it")
+
+    @staticmethod
+    def _id(bucket: str, prefix: str) -> str:
+        return f"{bucket}/{prefix}"
+
+    def objects(
+        self,
+        s3: Any,
+        bucket: str,
+        prefix: str,
+        job_id: Optional[str] = None,
+        max_collect: int = S3_LIST_MAX_KEYS,
+    ) -> List[Dict[str, Any]]:
+        """
+        Objects under `prefix` as [{"Key", "LastModified"}] (the list_objects_v2 shape).
+        Served from the index when fresh; otherwise listed once and stored.
+        """
+        self._ensure_indexes()
+        now = datetime.now(timezone.utc)
+        try:
+            doc = self._coll.find_one({"_id": self._id(bucket, prefix)})
+        except PyMongoError:
+            logger.exception("[S3-INDEX] lookup failed for %s/%s; listing directly", bucket, prefix)
+            doc = None
+        cached = self._fresh(doc, now)
+        if cached is not None:
+            return cached
+        return self._list_and_store(s3, bucket, prefix, job_id, max_collect, now)
+
+    def objects_many(
+        self,
+        s3: Any,
+        bucket: str,
+        prefixes: Dict[str, Optional[str]],
+        max_collect: int = S3_LIST_MAX_KEYS,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        objects() for many prefixes ({prefix: job_id}) with one index query; prefixes
+        that are unknown or stale are listed concurrently. A failed listing yields [].
+        """
+        self._ensure_indexes()
+        now = datetime.now(timezone.utc)
+        by_id = {self._id(bucket, p): p for p in prefixes}
+        out: Dict[str, List[Dict[str, Any]]] = {}
+        try:
+            for doc in self._coll.find({"_id": {"$in": list(by_id)}}):
+                cached = self._fresh(doc, now)
+                if cached is not None:
+                    out[by_id[doc["_id"]]] = cached
+        except PyMongoError:
+            logger.exception("[S3-INDEX] batch lookup failed; listing directly")
+
+        missing = [p for p in prefixes if p not in out]
+        if missing:
+            results = run_legs(
+                {p: partial(self._list_and_store, s3, bucket, p, prefixes[p], max_collect, now) for p in missing},
+                timeout_s=S3_LIST_TIMEOUT_SECONDS,
+                label="S3-LIST",
+            )
+            for p in missing:
+                out[p] = results[p].value if results[p].ok else []
+        return out
+
+    @staticmethod
+    def _fresh(doc: Optional[Dict[str, Any]], now: datetime) -> Optional[List[Dict[str, Any]]]:
+        if doc is None:
+            return None
+        objs = doc.get("objects") or []
+        ttl = S3_KEY_INDEX_TTL_SECONDS if objs else S3_KEY_INDEX_EMPTY_TTL_SECONDS
+        listed_at = doc.get("listed_at")
+        if listed_at is None or listed_at > now - timedelta(seconds=ttl):
+            return [{"Key": o["k"], "LastModified": o.get("m")} for o in objs]
+        return None
+
+    def _list_and_store(self, s3: Any, bucket: str, prefix: str, job_id: Optional[str],
+                        max_collect: int, now: datetime) -> List[Dict[str, Any]]:
+        listed = list_all(s3, bucket, prefix, max_collect=max_collect)
+        self._store(bucket, prefix, job_id, [(o["Key"], o.get("LastModified")) for o in listed], now)
+        return [{"Key": o["Key"], "LastModified": o.get("LastModified")} for o in listed]
+
+    def keys(self, s3: Any, bucket: str, prefix: str, job_id: Optional[str] = None) -> List[str]:
+        return [o["Key"] for o in self.objects(s3, bucket, prefix, job_id=job_id)]
+
+    def _store(self, bucket: str, prefix: str, job_id: Optional[str], items: List[tuple],
+               listed_at: Optional[datetime]) -> None:
+        try:
+            self._coll.update_one(
+                {"_id": self._id(bucket, prefix)},
+                {"$set": {
+                    "bucket": bucket,
+                    "prefix": prefix,
+                    "job_id": job_id,
+                    "objects": [{"k": k, "m": m} for k, m in items],
+                    "listed_at": listed_at,
+                }},
+                upsert=True,
+            )
+        except PyMongoError:
+            logger.exception("[S3-INDEX] store failed for %s/%s", bucket, prefix)
+
+    def record(self, bucket: str, prefix: str, keys: Iterable[str], job_id: Optional[str] = None) -> None:
+        """
+        Add keys just written under `prefix`. A writer that records every key it puts
+        there makes the index authoritative: such docs have listed_at=None and are
+        served without ever being listed.
+        """
+        now = datetime.now(timezone.utc)
+        items = [{"k": k, "m": now} for k in keys]
+        if not items:
+            return
+        try:
+            self._coll.update_one(
+                {"_id": self._id(bucket, prefix)},
+                {"$set": {"bucket": bucket, "prefix": prefix, "job_id": job_id},
+                 "$addToSet": {"objects": {"$each": items}},
+                 "$setOnInsert": {"listed_at": None}},
+                upsert=True,
+            )
+        except PyMongoError:
+            logger.exception("[S3-INDEX] record failed for %s/%s", bucket, prefix)
+
+    def moved(self, bucket: str, old_prefix: str, new_prefix: str, job_id: Optional[str] = None) -> None:
+        """After moving everything under old_prefix to new_prefix: old is empty, new must be re-listed."""
+        try:
+            self._store(bucket, old_prefix, job_id, [], datetime.now(timezone.utc))
+            self.invalidate(bucket, new_prefix)
+        except PyMongoError:
+            logger.exception("[S3-INDEX] move bookkeeping failed for %s -> %s", old_prefix, new_prefix)
+
+    def invalidate(self, bucket: str, prefix: str) -> None:
+        self._coll.delete_one({"_id": self._id(bucket, prefix)})
+
+    def invalidate_job(self, job_id: str) -> None:
+        self._coll.delete_many({"job_id": job_id})
@@ -0,0 +1,80 @@
+# app/services/s3_mover.py
+#
+# Server-side S3 "folder" moves.
+# S3 has no rename: a move is copy_object + delete. Copies run concurrently on
+# a pool of their own (not the shared fan-out pool, which page loads use);
+# sources are then deleted with delete_objects, 1,000 keys per call, and only
+# for keys whose copy succeeded, so a failed copy never loses data. Callers
+# get a per-key error map to build their own report.
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.services.fanout import run_legs
+
+logger = logging.getLogger(__name__)
+
+S3_MOVE_TIMEOUT_SECONDS = float(os.getenv("S3_MOVE_TIMEOUT_SECONDS", "120"))
+S3_MOVE_MAX_WORKERS = int(os.getenv("S3_MOVE_MAX_WORKERS", "16"))
+_DELETE_BATCH = 1000
+
+_MOVE_POOL = ThreadPoolExecutor(max_workers=S3_MOVE_MAX_WORKERS, thread_name_prefix="s3-move")
+
+
+def copy_many(
+    s3: Any,
+    bucket: str,
+    pairs: List[Tuple[str, str]],
+    timeout_s: float = S3_MOVE_TIMEOUT_SECONDS,
+) -> Dict[str, Optional[str]]:
+    """Copy src -> dst for every pair concurrently. Returns {src: error or None}."""
+    if not pairs:
+        return {}
+
+    def _copy(src: str, dst: str) -> None:
+        s3.copy_object(Bucket=bucket, CopySource={"Bucket": bucket, "Key": src}, Key=dst)
+
+    results = run_legs({src: (lambda s=src, d=dst: _copy(s, d)) for src, dst in pairs},
+                       timeout_s=timeout_s, label="S3-COPY", pool=_MOVE_POOL)
+    return {src: (None if res.ok else res.error) for src, res in results.items()}
+
+
+def delete_many(s3: Any, bucket: str, keys: List[str]) -> Dict[str, str]:
+    """Delete keys in batches of 1,000. Returns {key: error} for keys that failed."""
+    errors: Dict[str, str] = {}
+    for i in range(0, len(keys), _DELETE_BATCH):
+        batch = keys[i:i + _DELETE_BATCH]
+        try:
+            resp = s3.delete_objects(
+                Bucket=bucket,
+                Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+            )
+        except Exception as e:
+            logger.exception("[S3-MOVE] delete_objects failed for %d keys", len(batch))
+            errors.update({k: f"{type(e).__name__}: {e}" for k in batch})
+            continue
+        for err in resp.get("Errors", []) or []:
+            errors[err.get("Key", "")] = f"{err.get('Code')}: {err.get('Message')}"
+    return errors
+
+
+def move_many(s3: Any, bucket: str, pairs: List[Tuple[str, str]]) -> Dict[str, Optional[str]]:
+    """
+    Move src -> dst for every pair (concurrent copies, batched deletes).
+    Returns {src: error or None}; a source whose copy failed is left in place.
+    """
+    copy_errors = copy_many(s3, bucket, pairs)
+    copied = [src for src, err in copy_errors.items() if err is None]
+    delete_errors = delete_many(s3, bucket, copied)
+    out: Dict[str, Optional[str]] = {}
+    for src, _ in pairs:
+        if copy_errors.get(src):
+            out[src] = f"copy: {copy_errors[src]}"
+        elif src in delete_errors:
+            out[src] = f"delete: {delete_errors[src]}"
+        else:
+            out[src] = None
+    failed = sum(1 for e in out.values() if e)
+    logger.info("[S3-MOVE] %s: %d moved, %d failed", bucket, len(out) - failed, failed)
+    return out
@@ -0,0 +1,163 @@
+# app/services/shiprocket_orders.py
+#
+# Shiprocket order details (courier + shipping charges) synced into shipping_details.
+# Shared by GET /shiprocket/order/show and the Shiprocket tracking webhook, which
+# used to trigger the same work with a blocking HTTP call back into our own API.
+# The auth token is reused across calls instead of logging in on every event.
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+import requests
+from fastapi import HTTPException
+from pymongo.collection import Collection
+
+from app.services.timing import timed
+
+logger = logging.getLogger(__name__)
+
+SHIPROCKET_BASE = os.getenv(
+    "SHIPROCKET_BASE", "https://apiv2.shiprocket.in").rstrip("/")
+SHIPROCKET_EMAIL = os.getenv("SHIPROCKET_EMAIL")
+SHIPROCKET_PASSWORD = os.getenv("SHIPROCKET_PASSWORD")
+# Shiprocket tokens are valid for days; refresh well before that
+SHIPROCKET_TOKEN_TTL_SECONDS = int(os.getenv("SHIPROCKET_TOKEN_TTL_SECONDS", str(24 * 3600)))
+
+_token_lock = threading.Lock()
+_token: Optional[str] = None
+_token_at = 0.0
+
+
+def _login() -> str:
+    if not SHIPROCKET_EMAIL or not SHIPROCKET_PASSWORD:
+        raise HTTPException(500, "Shiprocket credentials missing")
+    r = requests.post(
+        f"{SHIPROCKET_BASE}/v1/external/auth/login",
+        json={"email": SHIPROCKET_EMAIL, "password": SHIPROCKET_PASSWORD},
+        timeout=30,
+    )
+    if r.status_code != 200:
+        raise HTTPException(502, f"Shiprocket auth failed: {r.text}")
+    token = (r.json() or {}).get("token")
+    if not token:
+        raise HTTPException(502, "Shiprocket token missing")
+    return token
+
+
+def sr_token(force_refresh: bool = False) -> str:
+    global _token, _token_at
+    with _token_lock:
+        if force_refresh or not _token or time.monotonic() - _token_at > SHIPROCKET_TOKEN_TTL_SECONDS:
+            _token = _login()
+            _token_at = time.monotonic()
+        return _token
+
+
+def _to_number(value):
+    try:
+        if value is None:
+            return 0
+        if isinstance(value, (int, float)):
+            return value
+        value = value.strip()
+        if value == "":
+            return 0
+        return float(value)
+    except Exception:
+        return 0
+
+
+def _get_order(sr_order_id: Any) -> Dict[str, Any]:
+    url = f"{SHIPROCKET_BASE}/v1/external/orders/show/{sr_order_id}"
+    try:
+        r = requests.get(url, headers={"Authorization": f"Bearer {sr_token()}"}, timeout=30)
+        if r.status_code == 401:
+            # token revoked/expired early: log in again once
+            r = requests.get(
+                url, headers={"Authorization": f"Bearer {sr_token(force_refresh=True)}"}, timeout=30)
+        r.raise_for_status()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Shiprocket API error: {str(e)}")
+    return r.json().get("data", {}) or {}
+
+
+@timed("shiprocket_orders.sync_order_show")
+def sync_order_show(
+    orders_collection: Collection,
+    shipping_collection: Collection,
+    internal_order_id: str,
+) -> Dict[str, Any]:
+    """
+    Look up the Shiprocket order linked to `internal_order_id`, store courier and
+    shipping charges in shipping_collection and return them.
+    Raises HTTPException (400/404/502) like the route always did.
+    """
+    if not internal_order_id:
+        raise HTTPException(status_code=400, detail="internal_order_id required")
+
+    doc = orders_collection.find_one(
+        {"order_id": internal_order_id}, {"sr_order_id": 1, "shiprocket_data.sr_order_id": 1})
+    if not doc:
+        raise HTTPException(
+            status_code=404, detail=f"{internal_order_id} not found in database")
+
+    sr_order_id = (
+        doc.get("sr_order_id")
+        or doc.get("shiprocket_data", {}).get("sr_order_id")
+    )
+    if not sr_order_id:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{internal_order_id} has no Shiprocket order linked (sr_order_id missing)"
+        )
+
+    data = _get_order(sr_order_id)
+
+    raw_shipping = (
+        data.get("others", {}).get("shipping_charges")
+        or data.get("others", {}).get("shipping_charge")
+        or data.get("shipping_charges")
+        or data.get("shipping_charge")
+        or data.get("awb_data", {}).get("charges", {}).get("freight_charges")
+        or "0"
+    )
+    shipping_charges = _to_number(raw_shipping)
+
+    shipments = data.get("shipments") or {}
+    if isinstance(shipments, dict):
+        courier_name = shipments.get("courier") or shipments.get("courier_name") or ""
+    elif isinstance(shipments, list) and shipments:
+        courier_name = shipments[0].get("courier") or shipments[0].get("courier_name") or ""
+    else:
+        courier_name = ""
+
+    try:
+        shipping_collection.update_one(
+            {"order_id": internal_order_id},
+            {
+                "$set": {
+                    "order_id": internal_order_id,
+                    "sr_order_id": sr_order_id,
+                    "shipping_charges": shipping_charges,
+                    "courier_name": courier_name,
+                    "shiprocket_raw": data,
+                    # read by the debounced refresher to skip fresh orders
+                    "shiprocket_synced_at": datetime.now(timezone.utc),
+                }
+            },
+            upsert=True
+        )
+    except Exception as e:
+        logger.exception(
+            f"[SR] Failed to update shipping_collection for {internal_order_id}: {e}")
+
+    return {
+        "order_id": internal_order_id,
+        "courier_name": courier_name,
+        "shipping_charges": shipping_charges
+    }
@@ -0,0 +1,57 @@
+# app/services/timing.py
+#
+# Per-call timing for in-process service functions.
+# Routes, schedulers and webhooks call the same service functions directly
+# (no loopback HTTP to our own API); @timed logs wall time and outcome of each
+# call under one tag, so a slow dependency shows up the same way whoever hit it.
+import functools
+import inspect
+import logging
+import time
+from typing import Any, Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def _log(name: str, ok: bool, t0: float) -> None:
+    ms = (time.perf_counter() - t0) * 1000.0
+    if ok:
+        logger.info("[SVC] %s ok in %.0fms", name, ms)
+    else:
+        logger.warning("[SVC] %s failed after %.0fms", name, ms)
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator for sync or async callables; the exception (if any) is re-raised unchanged."""
+
+    def deco(fn: F) -> F:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def _async(*args: Any, **kwargs: Any) -> Any:
+                t0 = time.perf_counter()
+                ok = False
+                try:
+                    result = await fn(*args, **kwargs)
+                    ok = True
+                    return result
+                finally:
+                    _log(name, ok, t0)
+
+            return _async  # type: ignore[return-value]
+
+        @functools.wraps(fn)
+        def _sync(*args: Any, **kwargs: Any) -> Any:
+            t0 = time.perf_counter()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                _log(name, ok, t0)
+
+        return _sync  # type: ignore[return-value]
+
+    return deco
@@ -0,0 +1,73 @@
+# app/services/tracking_store.py
+#
+# Raw carrier tracking payloads, kept out of the order/shipping documents.
+# Each webhook payload is appended to `tracking_events` (a time-series
+# collection with an expiry where the server supports it, a plain collection
+# with a TTL index otherwise), while shipping_details keeps only a compact
+# latest-status summary plus the de-duplicated scan list.
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+TRACKING_EVENTS_RETENTION_DAYS = int(os.getenv("TRACKING_EVENTS_RETENTION_DAYS", "180"))
+
+
+class TrackingEventStore:
+    def __init__(
+        self,
+        db: Database,
+        name: str = "tracking_events",
+        retention_days: int = TRACKING_EVENTS_RETENTION_DAYS,
+    ):
+        self._db = db
+        self._name = name
+        self._expire = retention_days * 86400
+        self._coll: Optional[Collection] = None
+
+    def _collection(self) -> Collection:
+        if self._coll is not None:
+            return self._coll
+        coll = self._db[self._name]
+        try:
+            if self._name not in self._db.list_collection_names(filter={"name": self._name}):
+                self._db.create_collection(
+                    self._name,
+                    timeseries={"timeField": "received_at", "metaField": "meta", "granularity": "minutes"},
+                    expireAfterSeconds=self._expire,
+                )
+                logger.info("[TRACKING] created time-series collection %s", self._name)
+        except CollectionInvalid:
+            pass  # created concurrently by another worker
+        except PyMongoError:
+            # server without time-series support: plain collection + TTL
+            logger.exception("[TRACKING] time-series create failed; using a TTL-indexed collection")
+            try:
+                coll.create_index("received_at", name="received_at_ttl", expireAfterSeconds=self._expire)
+            except PyMongoError:
+                logger.exception("[TRACKING] create_index failed; continuing without it")
+        self._coll = coll
+        return coll
+
+    def record(
+        self,
+        source: str,
+        payload: Dict[str, Any],
+        order_id: Optional[str] = None,
+        awb: Optional[str] = None,
+    ) -> None:
+        """Append one raw payload. Best effort: a failure is logged, never raised."""
+        try:
+            self._collection().insert_one({
+                "received_at": datetime.now(timezone.utc),
+                "meta": {"source": source, "order_id": order_id, "awb": awb},
+                "payload": payload,
+            })
+        except PyMongoError:
+            logger.exception("[TRACKING] failed to store %s event for %s", source, order_id or awb)
@@ -0,0 +1,97 @@
+# app/services/webhook_dedupe.py
+#
+# Duplicate suppression for provider webhooks (Shiprocket, CloudPrinter).
+# A bounded in-process LRU answers repeats cheaply; the Mongo collection is the
+# source of truth shared by every uvicorn worker and survives restarts. A key
+# is claimed by inserting {_id: key} (the _id index makes the claim atomic), and
+# a TTL index on created_at expires old keys so the collection stays bounded.
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_DEDUPE_TTL_SECONDS = int(os.getenv("WEBHOOK_DEDUPE_TTL_SECONDS", str(7 * 24 * 3600)))
+WEBHOOK_DEDUPE_LRU_SIZE = int(os.getenv("WEBHOOK_DEDUPE_LRU_SIZE", "10000"))
+
+
+def dedupe_key(*parts) -> str:
+    base = "|".join("" if p is None else str(p) for p in parts)
+    return hashlib.sha256(base.encode()).hexdigest()
+
+
+class WebhookDedupe:
+    def __init__(
+        self,
+        collection: Collection,
+        ttl_seconds: int = WEBHOOK_DEDUPE_TTL_SECONDS,
+        lru_size: int = WEBHOOK_DEDUPE_LRU_SIZE,
+    ):
+        self._coll = collection
+        self._ttl = ttl_seconds
+        self._lru_size = max(1, lru_size)
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexes_ready = False
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index(
+                "created_at", name="created_at_ttl", expireAfterSeconds=self._ttl)
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[WH-DEDUPE] create_index failed; continuing without TTL")
+
+    def _remember(self, key: str) -> None:
+        with self._lock:
+            self._lru[key] = None
+            self._lru.move_to_end(key)
+            while len(self._lru) > self._lru_size:
+                self._lru.popitem(last=False)
+
+    def _in_lru(self, key: str) -> bool:
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                return True
+        return False
+
+    def seen(self, source: str, key: str) -> bool:
+        """
+        Claim `key` for `source`. Returns True if it was already claimed (duplicate),
+        False if this call claimed it and the event should be processed.
+        If Mongo is unavailable the event is processed (fail open) and only the LRU
+        remembers it.
+        """
+        full = f"{source}:{key}"
+        if self._in_lru(full):
+            return True
+        self._ensure_indexes()
+        try:
+            self._coll.insert_one(
+                {"_id": full, "source": source, "created_at": datetime.now(timezone.utc)})
+        except DuplicateKeyError:
+            self._remember(full)
+            return True
+        except PyMongoError:
+            logger.exception("[WH-DEDUPE] %s: store unavailable; processing without shared dedupe", source)
+        self._remember(full)
+        return False
+
+    def forget(self, source: str, key: str) -> None:
+        """Release a claim after a failed processing attempt so the provider's retry is accepted."""
+        full = f"{source}:{key}"
+        with self._lock:
+            self._lru.pop(full, None)
+        try:
+            self._coll.delete_one({"_id": full})
+        except PyMongoError:
+            logger.exception("[WH-DEDUPE] %s: forget failed for %s", source, key)
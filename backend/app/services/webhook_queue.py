@@ -0,0 +1,237 @@
+# app/services/webhook_queue.py
+#
+# Ack-fast webhook ingestion.
+# Routes only validate, dedupe and append the raw event to `webhook_events`,
+# then return 200. A pool of worker threads (started from the app lifespan)
+# processes events in arrival order per order key, with retries and backoff;
+# events that keep failing are parked as status "failed" for inspection.
+#
+# Ordering across workers/processes: a worker claims one event at a time, and
+# only processes it if no earlier event for the same key is still pending or
+# in flight; otherwise the claim is handed back until the earlier event's next
+# attempt (or after a short delay while it is in flight).
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv("WEBHOOK_RETRY_BASE_SECONDS", "5"))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.getenv("WEBHOOK_RETRY_MAX_SECONDS", "900"))
+WEBHOOK_LOCK_SECONDS = int(os.getenv("WEBHOOK_LOCK_SECONDS", "300"))
+WEBHOOK_EVENTS_RETENTION_DAYS = int(os.getenv("WEBHOOK_EVENTS_RETENTION_DAYS", "30"))
+WEBHOOK_POLL_SECONDS = 1.0
+_BLOCKED_DELAY_SECONDS = 1.0
+
+# handler(event_doc) -> None; raising schedules a retry
+EventHandler = Callable[[Dict[str, Any]], None]
+
+
+class WebhookEventQueue:
+    def __init__(
+        self,
+        collection: Collection,
+        workers: int = WEBHOOK_WORKERS,
+        max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+    ):
+        self._coll = collection
+        self._workers = max(1, workers)
+        self._max_attempts = max(1, max_attempts)
+        self._handlers: Dict[str, EventHandler] = {}
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._indexes_ready = False
+
+    # ---- setup ----
+    def register(self, source: str, handler: EventHandler) -> None:
+        self._handlers[source] = handler
+
+    def _ensure_indexes(self) -> None:
+        if self._indexes_ready:
+            return
+        try:
+            self._coll.create_index(
+                [("status", ASCENDING), ("next_attempt_at", ASCENDING), ("_id", ASCENDING)],
+                name="status_next_attempt")
+            self._coll.create_index(
+                [("order_key", ASCENDING), ("_id", ASCENDING)], name="order_key_id")
+            self._coll.create_index(
+                "done_at", name="done_at_ttl",
+                expireAfterSeconds=WEBHOOK_EVENTS_RETENTION_DAYS * 86400)
+            self._indexes_ready = True
+        except PyMongoError:
+            logger.exception("[WH-QUEUE] create_index failed; continuing without it")
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._ensure_indexes()
+        self._stop.clear()
+        for i in range(self._workers):
+            t = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info("[WH-QUEUE] started %d workers for %s", self._workers, sorted(self._handlers))
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    # ---- ingest ----
+    def enqueue(self, source: str, order_key: Optional[str], payload: Dict[str, Any], **meta: Any) -> Any:
+        """Append a raw event; returns its _id. Raises PyMongoError if it could not be stored."""
+        now = datetime.now(timezone.utc)
+        doc = {
+            "source": source,
+            "order_key": order_key or f"{source}:unkeyed",
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "received_at": now,
+            "next_attempt_at": now,
+            **meta,
+        }
+        res = self._coll.insert_one(doc)
+        self._wake.set()
+        return res.inserted_id
+
+    # ---- processing ----
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        return self._coll.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    # a worker died mid-event: take it over once its lock lapses
+                    {"status": "processing", "locked_until": {"$lt": now}},
+                ]
+            },
+            {"$set": {
+                "status": "processing",
+                "locked_by": self._owner,
+                "locked_until": now + timedelta(seconds=WEBHOOK_LOCK_SECONDS),
+            }},
+            sort=[("_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _blocked(self, ev: Dict[str, Any]) -> Optional[float]:
+        """Seconds to hand the claim back for if an earlier event for the same key
+        is not finished yet; None when the event may run now."""
+        earlier = self._coll.find_one(
+            {
+                "order_key": ev["order_key"],
+                "_id": {"$lt": ev["_id"]},
+                "status": {"$in": ["pending", "processing"]},
+            },
+            {"status": 1, "next_attempt_at": 1},
+            sort=[("_id", ASCENDING)],
+        )
+        if earlier is None:
+            return None
+        due = earlier.get("next_attempt_at")
+        if earlier.get("status") != "pending" or not isinstance(due, datetime):
+            return _BLOCKED_DELAY_SECONDS
+        if due.tzinfo is None:
+            due = due.replace(tzinfo=timezone.utc)
+        # in backoff: nothing can change for this key before its retry
+        wait = (due - datetime.now(timezone.utc)).total_seconds()
+        return max(_BLOCKED_DELAY_SECONDS, wait)
+
+    def _release(self, ev: Dict[str, Any], delay: float, **fields: Any) -> None:
+        fields.update({
+            "status": "pending",
+            "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+        })
+        self._coll.update_one(
+            {"_id": ev["_id"], "locked_by": self._owner},
+            {"$set": fields, "$unset": {"locked_by": "", "locked_until": ""}},
+        )
+
+    def _finish(self, ev: Dict[str, Any], elapsed_ms: float) -> None:
+        self._coll.update_one(
+            {"_id": ev["_id"], "locked_by": self._owner},
+            {"$set": {
+                "status": "done",
+                "done_at": datetime.now(timezone.utc),
+                "attempts": ev.get("attempts", 0) + 1,
+                "elapsed_ms": round(elapsed_ms, 1),
+            },
+             "$unset": {"locked_by": "", "locked_until": "", "last_error": ""}},
+        )
+
+    def _fail(self, ev: Dict[str, Any], err: str) -> None:
+        attempts = ev.get("attempts", 0) + 1
+        if attempts >= self._max_attempts:
+            logger.error("[WH-QUEUE] %s event %s failed %d times; parking it: %s",
+                         ev.get("source"), ev["_id"], attempts, err)
+            self._coll.update_one(
+                {"_id": ev["_id"], "locked_by": self._owner},
+                {"$set": {"status": "failed", "attempts": attempts, "last_error": err,
+                          "failed_at": datetime.now(timezone.utc)},
+                 "$unset": {"locked_by": "", "locked_until": ""}},
+            )
+            return
+        delay = min(WEBHOOK_RETRY_MAX_SECONDS, WEBHOOK_RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+        logger.warning("[WH-QUEUE] %s event %s attempt %d failed (retry in %.0fs): %s",
+                       ev.get("source"), ev["_id"], attempts, delay, err)
+        self._release(ev, delay, attempts=attempts, last_error=err)
+
+    def process_one(self) -> bool:
+        """Claim and handle one event. Returns False when there was nothing to do."""
+        ev = self._claim()
+        if ev is None:
+            return False
+        wait = self._blocked(ev)
+        if wait is not None:
+            self._release(ev, wait)
+            return True
+
+        handler = self._handlers.get(ev.get("source"))
+        if handler is None:
+            self._fail(ev, f"no handler for source {ev.get('source')!r}")
+            return True
+
+        t0 = time.perf_counter()
+        try:
+            handler(ev)
+        except Exception as e:
+            logger.exception("[WH-QUEUE] %s event %s handler error", ev.get("source"), ev["_id"])
+            self._fail(ev, f"{type(e).__name__}: {e}")
+            return True
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+        self._finish(ev, elapsed_ms)
+        logger.info("[WH-QUEUE] %s event %s (%s) done in %.0fms",
+                    ev.get("source"), ev["_id"], ev.get("order_key"), elapsed_ms)
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                worked = self.process_one()
+            except PyMongoError:
+                logger.exception("[WH-QUEUE] store unavailable; backing off")
+                worked = False
+                self._stop.wait(WEBHOOK_POLL_SECONDS * 5)
+            except Exception:
+                logger.exception("[WH-QUEUE] worker loop error")
+                worked = False
+            if not worked:
+                self._wake.wait(WEBHOOK_POLL_SECONDS)
+                self._wake.clear()
@@ -0,0 +1,230 @@
+# app/services/xlsx_writer.py
+#
+# Row-at-a-time XLSX writer for the admin exports.
+# Prefers xlsxwriter in constant_memory mode (each row is flushed to a temp file
+# as soon as the next row starts) and falls back to openpyxl's write-only mode.
+# The finished workbook lands in a SpooledTemporaryFile, which stays in RAM for
+# small files and rolls over to disk for large ones, and is streamed back in chunks.
+import math
+import tempfile
+from datetime import date, datetime, timezone
+from typing import Any, Iterator, List, Optional, Sequence
+
+import pandas as pd
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# what pd.ExcelWriter applied to datetime / date cells
+DATETIME_FORMAT = "yyyy-mm-dd hh:mm:ss"
+DATE_FORMAT = "yyyy-mm-dd"
+
+
+def pick_engine() -> Optional[str]:
+    try:
+        import xlsxwriter  # noqa: F401
+        return "xlsxwriter"
+    except Exception:
+        try:
+            import openpyxl  # noqa: F401
+            return "openpyxl"
+        except Exception:
+            return None
+
+
+def _cell(v: Any) -> Any:
+    """Coerce numpy / pandas / tz-aware values into something both engines accept."""
+    if v is None:
+        return None
+    if isinstance(v, (pd.Timestamp,)):
+        v = v.to_pydatetime()
+    if isinstance(v, datetime):
+        return v.astimezone(timezone.utc).replace(tzinfo=None) if v.tzinfo else v
+    if isinstance(v, date):
+        return v
+    if hasattr(v, "item") and not isinstance(v, (str, bytes)):
+        try:
+            v = v.item()  # numpy scalar -> python scalar
+        except Exception:
+            pass
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    if isinstance(v, (bool, int, float, str)):
+        return v
+    try:
+        if pd.isna(v):
+            return None
+    except Exception:
+        pass
+    return str(v)
+
+
+def _date_kind(v: Any) -> Optional[str]:
+    if isinstance(v, datetime):
+        return "datetime"
+    if isinstance(v, date):
+        return "date"
+    return None
+
+
+class SheetWriter:
+    """Sequential writer for one worksheet. Rows must be written top to bottom."""
+
+    def __init__(self, book: "XlsxExportWriter", name: str):
+        self._book = book
+        self.name = name
+        self.row = 0  # next row to write (0-based)
+        if book.engine == "xlsxwriter":
+            self._ws = book._wb.add_worksheet(name)
+        else:
+            self._ws = book._wb.create_sheet(name)
+
+    def move_to(self, row: int) -> None:
+        """Skip forward to `row` (0-based). Going backwards is not possible in streaming mode."""
+        if row < self.row:
+            raise ValueError(f"{self.name}: cannot move back from row {self.row} to {row}")
+        if self._book.engine == "openpyxl":
+            for _ in range(row - self.row):
+                self._ws.append([])
+        self.row = row
+
+    def write_row(self, values: Sequence[Any], bold: bool = False) -> None:
+        vals = [_cell(v) for v in values]
+        if self._book.engine == "xlsxwriter":
+            for col, v in enumerate(vals):
+                if v is None:
+                    continue
+                fmt = self._book._formats[(bold, _date_kind(v))]
+                if fmt is not None:
+                    self._ws.write(self.row, col, v, fmt)
+                else:
+                    self._ws.write(self.row, col, v)
+        else:
+            if bold or any(isinstance(v, date) for v in vals):
+                from openpyxl.cell import WriteOnlyCell
+                from openpyxl.styles import Font
+                cells = []
+                for v in vals:
+                    c = WriteOnlyCell(self._ws, value=v)
+                    if bold:
+                        c.font = Font(bold=True)
+                    kind = _date_kind(v)
+                    if kind is not None:
+                        c.number_format = DATETIME_FORMAT if kind == "datetime" else DATE_FORMAT
+                    cells.append(c)
+                self._ws.append(cells)
+            else:
+                self._ws.append(vals)
+        self.row += 1
+
+    def write_frame(self, df: pd.DataFrame, index: bool = True) -> None:
+        """
+        Write `df` the way DataFrame.to_excel lays it out: bold header row
+        (columns.name in the corner when index is written), then an index-name row
+        when the index is named, then one row per record.
+        """
+        cols = [str(c) for c in df.columns]
+        if index:
+            corner = df.columns.name or ""
+            self.write_row([corner, *cols], bold=True)
+            if df.index.name:
+                self.write_row([df.index.name], bold=True)
+            for idx, rec in zip(df.index, df.itertuples(index=False, name=None)):
+                self.write_row([idx, *rec])
+        else:
+            self.write_row(cols, bold=True)
+            for rec in df.itertuples(index=False, name=None):
+                self.write_row(list(rec))
+
+    def freeze(self, row: int, col: int = 0) -> None:
+        if self._book.engine == "xlsxwriter":
+            self._ws.freeze_panes(row, col)
+        else:
+            from openpyxl.utils import get_column_letter
+            try:
+                self._ws.freeze_panes = f"{get_column_letter(col + 1)}{row + 1}"
+            except Exception:
+                pass  # not every write-only worksheet version supports panes
+
+
+class XlsxExportWriter:
+    """
+    Usage:
+        xw = XlsxExportWriter()
+        ws = xw.add_sheet("pivot"); ws.write_frame(df)
+        xw.close()
+        StreamingResponse(xw.iter_chunks(), media_type=XLSX_MEDIA_TYPE)
+    """
+
+    def __init__(self, engine: Optional[str] = None, spool_max_bytes: int = SPOOL_MAX_BYTES):
+        self.engine = engine or pick_engine()
+        if self.engine is None:
+            raise RuntimeError(
+                "Missing Excel writer engine. Install one of: pip install xlsxwriter OR pip install openpyxl")
+        self._out = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes, mode="w+b")
+        self._closed = False
+        if self.engine == "xlsxwriter":
+            import xlsxwriter
+            self._wb = xlsxwriter.Workbook(
+                self._out, {"constant_memory": True, "default_date_format": DATETIME_FORMAT})
+            add = self._wb.add_format
+            # (bold, date kind) -> cell format; None lets default_date_format apply
+            self._formats = {
+                (False, None): None,
+                (False, "datetime"): None,
+                (False, "date"): add({"num_format": DATE_FORMAT}),
+                (True, None): add({"bold": True}),
+                (True, "datetime"): add({"bold": True, "num_format": DATETIME_FORMAT}),
+                (True, "date"): add({"bold": True, "num_format": DATE_FORMAT}),
+            }
+        else:
+            from openpyxl import Workbook
+            self._wb = Workbook(write_only=True)
+
+    def add_sheet(self, name: str) -> SheetWriter:
+        return SheetWriter(self, name)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        if self.engine == "xlsxwriter":
+            self._wb.close()
+        else:
+            self._wb.save(self._out)
+        self._out.flush()
+        self._closed = True
+
+    def size(self) -> int:
+        self.close()
+        self._out.seek(0, 2)
+        return self._out.tell()
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Yield the finished workbook; the spooled file is released afterwards."""
+        self.close()
+        self._out.seek(0)
+        try:
+            while True:
+                chunk = self._out.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self._out.close()
+
+    def getvalue(self) -> bytes:
+        """Whole workbook as bytes (for email attachments); releases the spooled file."""
+        return b"".join(self.iter_chunks())
+
+
+def write_blocks(ws: SheetWriter, blocks: List[tuple], gap: int = 4) -> None:
+    """
+    Multi-block sheet layout used by the scheduled export:
+    for each (heading, frame) write a bold heading row, the frame below it, and
+    leave `gap` rows between the end of one frame's data and the next heading.
+    """
+    for heading, frame in blocks:
+        start = ws.row
+        ws.write_row([heading], bold=True)
+        ws.write_frame(frame)
+        ws.move_to(max(ws.row, start + 1 + frame.shape[0] + gap))
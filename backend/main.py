@@ -7,7 +7,7 @@ from dateutil import parser as date_parser
 from typing import Optional
 from fastapi import Query
 from typing import Optional, List
-from app.routers.cloudprinter_produce_webhook import router as cp_produce_router
+from app.routers.cloudprinter_produce_webhook import router as cp_produce_router, process_item_produce_event
 from dateutil import parser
 from fastapi import FastAPI, BackgroundTasks, Response, Query, HTTPException, Body
 from fastapi.middleware.cors import CORSMiddleware
@@ -21,12 +21,12 @@ import requests
 import hashlib
 import PyPDF2
 import io
-import smtplib
 from email.message import EmailMessage
 import logging
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, EmailStr, Field, ConfigDict
 from contextlib import asynccontextmanager
+from functools import partial
 from apscheduler.schedulers.background import BackgroundScheduler
 import boto3
 import csv
@@ -34,24 +34,22 @@ from fastapi.responses import FileResponse, StreamingResponse
 import tempfile
 from dateutil import parser
 from app.routers.reconcile import router as vlookup_router
-from app.routers.reconcile import _auto_reconcile_and_sign_once
+from app.routers.reconcile import _auto_reconcile_and_sign_once, na_payment_details_for, vlookup_na_payments
 from app.routers.razorpay_export import router as razorpay_router
-from app.routers.cloudprinter_webhook import router as cloudprinter_router
+from app.routers.cloudprinter_webhook import router as cloudprinter_router, process_item_shipped_event
 import pandas as pd
-from botocore.exceptions import BotoCoreError, ClientError
+from botocore.exceptions import ClientError
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import pytz
-from io import BytesIO
 from typing import Tuple
 from zoneinfo import ZoneInfo
 import re
 import json
-import httpx
 import html
 import asyncio
 import boto3
-from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
 from pymongo.collection import Collection
 from calendar import monthrange
@@ -62,7 +60,32 @@ from bson import ObjectId
 from datetime import datetime, date
 from zoneinfo import ZoneInfo
 from datetime import datetime
-from app.routers.shiprocket_webhook import router as shiprocket_router
+from app.routers.shiprocket_webhook import router as shiprocket_router, process_shiprocket_event
+from app.services.hourly_pivot import (
+    counts_to_matrix,
+    fetch_hourly_counts,
+    hourly_pivot,
+    merge_counts,
+)
+from app.services.pivot_cache import HourlyPivotCache
+from app.services.fanout import run_legs
+from app.services.ec2_status import Ec2StatusProvider
+from app.services.xlsx_writer import XLSX_MEDIA_TYPE, XlsxExportWriter, write_blocks
+from app.services.order_reconcile import mark_reconciled as mark_job_reconciled
+from app.services.shiprocket_orders import sync_order_show
+from app.services.order_show_refresh import OrderShowRefresher, refresh_order_show
+from app.services.run_lease import RunLease
+from app.services.webhook_dedupe import WebhookDedupe
+from app.services.webhook_queue import WebhookEventQueue
+from app.services import email_outbox as email_outbox_service
+from app.services.email_outbox import EmailOutbox, queue_email
+from app.services.email_templates import render as render_email
+from app.services.nudge_candidates import WorkflowCountWatcher, ensure_workflow_counts, fetch_nudge_candidates
+from app.services.nudge_dispatch import NudgeSend, dispatch_batch, record_parked
+from app.services.customer_contacts import CustomerContacts
+from app.services.s3_access import s3_access
+from app.services.s3_key_index import S3KeyIndex
+from app.services.s3_mover import move_many
 from dateutil import parser as dateutil_parser
 from fastapi import HTTPException, Body
 from pydantic import BaseModel, EmailStr
@@ -110,6 +133,37 @@ client = MongoClient(MONGO_URI, tz_aware=True)
 db = client["candyman"]
 shipping_collection = db["shipping_details"]
 
+# finalized (source, IST date, hour) counts reused by the scheduled XLSX export
+xlsx_pivot_cache = HourlyPivotCache(db["xlsx_pivot_cache"])
+
+# webhook event keys shared by every worker (Shiprocket + CloudPrinter routers)
+webhook_dedupe = WebhookDedupe(db["webhook_dedupe"])
+
+# webhooks ack after appending here; workers (started in lifespan) apply events per order
+webhook_queue = WebhookEventQueue(db["webhook_events"])
+webhook_queue.register("shiprocket", process_shiprocket_event)
+webhook_queue.register("cloudprinter_shipped", process_item_shipped_event)
+webhook_queue.register("cloudprinter_produce", process_item_produce_event)
+
+# workflows are written by the generation service; counts follow its writes (started in lifespan)
+workflow_count_watcher = WorkflowCountWatcher(db["user_details"], db["change_stream_state"])
+
+# per-customer email state (feedback due/sent, nudge and production stamps)
+customer_contacts = CustomerContacts(db["customer_contacts"])
+
+# every outgoing email goes through this outbox (workers started in lifespan)
+email_outbox = EmailOutbox(db["email_outbox"])
+email_outbox_service.install(email_outbox)
+
+# tracking events only request a Shiprocket order/show refresh; a tick coalesces them
+SR_REFRESH_TICK_SECONDS = int(os.getenv("SR_REFRESH_TICK_SECONDS", "30"))
+order_show_refresher = OrderShowRefresher(
+    db["sr_order_refresh_queue"],
+    shipping_collection,
+    partial(refresh_order_show, partial(sync_order_show, db["user_details"], shipping_collection)),
+    RunLease(db["job_leases"], "sr_order_refresh", ttl_seconds=600),
+)
+
 scheduler = BackgroundScheduler(timezone=IST_TZ)
 
 
@@ -120,6 +174,10 @@ async def lifespan(app: FastAPI):
         if not scheduler.running:
             scheduler.start()
 
+        webhook_queue.start()
+        email_outbox.start()
+        workflow_count_watcher.start()
+
         loop = asyncio.get_running_loop()
 
         def _kick_auto_reconcile():
@@ -136,6 +194,20 @@ async def lifespan(app: FastAPI):
             max_instances=1,
         )
 
+        def _kick_hourly_reconcile():
+            asyncio.run_coroutine_threadsafe(
+                _hourly_reconcile_and_email(), loop
+            )
+
+        scheduler.add_job(
+            _kick_hourly_reconcile,
+            trigger=CronTrigger(minute=0, timezone=IST_TZ),
+            id="reconcile_email_hourly",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+        )
+
         scheduler.add_job(
             _run_export_and_email,
             trigger=CronTrigger(
@@ -149,6 +221,28 @@ async def lifespan(app: FastAPI):
             max_instances=1,
         )
 
+        scheduler.add_job(
+            order_show_refresher.tick,
+            trigger=IntervalTrigger(
+                seconds=SR_REFRESH_TICK_SECONDS, timezone=IST_TZ),
+            id="sr_order_show_refresh",
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1,
+        )
+
+        if AWS_REGION:
+            scheduler.add_job(
+                ec2_status_provider.refresh,
+                trigger=IntervalTrigger(
+                    seconds=EC2_STATUS_REFRESH_SECONDS, timezone=IST_TZ),
+                id="ec2_status_refresh",
+                replace_existing=True,
+                coalesce=True,
+                max_instances=1,
+                next_run_time=datetime.now(IST_TZ),
+            )
+
         def _kick_feedback_emails():
             asyncio.run_coroutine_threadsafe(
                 _run_feedback_emails_once(), loop
@@ -188,6 +282,10 @@ async def lifespan(app: FastAPI):
     except Exception:
         logger.exception("Failed to stop APScheduler")
 
+    webhook_queue.stop()
+    email_outbox.stop()
+    workflow_count_watcher.stop()
+
 app = FastAPI(lifespan=lifespan)
 app.include_router(vlookup_router)
 app.include_router(razorpay_router)
@@ -239,9 +337,16 @@ def get_aws_region() -> str:
         raise HTTPException(status_code=500, detail="AWS region not configured")
     return region
 
+_ec2_clients: Dict[str, Any] = {}
+
+
 def get_ec2_client():
+    # boto3 clients are thread-safe; build one per region and reuse it
     region = get_aws_region()
-    return boto3.client("ec2", region_name=region)
+    ec2 = _ec2_clients.get(region)
+    if ec2 is None:
+        ec2 = _ec2_clients[region] = boto3.client("ec2", region_name=region)
+    return ec2
 
 
 def split_full_name(full_name: str) -> tuple[str, str]:
@@ -334,7 +439,9 @@ def format_processed_date(value):
 def _send_html_email(
     to_email: Union[str, List[str], None],
     subject: str,
-    html_body: str
+    html_body: str,
+    kind: str = "html",
+    meta: Optional[Dict[str, Any]] = None,
 ) -> None:
     email_user = (os.getenv("EMAIL_ADDRESS") or "").strip()
     email_pass = (os.getenv("EMAIL_PASSWORD") or "").strip()
@@ -360,11 +467,8 @@ def _send_html_email(
     msg.set_content("This message contains HTML.")
     msg.add_alternative(html_body, subtype="html")
 
-    # Send to all recipients
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(email_user, email_pass)
-        # send_message uses the headers for recipients; passing explicitly is extra safe:
-        smtp.sendmail(email_user, recipients, msg.as_string())
+    # Queued on the outbox; delivered over a pooled SMTP session
+    queue_email(msg, kind=kind, meta=meta)
 
 
 def _now_ist():
@@ -375,11 +479,7 @@ def _ist_midnight(dt_ist: datetime) -> datetime:
     return dt_ist.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-VLOOKUP_PATH = "/reconcile/vlookup-payment-to-orders/auto"
-DETAILS_PATH = "/reconcile/na-payment-details"
-
-
-def _hourly_reconcile_and_email():
+async def _hourly_reconcile_and_email():
     IST = ZoneInfo(os.getenv("RECONCILE_TZ", "Asia/Kolkata"))
     now_ist = datetime.now(IST)
 
@@ -390,26 +490,18 @@ def _hourly_reconcile_and_email():
     to_date = t_date.strftime("%Y-%m-%d")
 
     logger.info(
-        "[RECONCILE-HOURLY] Calling vlookup for IST window %s → %s", from_date, to_date)
+        "[RECONCILE-HOURLY] Running vlookup for IST window %s → %s", from_date, to_date)
 
-    # 1) Pull summary + NA payment IDs via the same UI endpoint
+    # 1) Pull summary + NA payment IDs with the same service the UI endpoint uses
     try:
-        with httpx.Client(timeout=60.0) as client:
-            resp = client.get(
-                f"{API_BASE}{VLOOKUP_PATH}",
-                params={
-                    "from_date": from_date,
-                    "to_date": to_date,
-                    "na_status": "captured",
-                    "max_fetch": 200000,
-                },
-            )
-            logger.info("[RECONCILE-HOURLY] vlookup GET %s -> %s",
-                        resp.request.url, resp.status_code)
-            resp.raise_for_status()
-            lookup_json = resp.json()
+        lookup_json = await vlookup_na_payments(
+            from_date=from_date,
+            to_date=to_date,
+            na_status="captured",
+            max_fetch=200000,
+        )
     except Exception as e:
-        logger.exception("[RECONCILE-HOURLY] vlookup API failed: %s", e)
+        logger.exception("[RECONCILE-HOURLY] vlookup failed: %s", e)
         return
 
     summary = lookup_json.get("summary", {}) or {}
@@ -430,19 +522,10 @@ def _hourly_reconcile_and_email():
     # 2) Enrich those NA IDs just like the UI (email, created_at, amount, paid, preview_url, job_id, etc.)
     details_items = []
     try:
-        with httpx.Client(timeout=60.0) as client:
-            dresp = client.post(
-                f"{API_BASE}{DETAILS_PATH}",
-                json={"ids": na_ids},
-                headers={"Content-Type": "application/json"},
-            )
-            logger.info("[RECONCILE-HOURLY] details POST %s -> %s",
-                        dresp.request.url, dresp.status_code)
-            dresp.raise_for_status()
-            djson = dresp.json() or {}
-            details_items = djson.get("items", []) or []
+        djson = await na_payment_details_for(na_ids)
+        details_items = djson.get("items", []) or []
     except Exception as e:
-        logger.exception("[RECONCILE-HOURLY] details API failed: %s", e)
+        logger.exception("[RECONCILE-HOURLY] details lookup failed: %s", e)
         # We still send the email, but with just the IDs table if enrichment failed.
 
     # 3) Render a compact HTML table with the requested columns
@@ -456,7 +539,7 @@ def _hourly_reconcile_and_email():
 
     logger.info("[RECONCILE-HOURLY] Sending email: %s", subject)
     try:
-        _send_html_email(EMAIL_TO, subject, html_body)
+        await asyncio.to_thread(_send_html_email, EMAIL_TO, subject, html_body)
         logger.info("[RECONCILE-HOURLY] Email sent successfully")
     except Exception as e:
         logger.exception("[RECONCILE-HOURLY] Email send failed: %s", e)
@@ -1736,10 +1819,14 @@ client = MongoClient(MONGO_URI, tz_aware=True)
 db = client["candyman"]
 orders_collection = db["user_details"]
 
-s3 = boto3.client('s3')
+# S3_ENDPOINT_URL points this at an S3-compatible stand-in (MinIO, moto server) locally
+s3 = boto3.client('s3', endpoint_url=(os.getenv("S3_ENDPOINT_URL") or None))
 
 BUCKET_NAME = "replicacomfy"
 
+# known output keys per job (covers, approved folders) so lookups skip LIST calls
+s3_key_index = S3KeyIndex(db["s3_key_index"])
+
 
 class CloudprinterWebhookBase(BaseModel):
     apikey: str
@@ -2467,140 +2554,7 @@ def _send_production_email(
     safe_order = order_id or "—"
     subject = f"Order {safe_order}: {child}'s storybook is now in production 🎉"
 
-    html_template = """<!doctype html>
-<html>
-<head>
-  <meta charset="UTF-8">
-  <meta name="x-apple-disable-message-reformatting">
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <meta name="color-scheme" content="light">
-  <meta name="supported-color-schemes" content="light">
-  <style>
-    body { margin:0; padding:20px; background:#f7f7f7; -webkit-text-size-adjust:100%; -ms-text-size-adjust:100%; }
-    .container { width:100%; max-width:768px; margin:0 auto; background:#ffffff; border-radius:8px; box-shadow:0 0 10px rgba(0,0,0,0.08); overflow:hidden; }
-    .inner { padding:24px; font-family:Arial, Helvetica, sans-serif; color:#111; }
-    p { margin:0 0 14px 0; font-size:16px; line-height:1.5; }
-    .row { width:100%; }
-    .col { vertical-align:top; }
-    .col-text { padding:20px; }
-    .col-img { padding:0 20px 0 0; }
-    img { border:0; outline:none; text-decoration:none; display:block; height:auto; }
-    .badge { display:inline-block; padding:0; margin:0; }
-
-    @keyframes shine-sweep {
-      0%   { transform: translateX(-100%) rotate(45deg); }
-      50%  { transform: translateX(100%)  rotate(45deg); }
-      100% { transform: translateX(100%)  rotate(45deg); }
-    }
-
-    .cta {
-      position: relative;
-      overflow: hidden;
-      border-radius:9999px; text-align:center; mso-line-height-rule:exactly;
-      font-family:Arial, Helvetica, sans-serif; font-weight:bold; text-decoration:none; display:block;
-      color:#ffffff !important; background:#5784ba;
-    }
-    .cta::before {
-      content: "";
-      position: absolute;
-      top: 0;
-      left: -50%;
-      height: 100%;
-      width: 200%;
-      background: linear-gradient(120deg, transparent 0%, rgba(255,255,255,0.6) 50%, transparent 100%);
-      animation: shine-sweep 4s infinite;
-    }
-
-    .cta-wrap { width:auto; }
-    .cta-text { font-size:15px; line-height:1.2; padding:12px 24px; display:block; color:#ffffff !important; text-decoration:none; }
-    .cta-secondary { background:#5784ba; } /* static secondary */
-
-    .banner { background:#f7f6cf; border-radius:8px; }
-    .banner p { font-size:15px; }
-    .center { text-align:center; }
-
-    @media only screen and (max-width:480px) {
-      .inner { padding:16px !important; }
-      p { font-size:15px !important; }
-      .stack { display:block !important; width:100% !important; }
-      .col-text { padding:0px !important; text-align:center !important; }
-      .col-img { padding:16px 0 0 0 !important; text-align:center !important; }
-      .cta-wrap { width:100% !important; }
-      .cta-text { font-size:13px !important; padding:10px 14px !important; }
-      .center-sm { text-align:center !important; }
-      .banner { padding:12px !important; }
-      .mt-sm { margin-top:12px !important; }
-      .banner .row { display:block !important; width:100% !important; }
-      .banner .col { display:block !important; width:100% !important; }
-      .banner img { margin:0 auto !important; }
-    }
-  </style>
-</head>
-<body>
-  <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0">
-    <tr>
-      <td align="center">
-        <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" class="container">
-          <tr>
-            <td class="inner">
-              <p>Hey {display},</p>
-              <p><strong>{child}'s storybook</strong> has been moved to production at our print factory. 🎉</p>
-              <p>It will be shipped within the next 3–4 business days. We will notify you with the tracking ID once your order is shipped.</p>
-
-              <table role="presentation" cellpadding="0" cellspacing="0" border="0" class="cta-wrap" style="margin:8px 0 18px 0;">
-                <tr>
-                  <td>
-                    <a href="{track_href}" class="cta">
-                      <span class="cta-text">Track your order</span>
-                    </a>
-                  </td>
-                </tr>
-              </table>
-
-              <p>Thanks,<br>Team Diffrun</p>
-
-              <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" class="banner" style="margin-top:24px;">
-                <tr>
-                  <td>
-                    <table role="presentation" width="100%" cellpadding="0" cellspacing="0" border="0" class="row">
-                      <tr>
-                        <td class="col col-text stack" width="60%">
-                          <p>Explore more magical books in our growing collection</p>
-
-                          <table role="presentation" cellpadding="0" cellspacing="0" border="0" class="cta-wrap mt-sm" style="margin-top:16px;">
-                            <tr>
-                              <td>
-                                <a href="https://diffrun.com" class="cta cta-secondary">
-                                  <span class="cta-text">Browse Now</span>
-                                </a>
-                              </td>
-                            </tr>
-                          </table>
-                        </td>
-
-                        <td class="col col-img stack" width="40%" align="right">
-                          <img src="https://diffrungenerations.s3.ap-south-1.amazonaws.com/email_image+(2).jpg"
-                               alt="Storybook Preview" width="300" style="max-width:100%;">
-                        </td>
-                      </tr>
-                    </table>
-                  </td>
-                </tr>
-              </table>
-
-            </td>
-          </tr>
-        </table>
-      </td>
-    </tr>
-  </table>
-</body>
-</html>"""
-
-    html = (html_template
-            .replace("{display}", display)
-            .replace("{child}", child)
-            .replace("{track_href}", track_href))
+    html = render_email("production", display=display, child=child, track_href=track_href)
 
     msg = EmailMessage()
     msg["Subject"] = subject
@@ -2614,9 +2568,25 @@ def _send_production_email(
     )
     msg.add_alternative(html, subtype="html")
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(EMAIL_USER, EMAIL_PASS)
-        smtp.send_message(msg)
+    queue_email(msg, kind="production",
+                meta={"email": to_email, "job_id": job_id, "order_id": order_id})
+
+
+def _on_production_sent(meta: Dict[str, Any]) -> None:
+    customer_contacts.record_sent(meta.get("email"), "production", meta.get("job_id"),
+                                  order_id=meta.get("order_id"))
+
+
+def _on_production_parked(meta: Dict[str, Any], error: str) -> None:
+    # reopen the once-gate so the next approve / ItemProduce sends it again
+    if meta.get("order_id"):
+        orders_collection.update_one(
+            {"order_id": meta["order_id"], "production_email_sent": True},
+            {"$set": {"production_email_sent": False}})
+
+
+# shared by the approve flow and the CloudPrinter ItemProduce worker
+email_outbox.on_delivery("production", sent=_on_production_sent, failed=_on_production_parked)
 
 
 class BulkPrintRequest(BaseModel):
@@ -3661,15 +3631,8 @@ def send_email(to_email: str, subject: str, body: str):
     msg.set_content(body)
 
     try:
-        # OPTION A – Port 465 (SSL from the start)
-        EMAIL_USER = os.getenv("EMAIL_ADDRESS")
-        EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
-
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(EMAIL_USER, EMAIL_PASSWORD)
-            smtp.send_message(msg)
-
-        print(f"✅ Sent email to {to_email}")
+        queue_email(msg, kind="plain")
+        print(f"✅ Queued email to {to_email}")
     except Exception as e:
         print(f"❌ Error sending email to {to_email}: {e}")
 
@@ -3679,48 +3642,6 @@ def chunked_iterable(items: List, size: int):
         yield items[i:i + size]
 
 
-def upsert_nudge_history(
-    job_id: str,
-    stage: int,
-    status: str,
-    error: str | None = None,
-):
-    now = datetime.now(timezone.utc)
-
-    # Try updating existing stage entry
-    res = orders_collection.update_one(
-        {"job_id": job_id, "nudge_history.stage": stage},
-        {
-            "$set": {
-                "nudge_history.$.status": status,
-                "nudge_history.$.at": now,
-                "nudge_history.$.error": error[:1000] if error else None,
-            },
-            "$inc": {
-                "nudge_history.$.attempts": 1
-            },
-        }
-    )
-
-    # If stage entry does not exist, insert once
-    if res.matched_count == 0:
-        orders_collection.update_one(
-            {"job_id": job_id},
-            {
-                "$push": {
-                    "nudge_history": {
-                        "stage": stage,
-                        "status": status,
-                        "via": "email",
-                        "attempts": 1,
-                        "at": now,
-                        "error": error[:1000] if error else None,
-                    }
-                }
-            }
-        )
-
-
 def _fetch_nudge_candidates_compact(days_window: int = 7) -> List[Dict]:
 
     ist = ZoneInfo("Asia/Kolkata")
@@ -3728,58 +3649,8 @@ def _fetch_nudge_candidates_compact(days_window: int = 7) -> List[Dict]:
     cutoff_ist = now_ist - timedelta(days=days_window)
     cutoff_utc = cutoff_ist.astimezone(timezone.utc)
 
-    pipeline = [
-        {"$match": {
-            "created_at": {"$gte": cutoff_utc},
-            "email": {"$exists": True, "$ne": None, "$not": {"$regex": "@lhmm\\.in$", "$options": "i"}},
-            "workflows": {"$exists": True}
-        }},
-        {"$group": {
-            "_id": "$email",
-            "docs": {"$push": "$$ROOT"},
-            "has_paid_order": {"$max": {"$cond": [{"$eq": ["$paid", True]}, 1, 0]}},
-            "latest_created_at": {"$max": "$created_at"}
-        }},
-        {"$match": {"has_paid_order": 0}},
-        {"$project": {
-            "email": "$_id",
-            "latest_doc": {
-                "$arrayElemAt": [
-                    {"$filter": {"input": "$docs", "as": "doc", "cond": {
-                        "$eq": ["$$doc.created_at", "$latest_created_at"]}}}, 0
-                ]
-            }
-        }},
-        {"$replaceRoot": {"newRoot": "$latest_doc"}},
-        {"$match": {
-            "paid": False,
-            "$or": [{"nudge_stage": {"$exists": False}}, {"nudge_stage": {"$in": [0, 1]}}]
-        }},
-        {"$addFields": {
-            "wf_array": {"$objectToArray": "$workflows"},
-            "wf_count": {"$size": {"$objectToArray": "$workflows"}}
-        }},
-        {"$match": {"wf_count": 13}},
-        {"$match": {
-            "$expr": {
-                "$allElementsTrue": {
-                    "$map": {"input": "$wf_array", "as": "w", "in": {"$eq": ["$$w.v.status", "completed"]}}
-                }
-            }
-        }},
-        {"$project": {
-            "_id": 0,
-            "email": 1,
-            "name": 1,
-            "user_name": 1,
-            "job_id": 1,
-            "created_at": 1,
-            "nudge_stage": {"$ifNull": ["$nudge_stage", 0]},
-            "nudge_history": {"$ifNull": ["$nudge_history", []]}
-        }}
-    ]
-
-    results = list(orders_collection.aggregate(pipeline))
+    ensure_workflow_counts(orders_collection, cutoff_utc, workflow_count_watcher)
+    results = fetch_nudge_candidates(orders_collection, cutoff_utc)
 
     filtered = []
     for r in results:
@@ -3802,111 +3673,55 @@ def send_stage1_nudge_email(
     email: str,
     user_name: str | None,
     child_name: str | None,
-    preview_link: str
+    preview_link: str,
+    meta: Optional[Dict[str, Any]] = None,
 ):
     user_name = ((user_name or "").strip().title()) or "there"
     child_name = ((child_name or "").strip().title()) or "your child"
 
     subject = f"{child_name}'s Diffrun Storybook is waiting!"
 
-    html = f"""
-    <html>
-      <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-        <p>Hi <strong>{user_name}</strong>,</p>
-
-        <p>
-          We noticed you began crafting a personalized storybook for
-          <strong>{child_name}</strong> — and it’s already looking magical!
-        </p>
-
-        <p>
-          Just one more step to bring it to life:
-          preview the story and place your order whenever you’re ready.
-        </p>
-
-        <p style="margin: 32px 0;">
-          <a href="{preview_link}"
-             style="background-color: #5784ba; color: white;
-                    padding: 14px 28px; border-radius: 6px;
-                    text-decoration: none; font-weight: bold;">
-            Preview & Continue
-          </a>
-        </p>
-
-        <p>
-          Your story is safe and waiting.
-          We’d love for <strong>{child_name}</strong> to see themselves in a story
-          made just for them.
-        </p>
-
-        <p>
-          Warm wishes,<br>
-          <strong>The Diffrun Team</strong>
-        </p>
-      </body>
-    </html>
-    """
+    html = render_email("nudge_stage1", user_name=user_name,
+                        child_name=child_name, preview_link=preview_link)
 
-    _send_html_email(email, subject, html)
+    _send_html_email(email, subject, html, kind="nudge", meta=meta)
 
 
 def send_stage2_nudge_email(
     email: str,
     user_name: str | None,
     child_name: str | None,
-    preview_link: str
+    preview_link: str,
+    meta: Optional[Dict[str, Any]] = None,
 ):
     user_name = ((user_name or "").strip().title()) or "there"
     child_name = ((child_name or "").strip().title()) or "your child"
 
     subject = f"Final reminder — {child_name}'s storybook is still waiting"
 
-    html = f"""
-    <html>
-      <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #222;">
-        <p>Hi <strong>{user_name}</strong>,</p>
-
-        <p>
-          {child_name}’s personalised story is ready —
-          over 300 parents completed their orders within 48 hours
-          and loved the results.
-        </p>
-
-        <p>
-          Complete the order now for faster dispatch
-          and a keepsake {child_name} will treasure.
-        </p>
-
-        <p style="margin: 22px 0;">
-          <a href="{preview_link}"
-             style="display: inline-block;
-                    padding: 12px 20px;
-                    border-radius: 6px;
-                    text-decoration: none;
-                    font-weight: 600;">
-            Finish & Order Now
-          </a>
-        </p>
-
-        <p>
-          Use code <strong>FAST10</strong> for 10% off —
-          valid for the next 24 hours only.
-        </p>
-
-        <p>
-          Need help finishing up?
-          Reply to this email and we’ll take care of the last steps.
-        </p>
-
-        <p>
-          Warmly,<br>
-          <strong>The Diffrun Team</strong>
-        </p>
-      </body>
-    </html>
-    """
+    html = render_email("nudge_stage2", user_name=user_name,
+                        child_name=child_name, preview_link=preview_link)
+
+    _send_html_email(email, subject, html, kind="nudge", meta=meta)
+
+
+def _on_nudge_sent(meta: Dict[str, Any]) -> None:
+    extra = {"stage": meta["stage"]} if "stage" in meta else {}
+    customer_contacts.record_sent(meta.get("email"), "nudge", meta.get("job_id"), **extra)
+
+
+def _on_nudge_parked(meta: Dict[str, Any], error: str) -> None:
+    job_id = meta.get("job_id")
+    if not job_id:
+        return
+    if "stage" in meta:
+        # staged nudges advanced nudge_stage before enqueue; put it back
+        record_parked(orders_collection, job_id, meta["stage"], meta.get("from_stage", 0), error)
+    else:
+        orders_collection.update_one({"job_id": job_id}, {"$set": {"nudge_sent": False}})
 
-    _send_html_email(email, subject, html)
+
+email_outbox.on_delivery("nudge", sent=_on_nudge_sent, failed=_on_nudge_parked)
 
 
 async def send_nudge_batches(batch_size: int = 200, days_window: int = 7):
@@ -3932,6 +3747,7 @@ async def send_nudge_batches(batch_size: int = 200, days_window: int = 7):
     )
 
     for batch in chunked_iterable(candidates, batch_size):
+        plans: List[NudgeSend] = []
         for user in batch:
             email = user.get("email")
             user_name = user.get("user_name")
@@ -3974,70 +3790,28 @@ async def send_nudge_batches(batch_size: int = 200, days_window: int = 7):
                     )
                     continue
 
-            def _send_and_record():
-                try:
-                    # ---- send mail ----
-                    if desired_stage == 1:
-                        send_stage1_nudge_email(
-                            email=email,
-                            user_name=user_name,
-                            child_name=child_name,
-                            preview_link=preview_link,
-                        )
-                    elif desired_stage == 2:
-                        send_stage2_nudge_email(
-                            email=email,
-                            user_name=user_name,
-                            child_name=child_name,
-                            preview_link=preview_link,
-                        )
-                    else:
-                        return
-
-                    # ---- advance stage atomically ----
-                    res = orders_collection.update_one(
-                        {"job_id": job_id, "nudge_stage": current_stage},
-                        {
-                            "$set": {
-                                "nudge_stage": desired_stage,
-                                "nudge_last_sent_at": datetime.now(timezone.utc),
-                            }
-                        }
-                    )
-
-                    if res.matched_count == 0:
-                        logger.warning(
-                            "Race condition: order %s stage changed, skipping update",
-                            job_id,
-                        )
-                        return
-
-                    # ---- mark history as sent ----
-                    upsert_nudge_history(
-                        job_id=job_id,
-                        stage=desired_stage,
-                        status="sent",
-                        error=None,
-                    )
-
-                    logger.info(
-                        f"✅ Sent stage {desired_stage} nudge to {email} (job_id={job_id})"
-                    )
-
-                except Exception as exc:
-                    # ---- overwrite failure state ----
-                    upsert_nudge_history(
-                        job_id=job_id,
-                        stage=desired_stage,
-                        status="failed",
-                        error=str(exc),
-                    )
-
-                    logger.exception(
-                        f"❌ Failed sending stage {desired_stage} to {email}: {exc}"
-                    )
-
-            await asyncio.to_thread(_send_and_record)
+            meta = {"job_id": job_id, "email": email,
+                    "stage": desired_stage, "from_stage": current_stage}
+            if desired_stage == 1:
+                send_fn = partial(send_stage1_nudge_email, email=email, user_name=user_name,
+                                  child_name=child_name, preview_link=preview_link, meta=meta)
+            else:
+                send_fn = partial(send_stage2_nudge_email, email=email, user_name=user_name,
+                                  child_name=child_name, preview_link=preview_link, meta=meta)
+
+            plans.append(NudgeSend(
+                job_id=job_id,
+                email=email,
+                stage=desired_stage,
+                from_stage=current_stage,
+                history_exists=stage_entry is not None,
+                send=send_fn,
+            ))
+
+        # orders are claimed (stage advanced) in one bulk_write, then sends run concurrently
+        # contacts are stamped on delivery (_on_nudge_sent), not here
+        counts = await asyncio.to_thread(dispatch_batch, orders_collection, plans)
+        logger.info(f"Nudge batch done: {counts}")
 
     logger.info("Completed all nudge batches.")
 
@@ -4054,23 +3828,8 @@ def send_nudge_email_to_user(email: str, user_name: str | None, child_name: str
     preview_link = order.get(
         "preview_url", f"https://diffrun.com/preview?job_id={job_id}&name={child_name}&book_id={book_id}")
 
-    html_content = f"""
-    <html>
-      <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-        <p>Hi <strong>{user_name}</strong>,</p>
-        <p>We noticed you began crafting a personalized storybook for <strong>{child_name}</strong> — and it’s already looking magical!</p>
-        <p>Just one more step to bring it to life: preview the story and place your order whenever you’re ready.</p>
-        <p style="margin: 32px 0;">
-          <a href="{preview_link}" 
-             style="background-color: #5784ba; color: white; padding: 14px 28px; border-radius: 6px; text-decoration: none; font-weight: bold;">
-            Preview & Continue
-          </a>
-        </p>
-        <p>Your story is safe and waiting. We’d love for <strong>{child_name}</strong> to see themselves in a story made just for them. 💫</p>
-        <p>Warm wishes,<br><strong>The Diffrun Team</strong></p>
-      </body>
-    </html>
-    """
+    html_content = render_email("nudge_reminder", user_name=user_name,
+                                child_name=child_name, preview_link=preview_link)
 
     msg = EmailMessage()
     msg["Subject"] = f"{child_name}'s Diffrun Storybook is waiting!"
@@ -4083,9 +3842,7 @@ def send_nudge_email_to_user(email: str, user_name: str | None, child_name: str
     if not EMAIL_USER or not EMAIL_PASS:
         raise RuntimeError("EMAIL_ADDRESS/EMAIL_PASSWORD not configured")
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-        smtp.login(EMAIL_USER, EMAIL_PASS)
-        smtp.send_message(msg)
+    queue_email(msg, kind="nudge", meta={"job_id": job_id, "email": email})
 
 
 def send_nudge_email():
@@ -4160,81 +3917,8 @@ def debug_nudge_candidates():
     cutoff_ist = now_ist - timedelta(days=7)
     cutoff_utc = cutoff_ist.astimezone(timezone.utc)
 
-    pipeline = [
-        {"$match": {
-            "created_at": {"$gte": cutoff_utc},
-            "email": {
-                "$exists": True,
-                "$ne": None,
-                "$not": {"$regex": "@lhmm\\.in$", "$options": "i"}
-            },
-            "workflows": {"$exists": True}
-        }},
-        {"$group": {
-            "_id": "$email",
-            "docs": {"$push": "$$ROOT"},
-            "has_paid_order": {
-                "$max": {
-                    "$cond": [
-                        {"$eq": ["$paid", True]},
-                        1,
-                        0
-                    ]
-                }
-            },
-            "latest_created_at": {"$max": "$created_at"}
-        }},
-        {"$match": {"has_paid_order": 0}},
-        {"$project": {
-            "email": "$_id",
-            "latest_doc": {
-                "$arrayElemAt": [
-                    {"$filter": {
-                        "input": "$docs",
-                        "as": "doc",
-                        "cond": {"$eq": ["$$doc.created_at", "$latest_created_at"]}
-                    }},
-                    0
-                ]
-            }
-        }},
-        {"$replaceRoot": {"newRoot": "$latest_doc"}},
-        {"$match": {
-            "paid": False,
-            "$or": [
-                {"nudge_stage": {"$exists": False}},  # no stage yet
-                {"nudge_stage": {"$in": [0, 1]}}       # we allow 0 or 1
-            ]
-        }},
-        {"$addFields": {
-            "wf_array": {"$objectToArray": "$workflows"},
-            "wf_count": {"$size": {"$objectToArray": "$workflows"}}
-        }},
-        {"$match": {"wf_count": 13}},
-        {"$match": {
-            "$expr": {
-                "$allElementsTrue": {
-                    "$map": {
-                        "input": "$wf_array",
-                        "as": "w",
-                        "in": {"$eq": ["$$w.v.status", "completed"]}
-                    }
-                }
-            }
-        }},
-        {"$project": {
-            "_id": 0,
-            "email": 1,
-            "name": 1,
-            "user_name": 1,
-            "job_id": 1,
-            "created_at": 1,
-            "nudge_stage": {"$ifNull": ["$nudge_stage", 0]},
-            "nudge_history": {"$ifNull": ["$nudge_history", []]}
-        }}
-    ]
-
-    mongo_results = list(orders_collection.aggregate(pipeline))
+    ensure_workflow_counts(orders_collection, cutoff_utc, workflow_count_watcher)
+    mongo_results = fetch_nudge_candidates(orders_collection, cutoff_utc)
 
     # Build compact output and format created_at into ISO + human-readable IST form
     output = []
@@ -4275,44 +3959,74 @@ def debug_nudge_candidates():
     }
 
 
-@app.post("/orders/unapprove")
-async def unapprove_orders(req: UnapproveRequest):
-    print(f"Unapprove request: {req}")
-    for job_id in req.job_ids:
-        print(f"Unapproving order with job_id: {job_id}")
+_UNAPPROVE_FOLDERS = ("final_coverpage/", "approved_output/")
+
+
+def _unapprove_and_move(job_ids: List[str]) -> List[Dict[str, Any]]:
+    """Unapprove every job, then move all their approved folders in one concurrent pass."""
+    report: Dict[str, Dict[str, Any]] = {}
+    pairs: List[Tuple[str, str]] = []
+    owner: Dict[str, str] = {}
+    prefixes: List[Tuple[str, str, str]] = []
+
+    for job_id in dict.fromkeys(job_ids):
         result = orders_collection.update_one(
             {"job_id": job_id},
             {"$set": {"approved": False}}
         )
-        print(f"Update result: {result}")
-        if result.modified_count == 0:
-            raise HTTPException(
-                status_code=404, detail=f"No order found with job_id {job_id}")
-
-    prefix = f"output/{job_id}/"
-    folders_to_move = ["final_coverpage/", "approved_output/"]
-    for folder in folders_to_move:
-        print(f"Moving folder: {folder}")
-        old_prefix = prefix + folder
-        new_prefix = prefix + "previous/" + folder
-
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=old_prefix)
-        print(f"List objects response: {response}")
-
-        if "Contents" not in response:
+        if result.matched_count == 0:
+            report[job_id] = {"job_id": job_id, "status": "not_found", "moved": 0, "errors": []}
             continue
+        report[job_id] = {"job_id": job_id, "status": "ok", "moved": 0, "errors": []}
+
+        prefix = f"output/{job_id}/"
+        for folder in _UNAPPROVE_FOLDERS:
+            old_prefix = prefix + folder
+            new_prefix = prefix + "previous/" + folder
+            try:
+                src_keys = s3_key_index.keys(s3, BUCKET_NAME, old_prefix, job_id=job_id)
+            except Exception as e:
+                report[job_id]["errors"].append(f"list {old_prefix}: {e}")
+                continue
+            for src_key in src_keys:
+                pairs.append((src_key, src_key.replace(old_prefix, new_prefix, 1)))
+                owner[src_key] = job_id
+            prefixes.append((job_id, old_prefix, new_prefix))
+
+    outcome = move_many(s3, BUCKET_NAME, pairs) if pairs else {}
+    for src_key, err in outcome.items():
+        entry = report[owner[src_key]]
+        if err:
+            entry["errors"].append(f"{src_key}: {err}")
+        else:
+            entry["moved"] += 1
+
+    for job_id, old_prefix, new_prefix in prefixes:
+        if report[job_id]["errors"]:
+            # some sources may still be in place: let the next access re-list
+            s3_key_index.invalidate(BUCKET_NAME, old_prefix)
+            s3_key_index.invalidate(BUCKET_NAME, new_prefix)
+        else:
+            s3_key_index.moved(BUCKET_NAME, old_prefix, new_prefix, job_id=job_id)
+
+    for entry in report.values():
+        if entry["status"] == "ok" and entry["errors"]:
+            entry["status"] = "partial"
+    return [report[j] for j in dict.fromkeys(job_ids)]
+
 
-        for obj in response["Contents"]:
-            src_key = obj["Key"]
-            dst_key = src_key.replace(old_prefix, new_prefix, 1)
-            print(f"Moving from: {src_key} to: {dst_key}")
+@app.post("/orders/unapprove")
+async def unapprove_orders(req: UnapproveRequest):
+    print(f"Unapprove request: {req}")
+    results = await asyncio.to_thread(_unapprove_and_move, list(req.job_ids))
 
-            s3.copy_object(Bucket=BUCKET_NAME, CopySource={
-                           "Bucket": BUCKET_NAME, "Key": src_key}, Key=dst_key)
-            s3.delete_object(Bucket=BUCKET_NAME, Key=src_key)
+    if results and all(r["status"] == "not_found" for r in results):
+        raise HTTPException(
+            status_code=404, detail=f"No order found with job_id {results[0]['job_id']}")
 
-    print(f"Unapproved {len(req.job_ids)} orders successfully")
-    return {"message": f"Unapproved {len(req.job_ids)} orders successfully"}
+    done = sum(1 for r in results if r["status"] != "not_found")
+    print(f"Unapproved {done} orders: {results}")
+    return {"message": f"Unapproved {done} orders successfully", "results": results}
 
 
 @app.get("/export-orders-csv")
@@ -4689,18 +4403,6 @@ def _parse_dt(value):
     return None
 
 
-def _pick_excel_engine():
-    try:
-        import xlsxwriter  # noqa: F401
-        return "xlsxwriter"
-    except Exception:
-        try:
-            import openpyxl  # noqa: F401
-            return "openpyxl"
-        except Exception:
-            return None
-
-
 def _fmt_ist(dt):
     try:
         if dt is None:
@@ -4720,150 +4422,36 @@ def _fmt_ist(dt):
 AWS_REGION = os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION")
 
 
-def _get_ec2_status_rows():
-    try:
-        if not AWS_REGION:
-            return [], "AWS region not set. Set AWS_REGION or AWS_DEFAULT_REGION."
-
-        ec2 = get_ec2_client()
-        resp = ec2.describe_instances(InstanceIds=INSTANCE_IDS)
-        reservations = resp.get("Reservations", [])
-
-        # Gather instance ids for status checks
-        instance_ids = [
-            inst["InstanceId"]
-            for r in reservations
-            for inst in r.get("Instances", [])
-        ]
-        checks_map = {}
-        if instance_ids:
-            status_resp = ec2.describe_instance_status(
-                InstanceIds=instance_ids, IncludeAllInstances=True
-            )
-            for s in status_resp.get("InstanceStatuses", []):
-                checks_map[s["InstanceId"]] = {
-                    "InstanceStatus": s.get("InstanceStatus", {}).get("Status", ""),
-                    "SystemStatus": s.get("SystemStatus", {}).get("Status", ""),
-                }
-
-        now_ist = datetime.utcnow().replace(tzinfo=timezone.utc).astimezone(IST)
-        rows = []
-        for r in reservations:
-            for inst in r.get("Instances", []):
-                iid = inst.get("InstanceId", "")
-                state = (inst.get("State") or {}).get("Name", "")
-                name = ""
-                for tag in inst.get("Tags", []) or []:
-                    if tag.get("Key") == "Name":
-                        name = tag.get("Value") or ""
-                        break
-
-                rows.append({
-                    "Name": name,
-                    "InstanceId": iid,
-                    "State": state,                           # running/stopped/…
-                    "OnOff": "on" if state == "running" else "off",
-                    "InstanceStatus": checks_map.get(iid, {}).get("InstanceStatus", ""),
-                    "SystemStatus": checks_map.get(iid, {}).get("SystemStatus", ""),
-                    "PublicIP": inst.get("PublicIpAddress", ""),
-                    "PrivateIP": inst.get("PrivateIpAddress", ""),
-                    "LaunchTime_IST": _fmt_ist(inst.get("LaunchTime")),
-                    "CheckedAt_IST": now_ist.strftime("%Y-%m-%d %H:%M:%S"),
-                })
-
-        return rows, None
+EC2_STATUS_REFRESH_SECONDS = int(os.getenv("EC2_STATUS_REFRESH_SECONDS", "120"))
 
-    except (BotoCoreError, ClientError) as e:
-        return [], f"AWS error: {e}"
-    except Exception as e:
-        return [], f"Unexpected error: {e}"
+# background-refreshed fleet snapshot; exports read it from memory
+ec2_status_provider = Ec2StatusProvider(
+    INSTANCE_IDS,
+    get_ec2_client,
+    stale_after_seconds=max(EC2_STATUS_REFRESH_SECONDS * 5, 300),
+)
 
 
 def _get_ec2_status_rows() -> Tuple[List[dict], Optional[str]]:
     """
-    Return (rows, err).  Skips any missing instance IDs instead of failing.
-    rows schema includes keys used later: OnOff, Name, InstanceId (plus extras).
+    Return (rows, err) from the cached EC2 snapshot. Missing instance IDs are skipped.
+    rows schema includes keys used later: OnOff, Name, InstanceId, InstanceStatus, SystemStatus (plus extras).
     """
-    ec2 = get_ec2_client()
-
-    # Source of instance IDs: keep whatever you already use
-    # Example: a global/list env. Do NOT change your current source; just read it.
-    # If you already have EC2_INSTANCE_IDS somewhere, keep that.
-    instance_ids: List[str] = INSTANCE_IDS  # type: ignore[name-defined]
-
-    rows: List[dict] = []
-    if not instance_ids:
-        # Nothing to do; do not error
-        return rows, None
-
-    def chunks(lst, n):
-        for i in range(0, len(lst), n):
-            yield lst[i:i + n]
+    if not AWS_REGION:
+        return [], "AWS region not set. Set AWS_REGION or AWS_DEFAULT_REGION."
+    return ec2_status_provider.rows()
 
-    skipped: List[str] = []
 
-    for chunk in chunks(instance_ids, 100):
-        to_query = list(chunk)
-        if not to_query:
-            continue
-
-        while to_query:
-            try:
-                resp = ec2.describe_instances(InstanceIds=to_query)
-            except ClientError as e:
-                code = e.response.get("Error", {}).get("Code")
-                if code == "InvalidInstanceID.NotFound":
-                    # Extract bad IDs from the message and drop them
-                    msg = e.response.get("Error", {}).get("Message", "")
-                    bad = re.findall(r"i-[0-9a-f]+", msg)
-                    if not bad:
-                        # If we can't parse, skip this whole chunk and move on
-                        logging.warning(
-                            "EC2: could not parse missing IDs from: %s", msg)
-                        break
-                    skipped.extend(bad)
-                    to_query = [i for i in to_query if i not in bad]
-                    if not to_query:
-                        break
-                    # retry with the remaining IDs
-                    continue
-                else:
-                    # Any other AWS error: surface a single error string (optional)
-                    logging.exception("EC2 describe_instances failed")
-                    return rows, f"AWS error: {e}"
-
-            # Process reservations -> instances
-            for r in resp.get("Reservations", []):
-                for inst in r.get("Instances", []):
-                    iid = inst.get("InstanceId", "")
-                    state = (inst.get("State", {}) or {}).get("Name", "")
-                    # OnOff field as int (1 running, 0 otherwise), matches your sort later
-                    onoff = 1 if state == "running" else 0
-                    # Name tag
-                    name = ""
-                    for t in inst.get("Tags", []) or []:
-                        if t.get("Key") == "Name":
-                            name = t.get("Value", "")
-                            break
-                    rows.append({
-                        "OnOff": onoff,
-                        "Name": name,
-                        "InstanceId": iid,
-                        "State": state,
-                        "Type": inst.get("InstanceType", ""),
-                        "AZ": (inst.get("Placement", {}) or {}).get("AvailabilityZone", ""),
-                        "PrivateIP": inst.get("PrivateIpAddress", ""),
-                        "PublicIP": inst.get("PublicIpAddress", ""),
-                        "LaunchTime": inst.get("LaunchTime", ""),
-                    })
-            break  # exit the inner while after successful call
-
-    if skipped:
-        logging.warning("EC2: skipped missing instance IDs: %s",
-                        ", ".join(skipped))
-
-    # IMPORTANT: we return no error so the caller writes 'ec2_status' (not *_error)
-    return rows, None
+def _write_ec2_status_sheet(xw: XlsxExportWriter) -> None:
+    """Raw EC2 rows as the ec2_status sheet (or ec2_status_error) for the download endpoints."""
+    ec2_rows, ec2_err = _get_ec2_status_rows()
+    if ec2_err:
+        xw.add_sheet("ec2_status_error").write_frame(
+            pd.DataFrame([{"error": ec2_err}]), index=False)
+        return
+    ws = xw.add_sheet("ec2_status")
+    ws.freeze(1, 0)
+    ws.write_frame(pd.DataFrame(ec2_rows), index=False)
 
 
 @app.get("/download-csv")
@@ -4944,124 +4532,26 @@ def download_xlsx(from_date: str = Query(...), to_date: str = Query(...)):
         if from_dt > to_dt:
             return Response("from_date cannot be after to_date", media_type="text/plain", status_code=400)
 
-        # Query Mongo (exclude _id)
-        data = list(collection_df.find(
-            {TIMESTAMP_FIELD: {"$gte": from_dt, "$lte": to_dt}},
-            {"_id": 0}
-        ))
-        if not data:
+        # Count room_id by (ist-date x ist-hour) inside Mongo, with Total row/col
+        pivot, matched = hourly_pivot(collection_df, from_dt, to_dt)
+        if not matched:
             return Response("No data available", media_type="text/plain", status_code=404)
 
-        # Build rows + IST columns
-        rows_out = []
-        for row in data:
-            r = dict(row)
-            base_ts = _parse_dt(r.get(TIMESTAMP_FIELD))
-
-            r["date"] = ""
-            r["hour"] = ""
-            r["date-hour"] = ""
-            r["ist-date"] = ""
-            r["ist-hour"] = ""
-
-            if base_ts is not None:
-                ist_ts = base_ts + IST_OFFSET  # remove if DB already stores IST
-                r["date"] = base_ts.strftime("%d/%m/%Y")
-                r["hour"] = base_ts.strftime("%H")
-                r["date-hour"] = ist_ts.strftime("%Y-%m-%d %H:%M:%S")
-                r["ist-date"] = ist_ts.strftime("%d/%m/%Y")
-                r["ist-hour"] = ist_ts.strftime("%H")
-
-            rows_out.append(r)
-
-        df = pd.DataFrame(rows_out)
-
-        # Ensure required columns exist
-        for col in ["ist-date", "ist-hour", "room_id"]:
-            if col not in df.columns:
-                df[col] = ""
-
-        # Build pivot: count of room_id by (ist-date x ist-hour)
-        hours = [f"{h:02d}" for h in range(24)]
-        df["ist-hour"] = df["ist-hour"].astype(str)
-        pivot = pd.pivot_table(
-            df, index="ist-date", columns="ist-hour",
-            values="room_id", aggfunc="count", fill_value=0
-        )
-        pivot = pivot.reindex(columns=hours, fill_value=0)
-
-        # Sort ist-date as real dates when possible
-        def _date_key(x):
-            try:
-                return datetime.strptime(x, "%d/%m/%Y")
-            except Exception:
-                return x
-        pivot = pivot.sort_index(key=lambda idx: [_date_key(x) for x in idx])
-
-        # Totals
-        pivot["Total"] = pivot.sum(axis=1)
-        pivot.loc["Total"] = pivot.sum(numeric_only=True)
-
-        # Pick an engine we actually have
-        engine = _pick_excel_engine()
-        if engine is None:
-            return Response(
-                "Missing Excel writer engine. Install one of: pip install xlsxwriter OR pip install openpyxl",
-                media_type="text/plain", status_code=500
-            )
+        # Stream the workbook: rows go straight to a spooled temp file
+        xw = XlsxExportWriter()
+        ws_pivot = xw.add_sheet("pivot")
+        ws_pivot.freeze(1, 1)  # row 2, col B
+        ws_pivot.write_frame(pivot)
+        _write_ec2_status_sheet(xw)
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine=engine) as writer:
-            # Sheet 1: raw/orders
-            # df.to_excel(writer, index=False, sheet_name="orders")
-            # Sheet 2: pivot
-            pivot.to_excel(writer, sheet_name="pivot")
-
-            # ✅ NEW: Sheet 3 — EC2 status
-            ec2_rows, ec2_err = _get_ec2_status_rows()
-            if ec2_err:
-                pd.DataFrame([{"error": ec2_err}]).to_excel(
-                    writer, index=False, sheet_name="ec2_status_error"
-                )
-            else:
-                ec2_df = pd.DataFrame(ec2_rows)
-                if not ec2_df.empty:
-                    for col in ec2_df.columns:
-                        if pd.api.types.is_datetime64tz_dtype(ec2_df[col]):
-                            ec2_df[col] = ec2_df[col].dt.tz_convert(
-                                'UTC').dt.tz_localize(None)
-                        elif ec2_df[col].dtype == "object":
-                            if ec2_df[col].apply(lambda v: isinstance(v, datetime) and getattr(v, "tzinfo", None) is not None).any():
-                                ec2_df[col] = ec2_df[col].apply(_to_naive_utc)
-                ec2_df.to_excel(writer, index=False, sheet_name="ec2_status")
-
-            # Freeze panes (engine-specific)
-            if engine == "xlsxwriter":
-                # ws1 = writer.sheets["orders"]
-                ws1 = writer.sheets["pivot"]
-                ws2 = writer.sheets.get("ec2_status")
-                # if ws1:ws1.freeze_panes(1, 0)  # row 2
-                if ws1:
-                    ws1.freeze_panes(1, 1)  # row 2, col B
-                if ws2:
-                    ws2.freeze_panes(1, 0)
-
-            else:  # openpyxl
-                # ws1 = writer.sheets.get("orders")
-                ws1 = writer.sheets.get("pivot")
-                ws2 = writer.sheets.get("ec2_status")
-                # if ws1 is not None: ws1.freeze_panes = "A2"
-                if ws1 is not None:
-                    ws1.freeze_panes = "B2"
-                if ws2 is not None:
-                    ws2.freeze_panes = "A2"
-
-        output.seek(0)
         filename = f"darkfantasy_{from_date}_to_{to_date}.xlsx"
-        headers = {"Content-Disposition": f"attachment; filename={filename}"}
+        headers = {
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Content-Length": str(xw.size()),
+        }
         return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            xw.iter_chunks(),
+            media_type=XLSX_MEDIA_TYPE,
             headers=headers
         )
 
@@ -5080,129 +4570,30 @@ def download_xlsx_yippee(from_date: str = Query(...), to_date: str = Query(...))
         if from_dt > to_dt:
             return Response("from_date cannot be after to_date", media_type="text/plain", status_code=400)
 
-        # Query Yippee collection (exclude _id)
-        data = list(
-            collection_yippee.find(
-                {TIMESTAMP_FIELD: {"$gte": from_dt, "$lte": to_dt}},
-                {"_id": 0},
-            )
-        )
-        if not data:
+        # Pivot: count of room_id by (ist-date × ist-hour), grouped in Mongo
+        pivot, matched = hourly_pivot(collection_yippee, from_dt, to_dt)
+        if not matched:
             return Response("No data available", media_type="text/plain", status_code=404)
 
-        # Build rows + IST helper columns (same logic as your DF endpoint)
-        rows_out = []
-        for row in data:
-            r = dict(row)
-            base_ts = _parse_dt(r.get(TIMESTAMP_FIELD))
-
-            r["date"] = ""
-            r["hour"] = ""
-            r["date-hour"] = ""
-            r["ist-date"] = ""
-            r["ist-hour"] = ""
-
-            if base_ts is not None:
-                ist_ts = base_ts + IST_OFFSET  # keep same assumption as DF endpoint
-                r["date"] = base_ts.strftime("%d/%m/%Y")
-                r["hour"] = base_ts.strftime("%H")
-                r["date-hour"] = ist_ts.strftime("%Y-%m-%d %H:%M:%S")
-                r["ist-date"] = ist_ts.strftime("%d/%m/%Y")
-                r["ist-hour"] = ist_ts.strftime("%H")
-
-            rows_out.append(r)
-
-        df = pd.DataFrame(rows_out)
+        # Stream the workbook (same layout as the DF endpoint)
+        xw = XlsxExportWriter()
+        ws_pivot = xw.add_sheet("pivot")
+        ws_pivot.freeze(1, 1)  # row 2, col B
+        ws_pivot.write_frame(pivot)
+        _write_ec2_status_sheet(xw)
 
-        # Ensure required columns exist
-        for col in ["ist-date", "ist-hour", "room_id"]:
-            if col not in df.columns:
-                df[col] = ""
-
-        # Pivot: count of room_id by (ist-date × ist-hour)
-        hours = [f"{h:02d}" for h in range(24)]
-        df["ist-hour"] = df["ist-hour"].astype(str)
-        pivot = pd.pivot_table(
-            df,
-            index="ist-date",
-            columns="ist-hour",
-            values="room_id",
-            aggfunc="count",
-            fill_value=0,
+        filename = f"yippee_{from_date}_to_{to_date}.xlsx"
+        headers = {
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Content-Length": str(xw.size()),
+        }
+        return StreamingResponse(
+            xw.iter_chunks(),
+            media_type=XLSX_MEDIA_TYPE,
+            headers=headers,
         )
-        pivot = pivot.reindex(columns=hours, fill_value=0)
-
-        # Sort ist-date as real dates when possible
-        def _date_key(x):
-            try:
-                return datetime.strptime(x, "%d/%m/%Y")
-            except Exception:
-                return x
-
-        pivot = pivot.sort_index(key=lambda idx: [_date_key(x) for x in idx])
-
-        # Totals
-        pivot["Total"] = pivot.sum(axis=1)
-        pivot.loc["Total"] = pivot.sum(numeric_only=True)
-
-        # Pick writer engine
-        engine = _pick_excel_engine()
-        if engine is None:
-            return Response(
-                "Missing Excel writer engine. Install one of: pip install xlsxwriter OR pip install openpyxl",
-                media_type="text/plain",
-                status_code=500,
-            )
-
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine=engine) as writer:
-            # pivot sheet
-            pivot.to_excel(writer, sheet_name="pivot")
-
-            # EC2 status sheet (same as DF)
-            ec2_rows, ec2_err = _get_ec2_status_rows()
-            if ec2_err:
-                pd.DataFrame([{"error": ec2_err}]).to_excel(
-                    writer, index=False, sheet_name="ec2_status_error"
-                )
-            else:
-                ec2_df = pd.DataFrame(ec2_rows)
-                if not ec2_df.empty:
-                    for col in ec2_df.columns:
-                        if pd.api.types.is_datetime64tz_dtype(ec2_df[col]):
-                            ec2_df[col] = ec2_df[col].dt.tz_convert(
-                                'UTC').dt.tz_localize(None)
-                        elif ec2_df[col].dtype == "object":
-                            if ec2_df[col].apply(lambda v: isinstance(v, datetime) and getattr(v, "tzinfo", None) is not None).any():
-                                ec2_df[col] = ec2_df[col].apply(_to_naive_utc)
-                ec2_df.to_excel(writer, index=False, sheet_name="ec2_status")
-
-            # Freeze panes
-            if engine == "xlsxwriter":
-                ws1 = writer.sheets["pivot"]
-                ws2 = writer.sheets.get("ec2_status")
-                if ws1:
-                    ws1.freeze_panes(1, 1)  # row 2, col B
-                if ws2:
-                    ws2.freeze_panes(1, 0)
-            else:  # openpyxl
-                ws1 = writer.sheets.get("pivot")
-                ws2 = writer.sheets.get("ec2_status")
-                if ws1 is not None:
-                    ws1.freeze_panes = "B2"
-                if ws2 is not None:
-                    ws2.freeze_panes = "A2"
-
-        output.seek(0)
-        filename = f"yippee_{from_date}_to_{to_date}.xlsx"
-        headers = {"Content-Disposition": f"attachment; filename={filename}"}
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers=headers,
-        )
-    except Exception as e:
-        return Response(f"❌ Error building XLSX: {e}", media_type="text/plain", status_code=500)
+    except Exception as e:
+        return Response(f"❌ Error building XLSX: {e}", media_type="text/plain", status_code=500)
 
 
 def _format_ec2_status_table(rows: List[dict]) -> pd.DataFrame:
@@ -5222,32 +4613,11 @@ def _format_ec2_status_table(rows: List[dict]) -> pd.DataFrame:
     # Map OnOff 1/0 -> "on"/"off"
     df["OnOff"] = df.get("OnOff", 0).map({1: "on", 0: "off"}).fillna("off")
 
-    # Resolve statuses from DescribeInstanceStatus (include stopped)
-    status_map = {}
-    ec2 = get_ec2_client()
-    ids = [i for i in df.get("InstanceId", []).tolist(
-    ) if isinstance(i, str) and i.startswith("i-")]
-    for i in range(0, len(ids), 100):
-        chunk = ids[i:i+100]
-        try:
-            resp = ec2.describe_instance_status(
-                InstanceIds=chunk, IncludeAllInstances=True)
-            for st in resp.get("InstanceStatuses", []):
-                iid = st.get("InstanceId", "")
-                inst_status = (st.get("InstanceStatus", {}) or {}).get(
-                    "Status", "not-applicable")
-                sys_status = (st.get("SystemStatus", {}) or {}
-                              ).get("Status", "not-applicable")
-                status_map[iid] = (
-                    inst_status or "not-applicable", sys_status or "not-applicable")
-        except ClientError as e:
-            logging.warning(
-                "describe_instance_status failed for %s: %s", chunk, e)
-
-    df["InstanceStatus"] = df["InstanceId"].map(
-        lambda x: status_map.get(x, ("not-applicable", "not-applicable"))[0])
-    df["SystemStatus"] = df["InstanceId"].map(
-        lambda x: status_map.get(x, ("not-applicable", "not-applicable"))[1])
+    # Statuses come with the cached rows (describe_instance_status runs in the provider refresh)
+    for col in ("InstanceStatus", "SystemStatus"):
+        if col not in df.columns:
+            df[col] = "not-applicable"
+        df[col] = df[col].fillna("not-applicable").replace("", "not-applicable")
 
     # LaunchTime -> UTC date string (YYYY-MM-DD), safe for Excel
     def _to_naive_utc(x):
@@ -5272,62 +4642,27 @@ def _format_ec2_status_table(rows: List[dict]) -> pd.DataFrame:
     return out.fillna("")
 
 
-def _export_xlsx_bytes(from_dt_utc: datetime, to_dt_utc: datetime) -> Tuple[bytes, str]:
-    # ---- helpers ----
-    def _load_df_for_collection(mongo_collection) -> pd.DataFrame:
-        mongo_filter = {TIMESTAMP_FIELD: {
-            "$gte": from_dt_utc, "$lte": to_dt_utc}}
-        projection = {"_id": 0}
-        data = list(mongo_collection.find(mongo_filter, projection))
-        rows_out = []
-        if data:
-            for row in data:
-                r = dict(row)
-                base_ts = _parse_dt(r.get(TIMESTAMP_FIELD))
-                r["date"] = ""
-                r["hour"] = ""
-                r["date-hour"] = ""
-                r["ist-date"] = ""
-                r["ist-hour"] = ""
-                if base_ts is not None:
-                    ist_ts = base_ts + IST_OFFSET
-                    r["date"] = base_ts.strftime("%d/%m/%Y")
-                    r["hour"] = base_ts.strftime("%H")
-                    r["date-hour"] = ist_ts.strftime("%Y-%m-%d %H:%M:%S")
-                    r["ist-date"] = ist_ts.strftime("%d/%m/%Y")
-                    r["ist-hour"] = ist_ts.strftime("%H")
-                rows_out.append(r)
-            df = pd.DataFrame(rows_out)
-        else:
-            df = pd.DataFrame(columns=["ist-date", "ist-hour"])
+EXPORT_LEG_TIMEOUT_SECONDS = float(os.getenv("EXPORT_LEG_TIMEOUT_SECONDS", "90"))
+# EC2 status is read from the background-refreshed snapshot, so it gets a short leash
+EXPORT_EC2_LEG_TIMEOUT_SECONDS = float(os.getenv("EXPORT_EC2_LEG_TIMEOUT_SECONDS", "15"))
 
-        for col in ["ist-date", "ist-hour", "room_id"]:
-            if col not in df.columns:
-                df[col] = ""
-        if "ist-hour" in df.columns:
-            df["ist-hour"] = df["ist-hour"].astype(str)
-        return df
 
-    def _build_pivot(df: pd.DataFrame) -> pd.DataFrame:
-        hours = [f"{h:02d}" for h in range(24)]
-        if df.empty:
+def _build_export_workbook(
+    from_dt_utc: datetime, to_dt_utc: datetime, use_cache: bool = True
+) -> Tuple[XlsxExportWriter, str]:
+    # ---- helpers ----
+    def _load_counts(source: str, mongo_collection):
+        # finished IST hours come from xlsx_pivot_cache; only open hours hit the cluster
+        if use_cache:
+            return xlsx_pivot_cache.hourly_counts(
+                source, mongo_collection, from_dt_utc, to_dt_utc)
+        return fetch_hourly_counts(mongo_collection, from_dt_utc, to_dt_utc)
+
+    def _build_pivot(counts) -> pd.DataFrame:
+        if not counts:
             return pd.DataFrame([{"error": "No data in range"}])
         try:
-            piv = pd.pivot_table(
-                df, index="ist-date", columns="ist-hour",
-                values="room_id", aggfunc="count", fill_value=0
-            )
-            piv = piv.reindex(columns=hours, fill_value=0)
-
-            def _date_key(x):
-                try:
-                    return datetime.strptime(x, "%d/%m/%Y")
-                except Exception:
-                    return x
-            piv = piv.sort_index(key=lambda idx: [_date_key(x) for x in idx])
-            piv["Total"] = piv.sum(axis=1)
-            piv.loc["Total"] = piv.sum(numeric_only=True)
-            return piv
+            return counts_to_matrix(counts)
         except Exception as e:
             return pd.DataFrame([{"error": f"pivot build failed: {e}"}])
 
@@ -5360,126 +4695,89 @@ def _export_xlsx_bytes(from_dt_utc: datetime, to_dt_utc: datetime) -> Tuple[byte
         section.loc[f"Total ({n_days}d)"] = section.sum(numeric_only=True)
         return section
 
-    # ---- main & yippee pivots ----
-    df_main = _load_df_for_collection(collection_df)
-    pivot_main_full = _build_pivot(df_main)
+    def _load_ec2_sheet() -> Tuple[pd.DataFrame, str]:
+        ec2_rows, ec2_err = _get_ec2_status_rows()
+        if ec2_err:
+            return pd.DataFrame([{"error": ec2_err}]), "ec2_status_error"
+        ec2_df = _format_ec2_status_table(ec2_rows)
+        if not ec2_df.empty:
+            ec2_df["__on__"] = (ec2_df["OnOff"] == "on").astype(int)
+            ec2_df = ec2_df.sort_values(["__on__", "Name", "InstanceId"], ascending=[
+                                        False, True, True]).drop(columns="__on__")
+        return ec2_df, "ec2_status"
+
+    # ---- fan out: DF cluster, Yippee cluster and EC2 are independent remote legs ----
+    legs = run_legs(
+        {
+            "darkfantasy": lambda: _load_counts("darkfantasy", collection_df),
+            "yippee": lambda: _load_counts("yippee", collection_yippee),
+            "ec2": _load_ec2_sheet,
+        },
+        timeout_s={
+            "darkfantasy": EXPORT_LEG_TIMEOUT_SECONDS,
+            "yippee": EXPORT_LEG_TIMEOUT_SECONDS,
+            "ec2": EXPORT_EC2_LEG_TIMEOUT_SECONDS,
+        },
+        label="XLSX-EXPORT",
+    )
+
+    def _pivot_from_leg(leg) -> Tuple[dict, int, pd.DataFrame]:
+        if not leg.ok:
+            return {}, 0, pd.DataFrame([{"error": f"{leg.name}: {leg.error}"}])
+        counts, matched = leg.value
+        return counts, matched, _build_pivot(counts)
+
+    # ---- main & yippee pivots (grouped by IST date x hour in Mongo) ----
+    counts_main, matched_main, pivot_main_full = _pivot_from_leg(
+        legs["darkfantasy"])
+    counts_yip, _, pivot_yip_full = _pivot_from_leg(legs["yippee"])
 
     # filename
     filename = (
         f"export_{from_dt_utc.strftime('%Y%m%d_%H%M%S')}_to_{to_dt_utc.strftime('%Y%m%d_%H%M%S')}.xlsx"
-        if not df_main.empty
+        if matched_main
         else f"export_empty_{from_dt_utc.date()}_{to_dt_utc.date()}.xlsx"
     )
 
-    df_yip = _load_df_for_collection(collection_yippee)
-    pivot_yip_full = _build_pivot(df_yip)
-
     # keep full main block as-is; yippee = last 4 IST days
     pivot_main = pivot_main_full.copy()
     pivot_yippee = _slice_last_n_days(pivot_yip_full, 4)
 
     # ---- combined (DF + Yippee) hour-wise sums per day ----
-    def _strip_totals(piv: pd.DataFrame) -> pd.DataFrame:
-        if piv.empty or "error" in piv.columns:
-            return pd.DataFrame()
-        if "Total" in piv.index:
-            piv = piv.drop(index="Total")
-        hours = [f"{h:02d}" for h in range(24)]
-        cols = [c for c in piv.columns if c in hours]
-        return piv[cols].copy()
-
-    hours = [f"{h:02d}" for h in range(24)]
-    m_hours = _strip_totals(pivot_main_full)
-    y_hours = _strip_totals(pivot_yip_full)
-
-    # union of dates
-    all_days = sorted(set(m_hours.index) | set(y_hours.index),
-                      key=lambda x: datetime.strptime(x, "%d/%m/%Y") if isinstance(x, str) else x)
-    combined = pd.DataFrame(0, index=all_days, columns=hours)
-    if not m_hours.empty:
-        m_aligned = m_hours.reindex(
-            index=all_days, columns=hours, fill_value=0)
-        combined = combined.add(m_aligned, fill_value=0)
-    if not y_hours.empty:
-        y_aligned = y_hours.reindex(
-            index=all_days, columns=hours, fill_value=0)
-        combined = combined.add(y_aligned, fill_value=0)
-    # totals
-    if not combined.empty:
-        combined["Total"] = combined.sum(axis=1)
-        combined.loc["Total (COMBINED)"] = combined.sum(numeric_only=True)
+    combined_counts = merge_counts(counts_main.items(), counts_yip.items())
+    if combined_counts:
+        combined = counts_to_matrix(
+            combined_counts, total_label="Total (COMBINED)")
     else:
         combined = pd.DataFrame([{"info": "No data to combine"}])
 
     # ---- Write workbook with headings and blocks ----
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-        ws_name = "pivot"
-        start_row = 0
-
-        # Heading 1
-        pd.DataFrame({"Dark fantasy": []}).to_excel(
-            writer, sheet_name=ws_name, index=False, header=True, startrow=start_row
-        )
-        start_row += 1
-
-        # DF block
-        pivot_main.to_excel(writer, sheet_name=ws_name, startrow=start_row)
-        start_row += (pivot_main.shape[0] + 4)  # leave some space
-
-        # Heading 2
-        pd.DataFrame({"Yippee": []}).to_excel(
-            writer, sheet_name=ws_name, index=False, header=True, startrow=start_row
-        )
-        start_row += 1
-
-        # Yippee block
-        pivot_yippee.to_excel(writer, sheet_name=ws_name, startrow=start_row)
-        start_row += (pivot_yippee.shape[0] + 4)
+    xw = XlsxExportWriter()
+    ws = xw.add_sheet("pivot")
+    write_blocks(ws, [
+        ("Dark fantasy", pivot_main),
+        ("Yippee", pivot_yippee),
+        ("Combined (DF + Yippee)", combined),
+    ])
 
-        # Heading 3
-        pd.DataFrame({"Combined (DF + Yippee)": []}).to_excel(
-            writer, sheet_name=ws_name, index=False, header=True, startrow=start_row
-        )
-        start_row += 1
+    # EC2 status sheet (loaded concurrently above)
+    ec2_leg = legs["ec2"]
+    if ec2_leg.ok:
+        ec2_df, ec2_sheet_name = ec2_leg.value
+    else:
+        ec2_df = pd.DataFrame([{"error": f"ec2: {ec2_leg.error}"}])
+        ec2_sheet_name = "ec2_status_error"
+    ws2 = xw.add_sheet(ec2_sheet_name)
+    ws2.freeze(1, 0)
+    ws2.write_frame(ec2_df, index=False)
 
-        # Combined block
-        combined.to_excel(writer, sheet_name=ws_name, startrow=start_row)
+    xw.close()
+    return xw, filename
 
-        # EC2 status sheet
-        ec2_rows, ec2_err = _get_ec2_status_rows()
-        if ec2_err:
-            ec2_df = pd.DataFrame([{"error": ec2_err}])
-            ec2_sheet_name = "ec2_status_error"
-        else:
-            ec2_df = _format_ec2_status_table(ec2_rows)
-            if not ec2_df.empty:
-                ec2_df["__on__"] = (ec2_df["OnOff"] == "on").astype(int)
-                ec2_df = ec2_df.sort_values(["__on__", "Name", "InstanceId"], ascending=[
-                                            False, True, True]).drop(columns="__on__")
-            ec2_sheet_name = "ec2_status"
-        ec2_df.to_excel(writer, index=False, sheet_name=ec2_sheet_name)
-
-        # Freeze panes (optional: top headings won’t freeze across all blocks cleanly)
-        ws2 = writer.sheets.get(ec2_sheet_name)
-        if ws2 is not None:
-            ws2.freeze_panes = "A2"
-
-        # Basic formatting for headings (bold) via openpyxl
-        ws = writer.sheets.get(ws_name)
-        if ws is not None:
-            for r in [1,                     # "Dark fantasy"
-                      1 + pivot_main.shape[0] + 4 + 1,  # "Yippee"
-                      # "Combined"
-                      1 + pivot_main.shape[0] + 4 + 1 + pivot_yippee.shape[0] + 4 + 1]:
-                try:
-                    ws.cell(row=r, column=1).font = ws.cell(
-                        row=r, column=1).font.copy(bold=True)
-                except Exception:
-                    pass
 
-    buf.seek(0)
-    return buf.read(), filename
+def _export_xlsx_bytes(from_dt_utc: datetime, to_dt_utc: datetime, use_cache: bool = True) -> Tuple[bytes, str]:
+    xw, filename = _build_export_workbook(from_dt_utc, to_dt_utc, use_cache)
+    return xw.getvalue(), filename
 
 
 def _send_email_with_attachment(subject: str, body_html: str, attachment_name: str, attachment_bytes: bytes):
@@ -5510,17 +4808,14 @@ def _send_email_with_attachment(subject: str, body_html: str, attachment_name: s
     )
 
     try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as server:
-            # STARTTLS path (most common). If you use port 465, switch to SMTP_SSL.
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASS)
-            server.send_message(msg)
+        # "export" account = SMTP_HOST/SMTP_PORT/SMTP_USER (STARTTLS unless port 465)
+        queue_email(msg, account="export", kind="export")
         logger.info(
             f"SMTP: host={SMTP_HOST}:{SMTP_PORT} as={SMTP_USER} to={EMAIL_TO}")
 
-        logger.info("📧 Export email sent.")
+        logger.info("📧 Export email queued.")
     except Exception as e:
-        logger.exception("Failed to send export email")
+        logger.exception("Failed to queue export email")
 
 
 def _run_export_and_email():
@@ -5564,19 +4859,6 @@ def debug_scheduler_jobs():
     return out
 
 
-try:
-    scheduler.add_job(
-        _hourly_reconcile_and_email,
-        CronTrigger(minute=0, timezone=IST_TZ),
-        id="reconcile_email_hourly",
-        replace_existing=True,
-        max_instances=1,  # don't overlap runs
-        coalesce=True     # skip missed to one
-    )
-except Exception:
-    logger.exception("Failed to register reconcile email hourly job")
-
-
 @app.post("/debug/run-export-now")
 def debug_run_export_now():
     # Manually trigger the XLSX export + email once
@@ -5594,16 +4876,26 @@ def debug_email_ping():
     msg["Subject"] = "Ping from Diffrun backend"
     msg.set_content("If you see this, SMTP + routing works.")
     try:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as s:
-            s.starttls()
-            s.login(SMTP_USER, SMTP_PASS)
-            refused = s.send_message(msg)
+        # synchronous on purpose: this checks SMTP reachability + login
+        refused = email_outbox.send_now(msg, account="export")
         return {"ok": True, "refused": refused}
     except Exception as e:
         logger.exception("Ping email failed")
         return {"ok": False, "error": str(e)}
 
 
+def _on_feedback_parked(meta: Dict[str, Any], error: str) -> None:
+    # not delivered: clear the once-only stamps; contacts re-marks it due (bounded retries)
+    email = meta.get("email")
+    if not email:
+        return
+    customer_contacts.feedback_failed(email, meta.get("job_id"))
+    orders_collection.update_many({"email": email}, {"$set": {"feedback_email_sent": False}})
+
+
+email_outbox.on_delivery("feedback", failed=_on_feedback_parked)
+
+
 @app.post("/send-feedback-email/{job_id}")
 def send_feedback_email(job_id: str, background_tasks: BackgroundTasks):
     # 1) Find the order
@@ -5616,11 +4908,8 @@ def send_feedback_email(job_id: str, background_tasks: BackgroundTasks):
         raise HTTPException(
             status_code=400, detail="No email found for this order"
         )
-    # 2) Check if feedback email was already sent for this email
-    already_sent_for_email = orders_collection.find_one(
-        {"email": recipient_email, "feedback_email_sent": True}
-    )
-    if already_sent_for_email:
+    # 2) Check if feedback email was already sent for this email (_id lookup)
+    if customer_contacts.feedback_sent(recipient_email):
         logger.info(
             f"⚠️ Feedback email already sent earlier for {recipient_email}, skipping."
         )
@@ -5630,149 +4919,19 @@ def send_feedback_email(job_id: str, background_tasks: BackgroundTasks):
             "email": recipient_email,
         }
 
+    stamped = False
     try:
-        # 3) Build HTML (unchanged)
-        html_content = f"""
-        <html>
-        <head>
-        <meta charset="UTF-8">
-        <meta name="color-scheme" content="light">
-        <meta name="supported-color-schemes" content="light">
-        <title>We'd love your feedback</title>
-        <style>
-        @keyframes shine-sweep {{
-          0%   {{ transform: translateX(-100%) rotate(45deg); }}
-          50%  {{ transform: translateX(100%)  rotate(45deg); }}
-          100% {{ transform: translateX(100%)  rotate(45deg); }}
-        }}
-        .review-btn {{
-          position: relative;
-          display: inline-block;
-          border-radius: 20px;
-          font-family: Arial, Helvetica, sans-serif;
-          font-weight: bold;
-          text-decoration: none;
-          color: #ffffff !important;
-          background-color: #5784ba;
-          overflow: hidden;
-          padding: 12px 24px;
-          font-size: 16px;
-        }}
-        .review-btn::before {{
-          content: "";
-          position: absolute;
-          top: 0;
-          left: -50%;
-          height: 100%;
-          width: 200%;
-          background: linear-gradient(120deg, transparent 0%, rgba(255,255,255,0.6) 50%, transparent 100%);
-          animation: shine-sweep 4s infinite;
-        }}
-        @media only screen and (max-width: 480px) {{
-            h2 {{ font-size: 15px !important; }}
-            p {{ font-size: 15px !important; }}
-            a {{ font-size: 15px !important; }}
-            .title-text {{ font-size: 18px !important; }}
-            .small-text {{ font-size: 12px !important; }}
-            .logo-img {{ width: 300px !important; }}
-            .review-btn {{ font-size: 13px !important; padding: 10px 16px !important; width: 100% !important; text-align: center !important; }}
-            .browse-now-btn {{
-              font-size: 12px !important;
-              padding: 8px 12px !important;
-            }}
-        }}
-        </style>
-
-        </head>
-        <body style="font-family: Arial, sans-serif; background-color: #f7f7f7; padding: 20px; margin: 0;">
-        <table width="100%" cellpadding="0" cellspacing="0" border="0" bgcolor="#ffffff" style="max-width: 600px; margin: 0 auto; border-radius: 8px; box-shadow: 0 0 10px rgba(0,0,0,0.1);">
-            <tr>
-            <td style="padding: 20px;">
-                <div style="text-align: left; margin-bottom: 20px;">
-                <img src="https://diffrungenerations.s3.ap-south-1.amazonaws.com/Diffrun_logo+(1).png" alt="Diffrun" class="logo-img" style="max-width: 100px;">
-                </div>
-
-                <h2 style="color: #333; font-size: 15px;">Hey {order.get("user_name")},</h2>
-
-                <p style="font-size: 14px; color: #555;">
-                We truly hope {order.get("name", "")} is enjoying {personalize_pronoun(order.get("gender", "   "))} magical storybook, <strong>{generate_book_title(order.get("book_id"), order.get("name"))}</strong>! 
-                At Diffrun, we are dedicated to crafting personalized storybooks that inspire joy, imagination, and lasting memories for every child. 
-                Your feedback means the world to us. We'd be grateful if you could share your experience.
-                </p>
-
-                <p style="font-size: 14px; color: #555;">Please share your feedback with us:</p>
-
-                <p style="text-align: left; margin: 30px 0;">
-                <a href="https://search.google.com/local/writereview?placeid=ChIJn5mGENoTrjsRPHxH86vgui0"
-                    class="review-btn"
-                    style="background-color: #5784ba; color: #ffffff; text-decoration: none; border-radius: 20px;">
-                    Leave a Google Review
-                </a>
-                </p>
-
-                <p style="font-size: 14px; color: #555; text-align: left;">
-                Thanks,<br>Team Diffrun
-                </p>
-
-                <hr style="border: none; border-top: 1px solid #eee; margin: 20px 0;">
-
-                <table width="100%" cellpadding="0" cellspacing="0" border="0" style="margin-top: 30px;">
-                <tr>
-                    <td colspan="2" style="padding: 10px 0; text-align: left;">
-                    <p class="title-text" style="font-size: 18px; margin: 0; font-weight: bold; color: #000;">
-                            {generate_book_title(order.get("book_id"), order.get("name"))}
-                            </p>
-                    </td>
-                </tr>
-
-                <tr>
-                    <td style="padding: 0; vertical-align: top; font-size: 12px; color: #333; font-weight: 500;">
-                    Order reference ID: <span>{order.get("order_id", "N/A")}</span>
-                    </td>
-                    <td style="padding: 0; text-align: right; font-size: 12px; color: #333; font-weight: 500;">
-                    Ordered: <span>{format_date(order.get("approved_at", ""))}</span>
-                    </td>
-                </tr>
-
-                <tr>
-                    <td colspan="2" style="padding: 0; margin: 0; background-color: #f7f6cf;">
-                    <table width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse: collapse; padding: 0; margin: 0;">
-                        <tr>
-                        <td style="padding: 20px; vertical-align: middle; margin: 0;">
-                            
-                            <p style="font-size: 15px; margin: 0;">
-                        Explore more magical books in our growing collection &nbsp;
-                        <button class="browse-now-btn" style="background-color:#5784ba; margin-top: 20px; border-radius: 30px;border: none;padding:10px 15px"><a href="https://diffrun.com" style="color:white; font-weight: bold; text-decoration: none;">
-                        Browse Now
-                        </a></button>
-                    </p>
-                        </td>
-
-                        <td width="300" style="padding: 0; margin: 0; vertical-align: middle;">
-                            <table width="100%" cellpadding="0" cellspacing="0" border="0" style="border-collapse: collapse;">
-                            <tr>
-                                <td align="right" style="padding: 0; margin: 0;">
-                                <img src="https://diffrungenerations.s3.ap-south-1.amazonaws.com/email_image+(2).jpg" 
-                                    alt="Cover Image" 
-                                    width="300" 
-                                    style="display: block; border-radius: 0; margin: 0; padding: 0;">
-                                </td>
-                            </tr>
-                            </table>
-                        </td>
-                        </tr>
-                    </table>
-                    </td>
-                </tr>
-
-                </table>
-
-            </td>
-            </tr>
-        </table>
-        </body>
-        </html>
-        """
+        # 3) Build HTML from the precompiled template
+        book_title = generate_book_title(order.get("book_id"), order.get("name"))
+        html_content = render_email(
+            "feedback",
+            user_name=order.get("user_name"),
+            child_name=order.get("name", ""),
+            pronoun=personalize_pronoun(order.get("gender", "   ")),
+            book_title=book_title,
+            order_id=order.get("order_id", "N/A"),
+            ordered_on=format_date(order.get("approved_at", "")),
+        )
 
         msg = EmailMessage()
         msg["Subject"] = f"We'd love your feedback on {order.get('name', '')}'s Storybook!"
@@ -5781,14 +4940,11 @@ def send_feedback_email(job_id: str, background_tasks: BackgroundTasks):
         msg.set_content("This email contains HTML content.")
         msg.add_alternative(html_content, subtype="html")
 
-        # 4) Actually send
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            EMAIL_USER = os.getenv("EMAIL_ADDRESS")
-            EMAIL_PASS = os.getenv("EMAIL_PASSWORD")
-            smtp.login(EMAIL_USER, EMAIL_PASS)
-            smtp.send_message(msg)
-
-        logger.info(f"✅ Feedback email sent to {recipient_email}")
+        # 4) Stamp first, then queue: the outbox undoes the stamps if it parks
+        #    the message as failed (_on_feedback_parked)
+        meta = {"email": recipient_email, "job_id": job_id}
+        customer_contacts.record_sent(recipient_email, "feedback", job_id)
+        stamped = True
 
         # 5) Mark ALL orders for this email as feedback_email_sent
         orders_collection.update_many(
@@ -5796,11 +4952,17 @@ def send_feedback_email(job_id: str, background_tasks: BackgroundTasks):
             {"$set": {"feedback_email_sent": True}},
         )
 
+        # 6) Queue for delivery (outbox retries transient SMTP failures)
+        queue_email(msg, kind="feedback", meta=meta)
+        logger.info(f"✅ Feedback email queued for {recipient_email}")
+
     except Exception as e:
         logger.error(f"❌ Failed to send feedback email: {e}")
+        if stamped:
+            _on_feedback_parked(meta, str(e))
         raise HTTPException(status_code=500, detail="Failed to send email.")
 
-    # 6) Consistent response for both cron and manual call
+    # 7) Consistent response for both cron and manual call
     return {
         "status": "sent",
         "message": "Feedback email sent",
@@ -5810,99 +4972,11 @@ def send_feedback_email(job_id: str, background_tasks: BackgroundTasks):
 
 @app.get("/debug/feedback-email-candidates")
 def debug_feedback_email_candidates():
-
-    blocked_emails = orders_collection.distinct(
-        "email",
-        {
-            "$or": [
-                {"feedback_email_sent": True},
-                {"feedback_email": True},
-            ]
-        }
-    )
-
-    pipeline = [
-        {
-            "$match": {
-                "email": {"$exists": True, "$ne": "", "$nin": blocked_emails},
-                "feedback_email_sent": {"$ne": True},
-                "feedback_email": {"$ne": True},
-                "processed_at": {"$exists": True, "$ne": None},
-            }
-        },
-        {
-            "$lookup": {
-                "from": "shipping_details",
-                "localField": "order_id",
-                "foreignField": "order_id",
-                "as": "shipping_docs",
-            }
-        },
-        {"$unwind": "$shipping_docs"},
-        {
-            "$match": {
-                "$or": [
-                    {"shipping_docs.shiprocket_data.current_status": "DELIVERED"},
-                    {"shipping_docs.shiprocket_data.shipment_status": "DELIVERED"},
-                ],
-                "shipping_docs.shiprocket_data.current_timestamp_iso": {
-                    "$exists": True,
-                    "$ne": None,
-                },
-            }
-        },
-        {
-            "$addFields": {
-                "processed_dt": {"$toDate": "$processed_at"},
-                "delivered_dt": {
-                    "$toDate": "$shipping_docs.shiprocket_data.current_timestamp_iso"
-                },
-            }
-        },
-        {
-            "$addFields": {
-                "processing_to_delivery_days": {
-                    "$dateDiff": {
-                        "startDate": "$processed_dt",
-                        "endDate": "$delivered_dt",
-                        "unit": "day",
-                        "timezone": "Asia/Kolkata",
-                    }
-                }
-            }
-        },
-        {
-            "$match": {
-                "$expr": {
-                    "$and": [
-                        {"$gte": ["$processing_to_delivery_days", 0]},
-                        {"$lte": ["$processing_to_delivery_days", 8]},
-                    ]
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$email",
-                "sample": {"$first": "$$ROOT"},
-            }
-        },
-        {"$replaceRoot": {"newRoot": "$sample"}},
-        {
-            "$project": {
-                "_id": 0,
-                "email": 1,
-                "order_id": 1,
-                "job_id": 1,
-                "processing_to_delivery_days": 1,
-            }
-        },
-    ]
-
-    candidates = list(orders_collection.aggregate(pipeline))
+    customer_contacts.ensure_backfilled(orders_collection)
+    candidates = customer_contacts.feedback_due(limit=1000)
 
     return {
-        "blocked_emails_count": len(blocked_emails),
+        "blocked_emails_count": customer_contacts.feedback_sent_count(),
         "total_unique_emails": len(candidates),
         "candidates": candidates,
     }
@@ -5910,88 +4984,9 @@ def debug_feedback_email_candidates():
 
 @app.post("/cron/feedback-emails")
 def cron_feedback_emails(limit: int = 200):
-
-    blocked_emails = orders_collection.distinct(
-        "email",
-        {
-            "$or": [
-                {"feedback_email_sent": True},
-                {"feedback_email": True},
-            ]
-        }
-    )
-
-    pipeline = [
-        {
-            "$match": {
-                "email": {"$exists": True, "$ne": "", "$nin": blocked_emails},
-                "feedback_email_sent": {"$ne": True},
-                "feedback_email": {"$ne": True},
-                "processed_at": {"$exists": True, "$ne": None},
-            }
-        },
-        {
-            "$lookup": {
-                "from": "shipping_details",
-                "localField": "order_id",
-                "foreignField": "order_id",
-                "as": "shipping_docs",
-            }
-        },
-        {"$unwind": "$shipping_docs"},
-        {
-            "$match": {
-                "$or": [
-                    {"shipping_docs.shiprocket_data.current_status": "DELIVERED"},
-                    {"shipping_docs.shiprocket_data.shipment_status": "DELIVERED"},
-                ],
-                "shipping_docs.shiprocket_data.current_timestamp_iso": {
-                    "$exists": True,
-                    "$ne": None,
-                },
-            }
-        },
-        {
-            "$addFields": {
-                "processed_dt": {"$toDate": "$processed_at"},
-                "delivered_dt": {
-                    "$toDate": "$shipping_docs.shiprocket_data.current_timestamp_iso"
-                },
-            }
-        },
-        {
-            "$addFields": {
-                "processing_to_delivery_days": {
-                    "$dateDiff": {
-                        "startDate": "$processed_dt",
-                        "endDate": "$delivered_dt",
-                        "unit": "day",
-                        "timezone": "Asia/Kolkata",
-                    }
-                }
-            }
-        },
-        {
-            "$match": {
-                "$expr": {
-                    "$and": [
-                        {"$gte": ["$processing_to_delivery_days", 0]},
-                        {"$lte": ["$processing_to_delivery_days", 8]},
-                    ]
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$email",
-                "sample": {"$first": "$$ROOT"},
-            }
-        },
-        {"$replaceRoot": {"newRoot": "$sample"}},
-        {"$limit": int(limit)},
-    ]
-
-    candidates = list(orders_collection.aggregate(pipeline))
+    # due contacts are marked by DELIVERED tracking events; one indexed find
+    customer_contacts.ensure_backfilled(orders_collection)
+    candidates = customer_contacts.feedback_due(limit=limit)
 
     results = {
         "total": len(candidates),
@@ -6001,12 +4996,22 @@ def cron_feedback_emails(limit: int = 200):
     }
 
     for c in candidates:
+        if not c.get("job_id"):
+            # find_one({"job_id": None}) would match some other customer's order
+            customer_contacts.clear_feedback_due(c["email"])
+            results["skipped"] += 1
+            continue
         try:
             res = send_feedback_email(c["job_id"], BackgroundTasks())
             if res.get("status") == "sent":
                 results["sent"] += 1
             else:
                 results["skipped"] += 1
+        except HTTPException as e:
+            if e.status_code < 500:
+                # order gone / no email on it: stop offering this customer every run
+                customer_contacts.clear_feedback_due(c["email"])
+            results["errors"] += 1
         except Exception:
             results["errors"] += 1
 
@@ -6043,19 +5048,7 @@ def mark_reconciled(payload: dict):
     if not job_id:
         raise HTTPException(status_code=400, detail="job_id is required")
 
-    now = datetime.now(timezone.utc)
-    update = {
-        "reconcile": True,
-        "reconciled_at": now,
-    }
-    if razorpay_payment_id:
-        # doesn’t overwrite your verify logic—just stores it if you want
-        update["transaction_id"] = razorpay_payment_id
-
-    result = orders_collection.update_one(
-        {"job_id": job_id},
-        {"$set": update}
-    )
+    result = mark_job_reconciled(orders_collection, job_id, razorpay_payment_id)
 
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="job_id not found")
@@ -6064,8 +5057,8 @@ def mark_reconciled(payload: dict):
 
 
 @app.post("/debug/run-reconcile-now")
-def debug_run_reconcile_now():
-    _hourly_reconcile_and_email()
+async def debug_run_reconcile_now():
+    await _hourly_reconcile_and_email()
     return {"ok": True}
 
 
@@ -6126,16 +5119,85 @@ def _pick_image_list(doc: Dict[str, Any]) -> List[str]:
     return []
 
 
-def _build_order_response(order: Dict[str, Any]) -> Dict[str, Any]:
+# fields _build_order_response may take from another order of the same job
+_JOB_DOC_PROJECTION = {
+    "_id": 0, "name": 1, "age": 1, "gender": 1, "book_id": 1,
+    "saved_files": 1, "child.saved_files": 1,
+    "child1_age": 1, "child2_age": 1,
+    "child1_image_filenames": 1, "child2_image_filenames": 1,
+}
+
+
+def _order_job_id(order: Dict[str, Any]) -> str:
+    return _first_non_empty(order, ["job_id", "JobId", "jobID"], default="")
+
+
+def _needs_job_doc(order: Dict[str, Any]) -> bool:
+    """
+    True when the order lacks child fields that another doc with its job_id may hold.
+    The old find_one({"job_id": ...}) almost always returned the order itself, so
+    a complete order is its own job doc.
+    """
+    if any(_first_non_empty(order, [f]) in (None, "") for f in ("name", "age", "gender", "book_id")):
+        return True
+    if not _pick_image_list(order):
+        return True
+    if _is_twin_book(order.get("book_id") or ""):
+        return not (order.get("child1_image_filenames") and order.get("child2_image_filenames"))
+    return False
+
+
+def _job_docs_for(orders: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """{job_id: job doc} for the orders that need one, with a single $in query."""
+    job_ids = list(dict.fromkeys(
+        jid for o in orders if (jid := _order_job_id(o)) and _needs_job_doc(o)))
+    if not job_ids:
+        return {}
+    out: Dict[str, Dict[str, Any]] = {}
+    for d in orders_collection.find(
+            {"job_id": {"$in": job_ids}}, {**_JOB_DOC_PROJECTION, "job_id": 1}):
+        out.setdefault(d.get("job_id"), d)
+    return out
+
+
+def _order_image_groups(order: Dict[str, Any], user_doc: Dict[str, Any]) -> List[List[str]]:
+    """[saved_files, child1_files, child2_files] as shown on the order detail."""
+    return [
+        _pick_image_list(order) or _pick_image_list(user_doc),
+        _coerce_list(order.get("child1_image_filenames")
+                     or user_doc.get("child1_image_filenames"))[:3],
+        _coerce_list(order.get("child2_image_filenames")
+                     or user_doc.get("child2_image_filenames"))[:3],
+    ]
+
+
+# "not passed" marker for _build_order_response's cover_url, where None is a result
+_COVER_NOT_RESOLVED: Any = object()
+
+
+def _build_order_response(
+    order: Dict[str, Any],
+    job_doc: Optional[Dict[str, Any]] = None,
+    image_urls: Optional[List[List[str]]] = None,
+    cover_url: Optional[str] = _COVER_NOT_RESOLVED,
+) -> Dict[str, Any]:
+    """
+    Order detail payload. `job_doc`, `image_urls` and `cover_url` let a batch caller
+    pass what it already resolved in bulk (cover_url=None: no cover); anything
+    omitted is looked up here.
+    """
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
 
-    job_id = _first_non_empty(order, ["job_id", "JobId", "jobID"], default="")
+    job_id = _order_job_id(order)
     current_status = order.get("current_status") 
 
-    user_doc = {}
-    if job_id:
-        user_doc = orders_collection.find_one({"job_id": job_id}) or {}
+    user_doc = job_doc
+    if user_doc is None:
+        user_doc = {}
+        if job_id:
+            user_doc = order if not _needs_job_doc(order) else (
+                orders_collection.find_one({"job_id": job_id}, _JOB_DOC_PROJECTION) or {})
 
     child_name = _first_non_empty(
         order, ["name"],   default=_first_non_empty(user_doc, ["name"]))
@@ -6144,12 +5206,7 @@ def _build_order_response(order: Dict[str, Any]) -> Dict[str, Any]:
     child_gender = _first_non_empty(
         order, ["gender"], default=_first_non_empty(user_doc, ["gender"]))
 
-    saved_files = _pick_image_list(order) or _pick_image_list(user_doc)
-
-    saved_file_urls: list[str] = []
-    if saved_files:
-        saved_file_urls = _presigned_urls_for_saved_files(
-            saved_files, expires_in=3600)
+    saved_files, child1_files, child2_files = _order_image_groups(order, user_doc)
 
     book_id = _first_non_empty(
         order, ["book_id"], default=_first_non_empty(user_doc, ["book_id"])) or ""
@@ -6160,15 +5217,11 @@ def _build_order_response(order: Dict[str, Any]) -> Dict[str, Any]:
     child2_age = _first_non_empty(
         order, ["child2_age"], default=_first_non_empty(user_doc, ["child2_age"]))
 
-    child1_files = _coerce_list(order.get(
-        "child1_image_filenames") or user_doc.get("child1_image_filenames"))[:3]
-    child2_files = _coerce_list(order.get(
-        "child2_image_filenames") or user_doc.get("child2_image_filenames"))[:3]
-
-    child1_input_urls: list[str] = _presigned_urls_for_saved_files(
-        child1_files, expires_in=3600) if child1_files else []
-    child2_input_urls: list[str] = _presigned_urls_for_saved_files(
-        child2_files, expires_in=3600) if child2_files else []
+    if image_urls is None:
+        # one concurrent existence round for all three image sets
+        image_urls = _presigned_urls_for_file_groups(
+            [saved_files, child1_files, child2_files], expires_in=3600)
+    saved_file_urls, child1_input_urls, child2_input_urls = image_urls
 
     child_details = {
         "name": (child_name or ""),
@@ -6199,8 +5252,10 @@ def _build_order_response(order: Dict[str, Any]) -> Dict[str, Any]:
         "phone_number": phone_number or "",
     }
 
-    cover_url_from_gen = _find_cover_image_url_from_generations(
-        job_id, expires_in=3600)
+    cover_url_from_gen = cover_url
+    if cover_url_from_gen is _COVER_NOT_RESOLVED:
+        cover_url_from_gen = _find_cover_image_url_from_generations(
+            job_id, expires_in=3600)
 
     # order financials/ids
     order_details = {
@@ -6273,6 +5328,48 @@ def _build_order_response(order: Dict[str, Any]) -> Dict[str, Any]:
     return response
 
 
+ORDER_DETAILS_MAX_IDS = 100
+
+
+# registered before /orders/{order_id} so "details" is not taken for an order id
+@app.get("/orders/details")
+def get_order_details(ids: str = Query(..., description="Comma-separated order_ids")):
+    """
+    Detail payloads for several orders. Orders, job docs and cover keys are each
+    one query whatever N is; all input images are presigned in one concurrent round.
+    """
+    order_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not order_ids:
+        raise HTTPException(status_code=400, detail="ids is required")
+    if len(order_ids) > ORDER_DETAILS_MAX_IDS:
+        raise HTTPException(status_code=400,
+                            detail=f"At most {ORDER_DETAILS_MAX_IDS} ids per request")
+
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for o in orders_collection.find({"order_id": {"$in": order_ids}}):
+        by_id.setdefault(o.get("order_id"), o)
+    orders = [by_id[i] for i in order_ids if i in by_id]
+
+    job_docs = _job_docs_for(orders)
+    resolved = []
+    for o in orders:
+        jid = _order_job_id(o)
+        user_doc = (job_docs.get(jid) or {}) if jid and _needs_job_doc(o) else (o if jid else {})
+        resolved.append((o, user_doc, _order_image_groups(o, user_doc)))
+
+    url_groups = _presigned_urls_for_file_groups(
+        [g for _, _, groups in resolved for g in groups], expires_in=3600)
+    covers = _find_cover_image_urls_from_generations([_order_job_id(o) for o in orders])
+
+    results = [
+        _build_order_response(
+            o, job_doc=user_doc, image_urls=url_groups[3 * n:3 * n + 3],
+            cover_url=covers.get(_order_job_id(o)))
+        for n, (o, user_doc, _) in enumerate(resolved)
+    ]
+    return {"orders": results, "missing": [i for i in order_ids if i not in by_id]}
+
+
 @app.get("/orders/{order_id}")
 def get_order_detail(order_id: str):
     order = orders_collection.find_one({"order_id": order_id})
@@ -6545,98 +5642,71 @@ def patch_order(order_id: str, update: OrderUpdate):
     return {"updated": bool(res.modified_count), "order": _build_order_response(updated)}
 
 
-def _get_s3_client() -> Tuple[boto3.client, str]:
-    bucket = os.getenv("REPLICACOMFY_BUCKET", "").strip()
-    region = get_aws_region()
-    return boto3.client(
-        "s3",
-        region_name=region,
-        config=Config(
-            retries={"max_attempts": 3, "mode": "standard"}
-        )
-    )
-
-   
-
-
 def _s3_key_for_input(filename: str) -> str:
     base = os.path.basename(filename).strip()
     return f"input/{base}"
 
 
-def _generate_presigned_url(s3, bucket: str, key: str, expires_in: int = 3600) -> str:
-    return s3.generate_presigned_url(
-        "get_object",
-        Params={"Bucket": bucket, "Key": key},
-        ExpiresIn=expires_in,
-    )
+def _presigned_urls_for_file_groups(groups: List[List[str]], expires_in: int = 3600) -> List[List[str]]:
+    """
+    Presigned input-image URLs for several file lists (up to 3 each) in one go:
+    unknown keys are HEAD-checked concurrently, missing ones are skipped.
+    """
+    key_groups = [[_s3_key_for_input(f) for f in (files or [])[:3]] for files in groups]
+    all_keys = [k for ks in key_groups for k in ks]
+    if not all_keys:
+        return [[] for _ in key_groups]
+    bucket = os.getenv("REPLICACOMFY_BUCKET")
+    try:
+        urls = s3_access.presign_existing(get_aws_region(), bucket, all_keys, expires_in=expires_in)
+    except HTTPException:
+        raise
+    except NoCredentialsError:
+        raise HTTPException(
+            status_code=500, detail="AWS credentials not available")
+    except PartialCredentialsError:
+        raise HTTPException(
+            status_code=500, detail="AWS credentials are incomplete")
+    except ClientError:
+        raise HTTPException(
+            status_code=502, detail="S3 error while generating image URLs")
+    except Exception:
+        raise HTTPException(
+            status_code=502, detail="Unexpected error while generating image URLs")
+    return [[urls[k] for k in ks if k in urls] for ks in key_groups]
 
 
 def _presigned_urls_for_saved_files(files: List[str], expires_in: int = 3600) -> List[str]:
     if not files:
         return []
-    try:
-        bucket = os.getenv("REPLICACOMFY_BUCKET")
-        s3 = _get_s3_client()
-    except HTTPException:
-        raise
-
-    urls: List[str] = []
-    for f in files[:3]:
-        key = _s3_key_for_input(f)
-        try:
-            # Verify the object exists before signing
-            s3.head_object(Bucket=bucket, Key=key)
-            urls.append(_generate_presigned_url(
-                s3, bucket, key, expires_in=expires_in))
-        except NoCredentialsError:
-            raise HTTPException(
-                status_code=500, detail="AWS credentials not available")
-        except PartialCredentialsError:
-            raise HTTPException(
-                status_code=500, detail="AWS credentials are incomplete")
-        except ClientError as e:
-            code = getattr(e, "response", {}).get("Error", {}).get("Code")
-            if code in ("404", "NoSuchKey", "NotFound", "AccessDenied"):
-                # Skip silently—don’t break the whole order response
-                continue
-            raise HTTPException(
-                status_code=502, detail="S3 error while generating image URLs")
-        except Exception:
-            raise HTTPException(
-                status_code=502, detail="Unexpected error while generating image URLs")
-    return urls
+    return _presigned_urls_for_file_groups([files], expires_in=expires_in)[0]
 
 
 def _get_s3_client_generic():
-    region = (os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION") or "").strip()
-    if not region:
-        raise HTTPException(
-            status_code=500,
-            detail="AWS region not configured"
-        )
+    # process-wide client, shared with the presign/existence caches
+    return s3_access.client(get_aws_region())
 
-    return boto3.client(
-        "s3",
-        region_name=region,
-        config=Config(
-            retries={"max_attempts": 3, "mode": "standard"}
-        ),
-    )
+def _cover_prefix(job_id: str) -> str:
+    return f"jpg_output/{job_id}_pg0_"
 
-def _list_objects_with_prefix(s3, bucket: str, prefix: str, max_collect: int = 1000) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
-    token: Optional[str] = None
-    while True:
-        kwargs = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": 1000}
-        if token:
-            kwargs["ContinuationToken"] = token
-        resp = s3.list_objects_v2(**kwargs)
-        out.extend(resp.get("Contents", []) or [])
-        if not resp.get("IsTruncated") or len(out) >= max_collect:
-            break
-        token = resp.get("NextContinuationToken")
-    return out
+
+def _cover_url_from_objects(bucket: str, objs: List[Dict[str, Any]], expires_in: int = 3600) -> Optional[str]:
+    if not objs:
+        return None
+
+    preferred = [o for o in objs if str(
+        o.get("Key", "")).lower().endswith("_001.jpg")]
+    chosen = min(preferred or objs, key=lambda o: o.get("LastModified"))
+
+    try:
+        return s3_access.presign(
+            get_aws_region(), bucket, chosen["Key"], expires_in,
+            # Force browser-friendly headers for inline display
+            ResponseContentType="image/jpeg",
+            ResponseContentDisposition="inline",
+        )
+    except ClientError:
+        return None
 
 
 def _find_cover_image_url_from_generations(job_id: str, expires_in: int = 3600) -> Optional[str]:
@@ -6645,34 +5715,26 @@ def _find_cover_image_url_from_generations(job_id: str, expires_in: int = 3600)
         return None
 
     s3 = _get_s3_client_generic()
-    prefix = f"jpg_output/{job_id}_pg0_"
 
     try:
-        objs = _list_objects_with_prefix(s3, bucket, prefix, max_collect=2000)
+        # known keys come from the index; S3 is listed only on first access
+        objs = s3_key_index.objects(s3, bucket, _cover_prefix(job_id), job_id=job_id)
     except ClientError:
         return None
+    return _cover_url_from_objects(bucket, objs, expires_in)
 
-    if not objs:
-        return None
 
-    preferred = [o for o in objs if str(
-        o.get("Key", "")).lower().endswith("_001.jpg")]
-    chosen = min(preferred or objs, key=lambda o: o.get("LastModified"))
+def _find_cover_image_urls_from_generations(job_ids: List[str], expires_in: int = 3600) -> Dict[str, Optional[str]]:
+    """Batch form: {job_id: cover url or None}, with one key-index query for all jobs."""
+    bucket = (os.getenv("DIFFRUN_GENERATIONS_BUCKET") or "").strip()
+    job_ids = [j for j in dict.fromkeys(job_ids) if j]
+    if not bucket or not job_ids:
+        return {}
 
-    try:
-        return s3.generate_presigned_url(
-            "get_object",
-            Params={
-                "Bucket": bucket,
-                "Key": chosen["Key"],
-                # Force browser-friendly headers for inline display
-                "ResponseContentType": "image/jpeg",
-                "ResponseContentDisposition": "inline",
-            },
-            ExpiresIn=expires_in,
-        )
-    except ClientError:
-        return None
+    by_prefix = s3_key_index.objects_many(
+        _get_s3_client_generic(), bucket, {_cover_prefix(j): j for j in job_ids})
+    return {j: _cover_url_from_objects(bucket, by_prefix.get(_cover_prefix(j)) or [], expires_in)
+            for j in job_ids}
 
 
 def _is_twin_book(book_id: str) -> bool:
@@ -6735,8 +5797,6 @@ def get_job_mini(job_id: str) -> Dict[str, Any]:
     )
 
     saved_files = _pick_image_list(order)
-    input_image_urls = _presigned_urls_for_saved_files(
-        saved_files, expires_in=3600) if saved_files else []
 
     child1_filenames = order.get("child1_image_filenames") or []
     child2_filenames = order.get("child2_image_filenames") or []
@@ -6750,10 +5810,9 @@ def get_job_mini(job_id: str) -> Dict[str, Any]:
     child2_filenames = [str(x).strip()
                         for x in child2_filenames if str(x).strip()][:3]
 
-    child1_input_images = _presigned_urls_for_saved_files(
-        child1_filenames, expires_in=3600) if child1_filenames else []
-    child2_input_images = _presigned_urls_for_saved_files(
-        child2_filenames, expires_in=3600) if child2_filenames else []
+    # one concurrent existence round for all three image sets
+    input_image_urls, child1_input_images, child2_input_images = _presigned_urls_for_file_groups(
+        [saved_files, child1_filenames, child2_filenames], expires_in=3600)
 
     return {
         "job_id": job_id,
@@ -7114,104 +6173,10 @@ def shiprocket_create_from_orders(
     return {"created": created_refs, "awbs": awb_results, "pickup": pickup_res, "errors": errors}
 
 
-def _to_number(value):
-    try:
-        if value is None:
-            return 0
-        if isinstance(value, (int, float)):
-            return value
-        value = value.strip()
-        if value == "":
-            return 0
-        return float(value)
-    except Exception:
-        return 0
-
-
 @app.get("/shiprocket/order/show")
 def shiprocket_order_show(internal_order_id: str):
-
-    if not internal_order_id:
-        raise HTTPException(
-            status_code=400, detail="internal_order_id required")
-
-    # 1️⃣ Lookup internal order in orders collection (UNCHANGED)
-    doc = orders_collection.find_one({"order_id": internal_order_id})
-    if not doc:
-        raise HTTPException(
-            status_code=404, detail=f"{internal_order_id} not found in database")
-
-    sr_order_id = (
-        doc.get("sr_order_id")
-        or doc.get("shiprocket_data", {}).get("sr_order_id")
-    )
-    if not sr_order_id:
-        raise HTTPException(
-            status_code=400,
-            detail=f"{internal_order_id} has no Shiprocket order linked (sr_order_id missing)"
-        )
-
-    # 2️⃣ Call Shiprocket API (UNCHANGED)
-    token = _sr_login_token()
-    headers = _sr_headers(token)
-    url = f"{SHIPROCKET_BASE}/v1/external/orders/show/{sr_order_id}"
-
-    try:
-        r = requests.get(url, headers=headers, timeout=30)
-        r.raise_for_status()
-    except Exception as e:
-        raise HTTPException(
-            status_code=502, detail=f"Shiprocket API error: {str(e)}")
-
-    data = r.json().get("data", {}) or {}
-
-    # 3️⃣ Extract shipping_charges (UNCHANGED)
-    raw_shipping = (
-        data.get("others", {}).get("shipping_charges")
-        or data.get("others", {}).get("shipping_charge")
-        or data.get("shipping_charges")
-        or data.get("shipping_charge")
-        or data.get("awb_data", {}).get("charges", {}).get("freight_charges")
-        or "0"
-    )
-
-    shipping_charges = _to_number(raw_shipping)
-
-    # 4️⃣ Extract courier_name (UNCHANGED)
-    shipments = data.get("shipments") or {}
-    if isinstance(shipments, dict):
-        courier_name = shipments.get(
-            "courier") or shipments.get("courier_name") or ""
-    elif isinstance(shipments, list) and shipments:
-        courier_name = shipments[0].get(
-            "courier") or shipments[0].get("courier_name") or ""
-    else:
-        courier_name = ""
-
-    # 5️⃣ Store the result ONLY in shipping_collection
-    try:
-        shipping_collection.update_one(
-            {"order_id": internal_order_id},
-            {
-                "$set": {
-                    "order_id": internal_order_id,
-                    "sr_order_id": sr_order_id,
-                    "shipping_charges": shipping_charges,
-                    "courier_name": courier_name,
-                    "shiprocket_raw": data,
-                }
-            },
-            upsert=True
-        )
-    except Exception as e:
-        logging.exception(
-            f"[SR] Failed to update shipping_collection for {internal_order_id}: {e}")
-
-    return {
-        "order_id": internal_order_id,
-        "courier_name": courier_name,
-        "shipping_charges": shipping_charges
-    }
+    # same call the tracking webhook makes in-process
+    return sync_order_show(orders_collection, shipping_collection, internal_order_id)
 
 
 from fastapi import Query
@@ -8156,6 +7121,25 @@ def normalize_tracking_data(tracking_response):
 # -------------------------------------------------
 # Mongo Updates
 # -------------------------------------------------
+def _note_delivery_from_tracking(order_id: str, data: dict) -> None:
+    """A polled DELIVERED status marks feedback due, as the Shiprocket webhook does."""
+    if (data.get("current_status") or "").upper() != "DELIVERED":
+        return
+    try:
+        order = orders_collection.find_one(
+            {"order_id": order_id},
+            {"email": 1, "job_id": 1, "processed_at": 1, "feedback_email_sent": 1, "feedback_email": 1, "_id": 0},
+        )
+        if not order or order.get("feedback_email_sent") or order.get("feedback_email"):
+            return
+        customer_contacts.note_delivery(
+            order.get("email"), order.get("job_id"), order_id,
+            order.get("processed_at"), data.get("current_timestamp_iso"),
+        )
+    except Exception:
+        logger.exception("[TRACKING] failed to mark feedback due for order %s", order_id)
+
+
 def update_shipping_details(order_id: str, data: dict):
     shipping_collection.update_one(
         {"order_id": order_id},
@@ -8169,6 +7153,7 @@ def update_shipping_details(order_id: str, data: dict):
             }
         }
     )
+    _note_delivery_from_tracking(order_id, data)
 
 
 def update_order_details(order_id: str, data: dict):
@@ -8401,6 +7386,7 @@ def update_shipping_details(order_id: str, data: dict):
             }
         }
     )
+    _note_delivery_from_tracking(order_id, data)
 
 
 def update_order_details(order_id: str, data: dict):
@@ -18,7 +18,8 @@ def main():
     from_utc = from_ist.astimezone(pytz.utc).replace(tzinfo=None)
     to_utc = to_ist.astimezone(pytz.utc).replace(tzinfo=None)
 
-    # Run export
+    # Run export (shares the xlsx_pivot_cache collection with the scheduled job,
+    # so only the still-open IST hours are queried)
     xlsx_bytes, fname = _export_xlsx_bytes(from_utc, to_utc)
 
     # Save under exports/